@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare powerdns (SQL) and pdnsapi (HTTP API) managers on the same
+workload: single record adds, batched adds, reads and deletes. SQL backend
+runs on in-memory sqlite with pdns utilities disabled, API backend runs
+against the in-process stub server from tests, so numbers show the
+overhead of the backends themselves, not of PowerDNS.
+
+    python benchmarks/backends.py [count] [batch]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from nova import flags
+FLAGS = flags.FLAGS
+FLAGS.dns_sql_connection = "sqlite://"
+FLAGS.dns_powerdns_flush_window = 0
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nova_dns.dnsmanager import RecordTuple
+from nova_dns.dnsmanager import pdnsapi
+from nova_dns.dnsmanager import powerdns
+from nova_dns.dnsmanager.powerdns import pipeline
+from tests import pdns_stub
+
+
+def workload(manager, count, batch):
+    """ yield (step, seconds) """
+    manager.add("bench.local")
+    zone = manager.get("bench.local")
+    start = time.time()
+    for i in xrange(count):
+        zone.add(RecordTuple("single-%d" % i, "A", "10.0.%d.%d" % (i >> 8 & 255,
+            i & 255)))
+    yield "add", time.time() - start
+    start = time.time()
+    for i in xrange(0, count, batch):
+        zone.add_many([RecordTuple("batch-%d" % j, "A", "10.1.%d.%d" % (
+            j >> 8 & 255, j & 255)) for j in xrange(i, min(i + batch, count))])
+    yield "add_many", time.time() - start
+    start = time.time()
+    for i in xrange(count):
+        zone.get("single-%d" % i, "A")
+    yield "get", time.time() - start
+    start = time.time()
+    for i in xrange(count):
+        zone.delete("single-%d" % i, "A")
+    yield "delete", time.time() - start
+    manager.drop("bench.local", force=True)
+    manager.release()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    pipeline.subprocess.call = lambda args: 0
+    FLAGS.dns_powerdns_geomaps_dir = tempfile.mkdtemp()
+    server = pdns_stub.Server()
+    FLAGS.dns_pdnsapi_url = server.url
+    FLAGS.dns_pdnsapi_key = server.key
+    print "%d records, batches of %d" % (count, batch)
+    print "%-10s %-10s %10s %12s" % ("backend", "step", "seconds", "records/s")
+    for name, manager in (("powerdns", powerdns.Manager()),
+            ("pdnsapi", pdnsapi.Manager())):
+        for step, elapsed in workload(manager, count, batch):
+            print "%-10s %-10s %10.3f %12d" % (name, step, elapsed,
+                count / elapsed)
+    server.stop()
+    shutil.rmtree(FLAGS.dns_powerdns_geomaps_dir)
+
+
+if __name__ == '__main__':
+    main()
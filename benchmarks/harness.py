@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared setup of end-to-end benchmarks: nova and PowerDNS schemas on
+in-memory sqlite, pdns utilities disabled, latency and SQL statement
+statistics per operation.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlalchemy.event
+
+from nova import flags
+FLAGS = flags.FLAGS
+FLAGS.sql_connection = "sqlite://"
+FLAGS.dns_sql_connection = "sqlite://"
+FLAGS.dns_sync_on_start = False
+#no keystone, see auth.NoAuth
+FLAGS.dns_auth = "none"
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nova.db.sqlalchemy.session import get_engine
+from nova_dns.dnsmanager.powerdns import pipeline
+from nova_dns.dnsmanager.powerdns import session
+
+
+class Benchmark(object):
+    """ environment of one benchmark run, use as context manager """
+    def __init__(self, manager="nova_dns.dnsmanager.powerdns.Manager"):
+        FLAGS.dns_manager = manager
+        self.statements = 0
+        self.geomaps_dir = None
+
+    def __enter__(self):
+        self.geomaps_dir = tempfile.mkdtemp()
+        FLAGS.dns_powerdns_geomaps_dir = self.geomaps_dir
+        pipeline.subprocess.call = lambda args: 0
+        for engine in [get_engine(), session.get_engine()] + \
+                session.get_read_engines():
+            sqlalchemy.event.listen(engine, "before_cursor_execute",
+                self.count)
+        conn = get_engine()
+        conn.execute("drop table if exists instances")
+        conn.execute("drop table if exists fixed_ips")
+        conn.execute("create table instances (id integer primary key, "
+            "uuid varchar(36), hostname varchar(255), "
+            "project_id varchar(255), deleted boolean default 0)")
+        conn.execute("create table fixed_ips (id integer primary key, "
+            "address varchar(39), instance_id integer)")
+        conn.execute("create index fixed_ips_address on fixed_ips (address)")
+        conn.execute("create index instances_uuid on instances (uuid)")
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.geomaps_dir)
+
+    def count(self, *args):
+        self.statements += 1
+
+    def add_instances(self, count, tenants):
+        """ add instances with fixed ips to nova db, return their rows as
+        (uuid, hostname, project_id, address) """
+        rows = [("uuid-%d" % i, "host-%d" % i, "tenant-%d" % (i % tenants),
+            address(10, i)) for i in xrange(count)]
+        conn = get_engine()
+        conn.execute("insert into instances (id, uuid, hostname, project_id) "
+            "values (?, ?, ?, ?)", [(i, r[0], r[1], r[2])
+                for i, r in enumerate(rows)])
+        conn.execute("insert into fixed_ips (address, instance_id) "
+            "values (?, ?)", [(r[3], i) for i, r in enumerate(rows)])
+        return rows
+
+
+class Stats(object):
+    """ latencies and SQL statement counts per operation """
+    def __init__(self, benchmark):
+        self.benchmark = benchmark
+        #operation => [latencies, seconds, statements]
+        self.ops = {}
+        self.order = []
+
+    def phase(self, op):
+        """ context manager measuring wall time and statements of a phase
+        running operations of one kind """
+        return Phase(self, op)
+
+    def add(self, op, latency):
+        self.ops[op][0].append(latency)
+
+    def report(self, out=sys.stdout):
+        out.write("%-24s %8s %10s %9s %9s %9s\n" % ("operation", "count",
+            "ops/s", "p50 ms", "p99 ms", "SQL/op"))
+        for op in self.order:
+            latencies, seconds, statements = self.ops[op]
+            count = len(latencies)
+            if not count:
+                continue
+            out.write("%-24s %8d %10.1f %9.2f %9.2f %9.2f\n" % (op, count,
+                count / seconds if seconds else 0,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000,
+                float(statements) / count))
+
+
+class Phase(object):
+    def __init__(self, stats, op):
+        self.stats = stats
+        self.op = op
+
+    def __enter__(self):
+        if self.op not in self.stats.ops:
+            self.stats.ops[self.op] = [[], 0, 0]
+            self.stats.order.append(self.op)
+        self.started = time.time()
+        self.statements = self.stats.benchmark.statements
+        return self
+
+    def __exit__(self, *exc):
+        data = self.stats.ops[self.op]
+        data[1] += time.time() - self.started
+        data[2] += self.stats.benchmark.statements - self.statements
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def address(prefix, i):
+    return "%d.%d.%d.%d" % (prefix, i >> 16 & 255, i >> 8 & 255, i & 255)
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Replay storms of nova notifications thru amqp.Service into
+simple.Listener with PowerDNS schema on sqlite: run_instance and
+allocate_for_instance for every instance, then associate_floating_ip and
+terminate_instance. Latency of a message is the time from its delivery to
+its ack. Background poller of the listener is stopped, records are added
+on allocate_for_instance messages.
+
+    python benchmarks/listener_storm.py [--instances N] [--tenants N]
+        [--workers N] [--batch N] [--ptr]
+"""
+
+import optparse
+import time
+
+import eventlet
+
+import harness
+from harness import FLAGS
+from nova_dns import amqp
+from nova_dns import auth
+from nova_dns.listener import simple
+
+
+class Message(object):
+    delivery_info = {"routing_key": "compute.instance"}
+
+    def __init__(self, stats, op, delivery_tag):
+        self.stats = stats
+        self.op = op
+        self.delivery_tag = delivery_tag
+        self.delivered = time.time()
+
+    def ack(self):
+        self.stats.add(self.op, time.time() - self.delivered)
+
+
+class Channel(object):
+    """ acks of batching mode, basic_ack acks all messages up to tag """
+    def __init__(self):
+        self.unacked = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        while self.unacked and self.unacked[0].delivery_tag <= delivery_tag:
+            self.unacked.pop(0).ack()
+
+
+def storm(service, stats, op, bodies):
+    channel = service.channel
+    with stats.phase(op):
+        for tag, body in enumerate(bodies):
+            message = Message(stats, op, tag)
+            if FLAGS.dns_amqp_batch_size > 0:
+                channel.unacked.append(message)
+                service.collect_message(body, message)
+            else:
+                service.process_message(body, message)
+        service.process_batch()
+        service.pool.waitall()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--instances", type="int", default=1000)
+    parser.add_option("--tenants", type="int", default=10)
+    parser.add_option("--workers", type="int", default=1,
+        help="dns_amqp_workers")
+    parser.add_option("--batch", type="int", default=0,
+        help="dns_amqp_batch_size")
+    parser.add_option("--ptr", action="store_true", default=False,
+        help="manage PTR records")
+    options, args = parser.parse_args()
+    FLAGS.dns_amqp_workers = options.workers
+    FLAGS.dns_amqp_batch_size = options.batch
+    FLAGS.dns_ptr = options.ptr
+    FLAGS.dns_listener = "nova_dns.listener.simple.Listener"
+    simple.AUTH = auth.NoAuth()
+    with harness.Benchmark() as benchmark:
+        instances = benchmark.add_instances(options.instances,
+            options.tenants)
+        service = amqp.Service()
+        service.listener.eventlet.kill()
+        service.channel = Channel()
+        stats = harness.Stats(benchmark)
+        storm(service, stats, "run_instance", [{"method": "run_instance",
+            "args": {"instance_uuid": uuid}}
+            for uuid, hostname, project_id, address in instances])
+        storm(service, stats, "allocate_for_instance",
+            [{"method": "allocate_for_instance",
+                "args": {"instance_uuid": uuid}}
+            for uuid, hostname, project_id, address in instances])
+        storm(service, stats, "associate_floating_ip",
+            [{"method": "associate_floating_ip",
+                "args": {"fixed_address": address,
+                    "floating_address": harness.address(172, i)}}
+            for i, (uuid, hostname, project_id, address)
+            in enumerate(instances)])
+        storm(service, stats, "terminate_instance",
+            [{"method": "terminate_instance",
+                "args": {"instance_uuid": uuid}}
+            for uuid, hostname, project_id, address in instances])
+        print "%d instances, %d tenants, %d workers, batch %d%s" % (
+            options.instances, options.tenants, options.workers,
+            options.batch, ", PTR" if options.ptr else "")
+        stats.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of record representations: creation time and memory of
+DNSRecord, RecordTuple and the old __dict__ based record.
+
+    python benchmarks/records.py [count]
+"""
+
+import re
+import sys
+import time
+
+from nova_dns.dnsmanager import DNSRecord, RecordTuple, record_types
+
+
+class DictRecord:
+    """ DNSRecord before __slots__ and precompiled validators """
+    def __init__(self, name, type, content, priority=None, ttl=None):
+        self.name=DictRecord.normname(name)
+        self.type=DictRecord.normtype(type)
+        self.content=content
+        self.priority=int(priority) if priority else 0
+        self.ttl=int(ttl) if ttl else 7200
+    @staticmethod
+    def normtype(type):
+        t=str(type).upper()
+        if t not in record_types:
+            raise ValueError("Incorrect type: " + type)
+        return t
+    @staticmethod
+    def normname(n):
+        name = str(n).lower()
+        if name=="" or name=="*" or re.match(r'\A(?:[\w\d-]+\.)*(?:[\w\d-]+)\Z', name):
+            return name
+        else:
+            raise ValueError("Incorrect DNS name: " + name)
+
+
+def size(obj):
+    s = sys.getsizeof(obj)
+    if not hasattr(obj.__class__, '__slots__'):
+        s += sys.getsizeof(obj.__dict__)
+    return s
+
+
+def bench(cls, rows):
+    start = time.time()
+    records = [cls(name, 'A', content) for name, content in rows]
+    elapsed = time.time() - start
+    return elapsed, size(records[0])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = [("host-%d.tenant" % i, "10.%d.%d.%d" % (i >> 16 & 255,
+        i >> 8 & 255, i & 255)) for i in xrange(count)]
+    print "%d records" % count
+    print "%-12s %10s %12s %14s" % ("class", "seconds", "records/s", "bytes/record")
+    for cls in (DictRecord, DNSRecord, RecordTuple):
+        elapsed, bytes = bench(cls, rows)
+        print "%-12s %10.3f %12d %14d" % (cls.__name__, elapsed,
+            count / elapsed, bytes)
+
+
+if __name__ == '__main__':
+    main()
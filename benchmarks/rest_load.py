@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+WSGI load generator for dns.App, requests are passed to the application
+in-process by a pool of green threads. Zones and records are created,
+read, changed and deleted thru REST API, each kind of request is a phase
+measured separately. PowerDNS schema is on sqlite, --manager memory runs
+the same load against in-memory manager.
+
+    python benchmarks/rest_load.py [--zones N] [--records N]
+        [--concurrency N] [--manager powerdns|memory]
+"""
+
+import json
+import optparse
+import time
+
+import eventlet
+import webob
+
+import harness
+from nova_dns import dns
+
+MANAGERS = {
+    "powerdns": "nova_dns.dnsmanager.powerdns.Manager",
+    "memory": "nova_dns.dnsmanager.memory.Manager",
+}
+
+
+class LoadGenerator(object):
+    def __init__(self, app, stats, concurrency):
+        self.app = app
+        self.stats = stats
+        self.pool = eventlet.GreenPool(concurrency)
+        self.errors = {}
+        self.etags = {}
+
+    def run(self, op, requests):
+        """ send (method, path, headers, body) requests of one phase """
+        with self.stats.phase(op):
+            for request in requests:
+                self.pool.spawn_n(self.request, op, *request)
+            self.pool.waitall()
+
+    def request(self, op, method, path, headers=None, body=None):
+        req = webob.Request.blank(path)
+        req.method = method
+        req.headers.update(headers or {})
+        if body is not None:
+            req.body = json.dumps(body)
+        started = time.time()
+        res = req.get_response(self.app)
+        data = res.body
+        self.stats.add(op, time.time() - started)
+        if res.status_int == 304:
+            return
+        if "ETag" in res.headers:
+            self.etags[path] = res.headers["ETag"]
+        if res.status_int != 200 or (res.content_type == "application/json"
+                and json.loads(data)["error"]):
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--zones", type="int", default=10)
+    parser.add_option("--records", type="int", default=100,
+        help="records per zone")
+    parser.add_option("--concurrency", type="int", default=10)
+    parser.add_option("--manager", default="powerdns",
+        choices=MANAGERS.keys())
+    options, args = parser.parse_args()
+    with harness.Benchmark(MANAGERS[options.manager]) as benchmark:
+        stats = harness.Stats(benchmark)
+        load = LoadGenerator(dns.VersionFilter(dns.App()), stats,
+            options.concurrency)
+        zones = ["zone-%d.bench" % z for z in xrange(options.zones)]
+        records = [(zone, "host-%d" % i,
+                harness.address(10, z * options.records + i))
+            for z, zone in enumerate(zones)
+            for i in xrange(options.records)]
+        load.run("zone_add", [("PUT", "/zone/" + zone) for zone in zones])
+        load.run("record_add", [("PUT", "/record/%s/%s/A/%s" % r)
+            for r in records])
+        load.run("record_bulk", [("POST", "/record/%s/_bulk" % zone, None,
+                [{"action": "add", "name": "bulk-%d" % i, "type": "TXT",
+                    "content": "bulk"} for i in xrange(options.records)])
+            for zone in zones])
+        load.run("zone_get", [("GET", "/zone/" + zone) for zone in zones])
+        load.run("zone_get_not_modified", [("GET", "/zone/" + zone,
+            {"If-None-Match": load.etags["/zone/" + zone]})
+            for zone in zones])
+        load.run("list", [("GET", "/record/%s?limit=100" % zone)
+            for zone in zones])
+        load.run("record_by_ip", [("GET", "/record/getbyip/" + r[2])
+            for r in records])
+        load.run("record_edit", [("POST", "/record/%s/%s/A?content=%s" %
+                (zone, name, harness.address(11, i)))
+            for i, (zone, name, ip) in enumerate(records)])
+        load.run("record_del", [("DELETE", "/record/%s/%s/A" % r[:2])
+            for r in records])
+        load.run("zone_del", [("DELETE", "/zone/%s?force=1" % zone)
+            for zone in zones])
+        print "%d zones, %d records per zone, concurrency %d, %s manager" % (
+            options.zones, options.records, options.concurrency,
+            options.manager)
+        stats.report()
+        for op, count in sorted(load.errors.items()):
+            print "%s: %d errors" % (op, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,8 +21,11 @@
 AMQP listener
 """
 
+import calendar
+import datetime
 import time
 import socket
+import collections
 
 import eventlet
 import json
@@ -38,9 +41,41 @@ from nova.openstack.common import importutils
 from nova import flags
 from nova.openstack.common import log as logging
 from nova.openstack.common.rpc import impl_kombu
+from nova_dns import metrics
 
 LOG = logging.getLogger("nova_dns.listener")
+
+nova_dns_amqp_opts = [
+    flags.cfg.IntOpt("dns_amqp_workers",
+                     default=1,
+                     help="Number of messages processed in parallel"),
+    flags.cfg.IntOpt("dns_amqp_batch_size",
+                     default=0,
+                     help="Pass up to this number of messages to listener at "
+                          "once and ack them together, 0 to disable"),
+    flags.cfg.IntOpt("dns_amqp_batch_timeout",
+                     default=100,
+                     help="Milliseconds to wait for a batch to fill"),
+]
+
 FLAGS = flags.FLAGS
+FLAGS.register_opts(nova_dns_amqp_opts)
+
+#message arguments to partition by if message has no project, first found
+#is used. Messages with the same value are processed in order
+PARTITION_KEYS = ("instance_uuid", "floating_address", "address",
+    "fixed_address", "instance_id")
+
+MESSAGES = metrics.counter("nova_dns_amqp_messages_total",
+    "Messages processed by listener", ("method",))
+FAILED = metrics.counter("nova_dns_amqp_failed_total",
+    "Messages listener failed to handle", ("method",))
+MESSAGE_SECONDS = metrics.histogram("nova_dns_amqp_message_seconds",
+    "Time listener spent on a message", ("method",))
+BATCH_SECONDS = metrics.histogram("nova_dns_amqp_batch_seconds",
+    "Time listener spent on a batch of messages")
+LAG_SECONDS = metrics.histogram("nova_dns_amqp_lag_seconds",
+    "Time from message was sent by nova till it was processed")
 
 class Service(object):
     """
@@ -54,8 +89,17 @@ class Service(object):
                           virtual_host=FLAGS.rabbit_virtual_host)
         self.connection = None
         self.eventlet = None
+        self.pool = eventlet.GreenPool(FLAGS.dns_amqp_workers)
+        #partition key => messages waiting for worker of this partition
+        self.partitions = {}
+        self.batch = []
+        self.batch_started = None
         listener_class = importutils.import_class(FLAGS.dns_listener);
         self.listener = listener_class()
+        self.metrics_thread = None
+        metrics.gauge("nova_dns_amqp_partitions",
+            "Instances and addresses with messages in process",
+            fn=lambda: len(self.partitions))
 
     def reconnect(self):
         if self.connection:
@@ -66,6 +110,8 @@ class Service(object):
             time.sleep(1)
 
         self.connection = kombu.connection.BrokerConnection(**self.params)
+        #not acked messages are redelivered to a new channel
+        self.batch = []
 
         options = {
             "durable": FLAGS.rabbit_durable_queues,
@@ -95,17 +141,115 @@ class Service(object):
         LOG.debug("created kombu connection: %s" % self.params)
 
     def process_message(self, body, message):
+        """
+        Dispatch message to worker pool. Messages of one partition (see
+        ``partition``) are handled by one worker in order of arrival
+        """
+        key = self.partition(body)
+        if key in self.partitions:
+            self.partitions[key].append((body, message))
+            return
+        self.partitions[key] = collections.deque([(body, message)])
+        # blocks while all workers are busy
+        self.pool.spawn_n(self.process_partition, key)
+
+    def process_partition(self, key):
+        queue = self.partitions[key]
+        try:
+            while queue:
+                body, message = queue.popleft()
+                method = body.get("method", "<unknown>")
+                try:
+                    self.process_event(body, message)
+                except KeyError, ex:
+                    FAILED.inc(method=method)
+                    LOG.exception("cannot handle message")
+                except Exception, ex:
+                    FAILED.inc(method=method)
+                    LOG.exception("failed to handle message")
+                MESSAGES.inc(method=method)
+                message.ack()
+        finally:
+            del self.partitions[key]
+
+    def partition(self, body):
+        """
+        Return project of the message, key of instance (or address) the
+        message is about if there is no project. Instances of a project
+        share its zone, so terminate of one instance and run of another
+        reusing its hostname are processed in order. Messages without
+        project (like ``lease_fixed_ip``) can still be reordered with
+        them, listener must not rely on their order
+        """
+        if body.get("_context_project_id"):
+            return body["_context_project_id"]
+        args = body.get("args") or {}
+        for k in PARTITION_KEYS:
+            if args.get(k):
+                return args[k]
+        return None
+
+    def collect_message(self, body, message):
+        """
+        Batching mode callback: collect message, process batch when full
+        """
+        if not self.batch:
+            self.batch_started = time.time()
+        self.batch.append((body, message))
+        if len(self.batch) >= FLAGS.dns_amqp_batch_size:
+            self.process_batch()
+
+    def process_batch(self):
+        """
+        Pass collected messages to listener at once. Failed messages are
+        requeued once (rejected if they were redelivered already), the
+        rest are acked with one ``basic.ack`` after they were processed
+        """
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
         try:
-            self.process_event(body, message)
-        except KeyError, ex:
-            LOG.exception("cannot handle message")
-        message.ack()
+            with BATCH_SECONDS.time():
+                errors = self.listener.events([body for body, message in batch])
+        except Exception, ex:
+            #listener can't tell which messages were handled
+            LOG.exception("failed to handle batch")
+            errors = [ex] * len(batch)
+        last_acked = None
+        for (body, message), error in zip(batch, errors):
+            method = body.get("method", "<unknown>")
+            MESSAGES.inc(method=method)
+            if error is None:
+                observe_lag(body)
+                last_acked = message.delivery_tag
+                continue
+            FAILED.inc(method=method)
+            requeue = not message.delivery_info.get("redelivered")
+            LOG.warn("message %s failed: %s, %s" % (method, error,
+                "requeued" if requeue else "rejected"))
+            self.channel.basic_reject(message.delivery_tag, requeue)
+        LOG.debug("processed batch of %d messages" % len(batch))
+        if last_acked is not None:
+            #rejected messages aren't covered by multiple ack
+            self.channel.basic_ack(last_acked, multiple=True)
+
+    def batch_timeout(self):
+        """
+        Seconds left till collected batch has to be processed, None if
+        there is nothing to wait for
+        """
+        if not self.batch:
+            return None
+        return max(0, self.batch_started +
+            FLAGS.dns_amqp_batch_timeout / 1000.0 - time.time())
 
     def process_event(self, body, message):
         """
         This function receive ``body`` and pass it to listener manager
         """
-        self.listener.event(body)
+        with MESSAGE_SECONDS.time(method=body.get("method", "<unknown>")):
+            self.listener.event(body)
+        observe_lag(body)
 
         try:
             routing_key = message.delivery_info["routing_key"]
@@ -120,12 +264,22 @@ class Service(object):
         while True:
             try:
                 self.reconnect()
+                if FLAGS.dns_amqp_batch_size > 0:
+                    callback = self.collect_message
+                else:
+                    callback = self.process_message
                 with kombu.messaging.Consumer(
                     channel=self.channel,
                     queues=[self.queue,self.network_queue],
-                    callbacks=[self.process_message]) as consumer:
+                    callbacks=[callback]) as consumer:
+                    consumer.qos(prefetch_count=max(FLAGS.dns_amqp_workers,
+                        FLAGS.dns_amqp_batch_size))
                     while True:
-                        self.connection.drain_events()
+                        try:
+                            self.connection.drain_events(
+                                timeout=self.batch_timeout())
+                        except socket.timeout:
+                            self.process_batch()
             except socket.error:
                 pass
             except Exception, e:
@@ -134,9 +288,38 @@ class Service(object):
 
     def start(self):
         self.eventlet = eventlet.spawn(self.consume)
+        if FLAGS.dns_metrics_port:
+            self.metrics_thread = eventlet.spawn(metrics.serve,
+                FLAGS.dns_metrics_listen, FLAGS.dns_metrics_port)
 
     def stop(self):
         self.eventlet.stop()
+        if self.metrics_thread:
+            self.metrics_thread.kill()
 
     def wait(self):
         self.eventlet.wait()
+
+
+def observe_lag(body):
+    """
+    Observe time since nova sent the message, by its context timestamp
+    """
+    sent = message_time(body)
+    if sent is not None:
+        LAG_SECONDS.observe(max(0, time.time() - sent))
+
+
+def message_time(body):
+    """
+    Return unix time of ``_context_timestamp`` of message (UTC, isoformat)
+    or None
+    """
+    try:
+        sent = datetime.datetime.strptime(
+            body["_context_timestamp"].split(".")[0], "%Y-%m-%dT%H:%M:%S")
+    except (KeyError, ValueError, AttributeError):
+        return None
+    fraction = body["_context_timestamp"].partition(".")[2]
+    return calendar.timegm(sent.utctimetuple()) + \
+        (float("0." + fraction) if fraction.isdigit() else 0)
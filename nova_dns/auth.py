@@ -22,11 +22,20 @@ Authorization
 """
 
 
+import time
 import ConfigParser
 
+import eventlet
+
 from nova import flags
+from nova.openstack.common import log as logging
+from keystoneclient import exceptions as keystone_exceptions
 from keystoneclient.v2_0 import client as keystone_client
 from dnsmanager import DNSRecord
+from nova_dns import metrics
+from nova_dns.cache import LRUCache
+
+LOG = logging.getLogger("nova_dns.auth")
 
 #flags.DEFINE_enum("dns_auth", "keystone", ["none", "keystone"],     
 #                    "Auth mode in REST API")
@@ -46,7 +55,19 @@ nova_dns_auth_opts = [
                      help="Role name in REST API"),
     flags.cfg.StrOpt("dns_zone", 
                      default="localzone", 
-                     help="Nova DNS base zone")
+                     help="Nova DNS base zone"),
+    flags.cfg.IntOpt("dns_tenant_cache_size",
+                     default=10000,
+                     help="Max number of cached tenant names"),
+    flags.cfg.IntOpt("dns_tenant_cache_ttl",
+                     default=600,
+                     help="Seconds before cached tenant name is refreshed"),
+    flags.cfg.IntOpt("dns_tenant_cache_negative_ttl",
+                     default=60,
+                     help="Seconds to remember unknown tenant ids"),
+    flags.cfg.IntOpt("dns_auth_cache_size",
+                     default=10000,
+                     help="Max number of cached authorization decisions")
 ]
 
 FLAGS = flags.FLAGS
@@ -74,13 +95,49 @@ class KeystoneAuth(NoAuth):
             password=self.password,
             tenant_name=self.tenant,
             auth_url=self.url)
-        self.tenants = {}
+        #tenant id => name, None for unknown tenants
+        self.tenants = LRUCache(FLAGS.dns_tenant_cache_size,
+            FLAGS.dns_tenant_cache_ttl)
+        self.refreshing = set()
+        #(roles header, tenant id, zone name) => decision, expires with
+        #tenant names it was made with
+        self.decisions = LRUCache(FLAGS.dns_auth_cache_size,
+            FLAGS.dns_tenant_cache_ttl)
+        #can() calls, decisions taken from cache, seconds spent
+        self.stats = {"calls": 0, "hits": 0, "time": 0.0}
+        metrics.counter("nova_dns_auth_calls_total",
+            "Authorization checks", fn=lambda: self.stats["calls"])
+        metrics.counter("nova_dns_auth_cache_hits_total",
+            "Authorization checks answered from cache",
+            fn=lambda: self.stats["hits"])
+        metrics.counter("nova_dns_auth_seconds_total",
+            "Time spent in authorization checks",
+            fn=lambda: self.stats["time"])
 
     def tenant2zonename(self, project_id):
         #project_id is a really project_id :)
         return super(KeystoneAuth, self).tenant2zonename(self._get_tenant(project_id))
     
     def can(self, req, zone_name): 
+        start = time.time()
+        key = (req.headers.get('X_ROLE', ''), req.headers.get('X_TENANT_ID'),
+            zone_name)
+        decision = self.decisions.get(key)
+        hit = decision is not None
+        try:
+            if not hit:
+                decision = self._can(req, zone_name)
+                self.decisions.set(key, decision)
+        finally:
+            elapsed = time.time() - start
+            self.stats["calls"] += 1
+            self.stats["hits"] += hit
+            self.stats["time"] += elapsed
+            LOG.debug("can(%s) took %.3f ms, cached: %s" %
+                (zone_name, elapsed * 1000, hit))
+        return dict(decision)
+
+    def _can(self, req, zone_name):
         roles = [r.strip()
                  for r in req.headers.get('X_ROLE', '').split(',')]
         if "Admin" in roles:
@@ -94,16 +151,33 @@ class KeystoneAuth(NoAuth):
 
 
     def _get_tenant(self, id):
-        if not self.tenants.has_key(id):
-            #probably new tenant, let's re-read cache
-            self.tenants={}
-            for t in self.client.tenants.list():
-                self.tenants[t.id] = t.name
-        name = self.tenants.get(id, None)
+        found, name, expired = self.tenants.lookup(id)
+        if not found or (expired and not name):
+            name = self._fetch_tenant(id)
+        elif expired and id not in self.refreshing:
+            #serve stale name, refresh in background
+            self.refreshing.add(id)
+            eventlet.spawn_n(self._refresh_tenant, id)
         if not name:
-            #nope, not new
             raise ValueError('Unknown tenant_id: %s' % (str(id)))
         return name
 
+    def _fetch_tenant(self, id):
+        try:
+            name = self.client.tenants.get(id).name
+        except keystone_exceptions.NotFound:
+            name = None
+        self.tenants.set(id, name, None if name else
+            FLAGS.dns_tenant_cache_negative_ttl)
+        return name
+
+    def _refresh_tenant(self, id):
+        try:
+            self._fetch_tenant(id)
+        except Exception:
+            LOG.exception("Failed to refresh tenant %s" % (id))
+        finally:
+            self.refreshing.discard(id)
+
 AUTH = NoAuth() if FLAGS.dns_auth == 'none' else KeystoneAuth()
 
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Small in-process caches
+"""
+
+import time
+import collections
+
+
+class LRUCache(object):
+    """
+    Mapping of limited size with per-entry expiry time. When full, least
+    recently used entry is evicted. Size 0 (or less) disables the cache.
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.data = collections.OrderedDict()
+
+    def lookup(self, key):
+        """
+        Return (found, value, expired). Expired entries are kept till
+        replaced or evicted, so caller can use stale value while refreshing
+        """
+        try:
+            expires, value = self.data.pop(key)
+        except KeyError:
+            return False, None, False
+        self.data[key] = (expires, value)
+        return True, value, expires < time.time()
+
+    def get(self, key, default=None):
+        found, value, expired = self.lookup(key)
+        if not found or expired:
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.data.pop(key, None)
+        if self.size <= 0:
+            return
+        while len(self.data) >= self.size:
+            self.data.popitem(last=False)
+        self.data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, (None, default))[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
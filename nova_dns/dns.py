@@ -21,8 +21,11 @@
 DNS rest service
 """
 
+import calendar
+import email.utils
 import eventlet
 import json
+import time
 
 from nova import flags
 from nova.openstack.common import log as logging
@@ -36,7 +39,8 @@ import routes.middleware
 from nova import wsgi
 from nova import service
 from nova_dns import __version__
-from nova_dns.dnsmanager import DNSRecord, DNSSOARecord
+from nova_dns import metrics
+from nova_dns.dnsmanager import DNSRecord, DNSSOARecord, RecordTuple
 from nova_dns.auth import AUTH
 
 LOG = logging.getLogger("nova_dns.dns")
@@ -54,6 +58,13 @@ nova_dns_opts = [
 FLAGS = flags.FLAGS
 FLAGS.register_opts(nova_dns_opts)
 
+REQUESTS = metrics.counter("nova_dns_api_requests_total",
+    "REST requests by action and result (ok, error or not_modified)",
+    ("action", "result"))
+REQUEST_SECONDS = metrics.histogram("nova_dns_api_request_seconds",
+    "Time to handle REST request, streamed body is not included",
+    ("action",))
+
 class Service(service.WSGIService):
     """
     """
@@ -93,20 +104,53 @@ class VersionFilter(object):
         return filter
 
 
+class ReleasingIter(object):
+    """
+    Response body releasing manager on close() - WSGI server calls it
+    when response is sent or client is gone, even if body wasn't read
+    """
+    def __init__(self, body, manager):
+        self.body=body
+        self.manager=manager
+
+    def __iter__(self):
+        return self.body
+
+    def close(self):
+        try:
+            self.body.close()
+        finally:
+            self.manager.release()
+
+
 class Controller(object):
     """
     WSGI application that reads routing information supplied by ``RoutesMiddleware``
-    and returns a report.
+    and returns a report. One instance is shared by all routes, manager is
+    created on first request.
     """
 
     def __init__(self):
-        manager_class=importutils.import_class(FLAGS.dns_manager);
-        self.manager=manager_class()
+        self._manager=None
+
+    @property
+    def manager(self):
+        if self._manager is None:
+            manager_class=importutils.import_class(FLAGS.dns_manager)
+            self._manager=manager_class()
+        return self._manager
 
     @webob.dec.wsgify
     def __call__(self, req):
         """
         """
+        #streamed response releases manager when server closes it
+        streaming=False
+        #ETag and Last-Modified of zone
+        headers={}
+        started=time.time()
+        action="<unknown>"
+        result_label="ok"
         try:
             args = req.environ["wsgiorg.routing_args"][1]
             action = args["action"]
@@ -125,7 +169,12 @@ class Controller(object):
             if action=="index":
                 result=self.manager.list()
             elif action=="zone_get":
-                result=self.manager.get(args['zonename']).get_soa().__dict__
+                soa=self.manager.get(args['zonename']).get_soa()
+                headers=self.version(soa.serial)
+                if self.not_modified(req, soa.serial):
+                    result_label="not_modified"
+                    return webob.Response(status=304, headers=headers)
+                result=soa.to_dict()
             elif action=="zone_del":
                 result=self.manager.drop(args['zonename'], req.GET.get('force', None))
             elif action=="zone_add":
@@ -138,8 +187,22 @@ class Controller(object):
                 name=req.GET.get('name', None)
                 name="" if name=='@' else name
                 type=req.GET.get('type', None)
-                records=self.manager.get(args['zonename']).get(name=name, type=type)
-                result=[r.__dict__ for r in records] 
+                limit=req.GET.get('limit', None)
+                zone=self.manager.get(args['zonename'])
+                serial=zone.get_serial()
+                headers=self.version(serial)
+                if self.not_modified(req, serial):
+                    result_label="not_modified"
+                    return webob.Response(status=304, headers=headers)
+                records=zone.iter_records(
+                    name=name, type=type, limit=limit,
+                    marker=req.GET.get('marker', None))
+                app_iter=self.stream(records, limit)
+                streaming=True
+                res=webob.Response(app_iter=app_iter,
+                    content_type='application/json')
+                res.headers.update(headers)
+                return res
 	    elif action=="record_by_ip":
 		result=self.manager.get_by_ip(args['ip'])
 		result=str(result)
@@ -154,6 +217,9 @@ class Controller(object):
             elif action=="record_del":
                 name="" if args['name']=='@' else args['name']
                 result=self.manager.get(args['zonename']).delete(name, args['type'])
+            elif action=="record_bulk":
+                result=self.bulk(self.manager.get(args['zonename']),
+                    json.loads(req.body))
             elif action=="record_edit":
                 name="" if args['name']=='@' else args['name']
                 result=self.manager.get(args['zonename']).set(
@@ -166,14 +232,101 @@ class Controller(object):
             else:
                 raise Exception("Incorrect action: "+action)
 	    if action!="record_by_ip":
-                return webob.Response(json.dumps({"result":result, "error":None}),
+                res=webob.Response(json.dumps({"result":result, "error":None}),
                     content_type='application/json')
+                res.headers.update(headers)
+                return res
 	    else:
 		return webob.Response(result, 
 		    content_type='text/html')
         except Exception as e:
+            result_label="error"
             return webob.Response(json.dumps({"result":None, "error":str(e)}),
                 content_type='application/json')
+        finally:
+            if self._manager is not None and not streaming:
+                self._manager.release()
+            REQUESTS.inc(action=action, result=result_label)
+            REQUEST_SECONDS.observe(time.time()-started, action=action)
+
+    def version(self, serial):
+        """ ETag and Last-Modified headers for zone with SOA serial. Serials
+        set by backend are timestamps, others (like YYYYMMDDnn) are only
+        used as ETag """
+        headers={}
+        if serial is None:
+            return headers
+        headers["ETag"]='"%s"' % serial
+        if str(serial).isdigit() and int(serial)<=time.time():
+            headers["Last-Modified"]=email.utils.formatdate(int(serial),
+                usegmt=True)
+        return headers
+
+    def not_modified(self, req, serial):
+        """ True if client has the zone version already """
+        if serial is None:
+            return False
+        if "If-None-Match" in req.headers:
+            return str(serial) in req.if_none_match
+        if req.if_modified_since and str(serial).isdigit():
+            return int(serial)<=calendar.timegm(
+                req.if_modified_since.utctimetuple())
+        return False
+
+    def stream(self, records, limit=None):
+        """ JSON response body for iterator of (marker, record), chunk per
+        record. Query runs here, so its errors are reported as usual.
+        "next_marker" is added if page of limit records is full """
+        first=next(records, None)
+        def body():
+            yield '{"result": ['
+            count=0
+            marker=None
+            item=first
+            while item is not None:
+                marker, record=item
+                yield (", " if count else "") + json.dumps(record)
+                count+=1
+                item=next(records, None)
+            yield '], "error": null'
+            if limit and count>=int(limit):
+                yield ', "next_marker": ' + json.dumps(marker)
+            yield '}'
+        return ReleasingIter(body(), self.manager)
+
+    def bulk(self, zone, items):
+        """ convert list of REST operations to zone changeset and apply it
+        in one go. Return per-item results """
+        if not isinstance(items, list):
+            raise Exception("List of operations expected")
+        results=[None]*len(items)
+        changes=[]
+        positions=[]
+        for i, item in enumerate(items):
+            try:
+                op=item.get("action")
+                name="" if item.get("name")=='@' else item.get("name")
+                if op=="add":
+                    change=("add", RecordTuple(name=name,
+                        content=item.get("content"), type=item.get("type"),
+                        ttl=item.get("ttl", None),
+                        priority=item.get("priority", None)))
+                elif op=="edit":
+                    change=("set", name, item.get("type"),
+                        item.get("content", None), item.get("priority", None),
+                        item.get("ttl", None))
+                elif op=="delete":
+                    change=("delete", name, item.get("type"))
+                else:
+                    raise Exception("Incorrect action: "+str(op))
+            except Exception as e:
+                results[i]={"result":None, "error":str(e)}
+                continue
+            changes.append(change)
+            positions.append(i)
+        for i, result in zip(positions, zone.apply(changes) if changes else []):
+            results[i]=result
+        return results
 
 class App(wsgi.Router):
     """
@@ -187,7 +340,9 @@ class App(wsgi.Router):
         GET /zone
             return list of all zones
         GET /zone/name
-            return JSON for SOA if zone exists
+            return JSON for SOA if zone exists. This and GET /record/zonename
+                return ETag/Last-Modified from SOA serial and 304 for
+                If-None-Match/If-Modified-Since with current serial
         PUT /zone/name[?soa_params]
             create new zone. if no params for SOA provided, backend
             _has_to_ use reasonable defaults. Return 'ok' on success
@@ -197,39 +352,46 @@ class App(wsgi.Router):
             if not - will refuse to delete if there are any sub-zone for
                 this zone
             return "ok" on success
-        GET /record/zonename[?name=&type=]
+        GET /record/zonename[?name=&type=&limit=&marker=]
             return JSON (array of objects). Will return 'err' if zone or
-                or (name, type) not exists
+                or (name, type) not exists. If page of "limit" records is
+                full, "next_marker" to pass as "marker" for next page is
+                returned too
         PUT /record/zonename/name/type/content[?ttl&priority]
             add record. return 'ok' on success. set name to '@' if empty
         POST /record/zonename/name/type?[params]
             return 'ok' on success, 'err' if zonename or (name, type) not exists
         DELETE /record/zonename/name/type
+        POST /record/zonename/_bulk
+            apply JSON array of operations {"action": "add"|"edit"|"delete",
+                "name", "type", "content", "ttl", "priority"} in one go.
+                return result for every operation
         """
-        #FIXME rewrite dict(controller=Controller(), action="...") to
-        #controller=Controller
-        #....controller=conntroller.index
+        controller = Controller()
         map = routes.Mapper()
         map.connect(None, "/zone/",
-            controller=Controller(), action="index")
+            controller=controller, action="index")
         map.connect(None, "/zone/{zonename}", conditions=dict(method=["GET"]),
-            controller=Controller(), action="zone_get")
+            controller=controller, action="zone_get")
         map.connect(None, "/zone/{zonename}", conditions=dict(method=["PUT"]),
-            controller=Controller(), action="zone_add")
+            controller=controller, action="zone_add")
         map.connect(None, "/zone/{zonename}", conditions=dict(method=["DELETE"]),
-            controller=Controller(), action="zone_del")
+            controller=controller, action="zone_del")
 	map.connect(None, "/record/getbyip/{ip}", conditions=dict(method=["GET"]),
-	    controller=Controller(), action="record_by_ip")
+	    controller=controller, action="record_by_ip")
         map.connect(None, "/record/{zonename}", conditions=dict(method=["GET"]),
-            controller=Controller(), action="list")
+            controller=controller, action="list")
+        map.connect(None, "/record/{zonename}/_bulk",
+            conditions=dict(method=["POST"]), controller=controller,
+            action="record_bulk")
         map.connect(None, "/record/{zonename}/{name}/{type}/{content}",
-            conditions=dict(method=["PUT"]), controller=Controller(),
+            conditions=dict(method=["PUT"]), controller=controller,
             action="record_add")
         map.connect(None, "/record/{zonename}/{name}/{type}",
-            conditions=dict(method=["POST"]), controller=Controller(),
+            conditions=dict(method=["POST"]), controller=controller,
             action="record_edit")
         map.connect(None, "/record/{zonename}/{name}/{type}",
-            conditions=dict(method=["DELETE"]), controller=Controller(),
+            conditions=dict(method=["DELETE"]), controller=controller,
             action="record_del")
         super(App, self).__init__(map)
 
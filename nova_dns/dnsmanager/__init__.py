@@ -18,6 +18,7 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+from collections import namedtuple
 
 from nova import flags
 from nova.openstack.common import log as logging
@@ -51,6 +52,11 @@ record_types=set(('A', 'AAAA', 'MX', 'SOA', 'CNAME', 'PTR', 'SPF', 'SRV', 'TXT',
           'AFSDB', 'CERT', 'DNSKEY', 'DS', 'HINFO', 'KEY', 'LOC', 'NAPTR', 'RP', 'RRSIG',
           'SSHFP'))
 
+#type in any case => type in upper case, for valid types only
+_types=dict([(t, t) for t in record_types] +
+    [(t.lower(), t) for t in record_types])
+_name_re=re.compile(r'\A(?:[\w\d-]+\.)*(?:[\w\d-]+)\Z')
+
 FLAGS = flags.FLAGS
 FLAGS.register_opts(nova_dns_dnsmanager_opts)
 
@@ -97,6 +103,11 @@ class DNSManager:
          """
         pass
 
+    def release(self):
+        """ called after each REST request, should return resources
+        (like db connections) held by the manager """
+        pass
+
 
 
 class DNSZone:
@@ -121,29 +132,93 @@ class DNSZone:
     @abstractmethod
     def delete(self, name, type):
         pass
-
-class DNSRecord:
+    def add_many(self, records):
+        """ add list of DNSRecord (or RecordTuple) objects """
+        for v in records:
+            self.add(v)
+        return "ok"
+    def apply(self, changes):
+        """ apply list of changes, each is a tuple with method name and
+        its arguments:
+            ("add", DNSRecord or RecordTuple)
+            ("set", name, type, content, priority, ttl)
+            ("delete", name, type)
+        return list of {"result":..., "error":...} for every change.
+        Backends should override this to apply changes in one transaction
+        """
+        results=[]
+        for change in changes:
+            try:
+                if change[0] not in ("add", "set", "delete"):
+                    raise ValueError("Incorrect action: " + str(change[0]))
+                result=getattr(self, change[0])(*change[1:])
+                results.append({"result":result, "error":None})
+            except Exception as e:
+                results.append({"result":None, "error":str(e)})
+        return results
+    def iter_names(self, type):
+        """ yield (name, content) for records of type, ordered by name.
+        Backends should override this to stream records from storage """
+        for r in sorted(self.get(type=type), key=lambda r: r.name):
+            yield r.name, r.content
+    def get_serial(self):
+        """ return SOA serial, it is changed on every change of the zone
+        and used as its version. None if backend doesn't track it or zone
+        has no SOA record """
+        return None
+    def iter_records(self, name=None, type=None, limit=None, marker=None):
+        """ yield (marker, record dict) for records after marker, at most
+        limit of them. Backends should override this to stream records
+        from storage, here marker is a position in get() result """
+        start=int(marker)+1 if marker is not None else 0
+        records=self.get(name, type)[start:]
+        if limit:
+            records=records[:int(limit)]
+        for i, r in enumerate(records):
+            yield start+i, r.to_dict()
+
+class DNSRecord(object):
+    __slots__=('name', 'type', 'content', 'priority', 'ttl')
+    #attributes of to_dict()
+    fields=__slots__
     def __init__(self, name, type, content, priority=None, ttl=None):
         self.name=DNSRecord.normname(name)
         self.type=DNSRecord.normtype(type)
         self.content=content
         self.priority=int(priority) if priority else 0
         self.ttl=int(ttl) if ttl else FLAGS.dns_default_ttl
+    def to_dict(self):
+        return dict((f, getattr(self, f)) for f in self.fields)
     @staticmethod
     def normtype(type):
-        t=str(type).upper()
-        if t not in record_types:
-            raise ValueError("Incorrect type: " + type)
+        t=_types.get(type)
+        if t is None:
+            t=str(type).upper()
+            if t not in record_types:
+                raise ValueError("Incorrect type: " + str(type))
         return t
     @staticmethod
     def normname(n):
         name = str(n).lower()
-        if name=="" or name=="*" or re.match(r'\A(?:[\w\d-]+\.)*(?:[\w\d-]+)\Z', name):
+        if name=="" or name=="*" or _name_re.match(name):
             return name
         else:
             raise ValueError("Incorrect DNS name: " + name)
 
+class RecordTuple(namedtuple("RecordTuple", DNSRecord.fields)):
+    """ DNSRecord as a tuple, for bulk paths. Constructor validates as
+    DNSRecord does, RecordTuple._make() takes already valid rows """
+    __slots__=()
+    def __new__(cls, name, type, content, priority=None, ttl=None):
+        return tuple.__new__(cls, (DNSRecord.normname(name),
+            DNSRecord.normtype(type), content, int(priority) if priority else 0,
+            int(ttl) if ttl else FLAGS.dns_default_ttl))
+    def to_dict(self):
+        return dict(zip(self._fields, self))
+
 class DNSSOARecord(DNSRecord):
+    __slots__=('primary', 'hostmaster', 'serial', 'refresh', 'retry', 'expire')
+    fields=DNSRecord.fields+__slots__
     def __init__(self, primary=None, hostmaster=None, serial=None, refresh=None, retry=None, expire=None, ttl=None):
         self.primary=primary if primary else FLAGS.dns_soa_primary
         self.hostmaster=hostmaster if hostmaster else FLAGS.dns_soa_email
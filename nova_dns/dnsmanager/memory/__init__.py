@@ -0,0 +1,384 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory DNS manager, for tests, benchmarks and CI. Zones of the process
+are kept in one store guarded by a lock, records are indexed by name,
+type and IP. Semantics follow powerdns.Manager: records are stored with
+full names, SOA serial grows on every changeset.
+
+If dns_memory_snapshot is set, zones are loaded from this file on start
+and written back to it after each unit of work (on release()).
+"""
+
+import collections
+import itertools
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+from nova import flags
+from nova.openstack.common import log as logging
+from nova_dns.dnsmanager import DNSManager, DNSZone, DNSRecord, \
+    DNSSOARecord, RecordTuple
+
+LOG = logging.getLogger("nova_dns.dnsmanager.memory")
+
+memory_nova_dns_dnsmanager_opts = [
+    flags.cfg.StrOpt("dns_memory_snapshot",
+                     default="",
+                     help="File to keep zones of in-memory manager, "
+                          "empty - don't save them"),
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(memory_nova_dns_dnsmanager_opts)
+
+_STORE = None
+
+
+class Zone(object):
+    """ records of one zone with name and type indexes """
+    def __init__(self, soa):
+        #id => RecordTuple with full name, or DNSSOARecord
+        self.records=collections.OrderedDict()
+        #full name => [ids]
+        self.names={}
+        #type => set of ids
+        self.types={}
+        self.soa_id=None
+        self.soa=soa
+
+
+class Store(object):
+    def __init__(self, snapshot=None):
+        self.lock=threading.RLock()
+        self.zones={}
+        #ip => set of (zone name, id) of A and AAAA records
+        self.ips={}
+        self.ids=itertools.count(1)
+        self.snapshot=snapshot
+        self.dirty=False
+        if snapshot and os.path.isfile(snapshot):
+            self.load(snapshot)
+
+    def add_zone(self, zone_name, soa):
+        zone=self.zones[zone_name]=Zone(soa)
+        zone.soa_id=self.insert(zone_name, soa, zone_name)
+        return zone
+
+    def drop_zone(self, zone_name):
+        zone=self.zones.pop(zone_name)
+        for id, rec in zone.records.items():
+            self.unindex_ip(zone_name, id, rec)
+        self.dirty=True
+
+    def insert(self, zone_name, rec, name=None):
+        """ add record, name is the full name if rec has relative one.
+        (name, type) is unique, as in powerdns database """
+        zone=self.zones[zone_name]
+        if name is not None and rec.type!='SOA':
+            rec=RecordTuple._make((name, rec.type, rec.content, rec.priority,
+                rec.ttl))
+        key=name if name is not None else rec.name
+        if [id for id in zone.names.get(key, ())
+                if zone.records[id].type==rec.type]:
+            raise Exception("Record (%s, %s) already exists" % (key, rec.type))
+        id=self.ids.next()
+        zone.records[id]=rec
+        zone.names.setdefault(key, []).append(id)
+        zone.types.setdefault(rec.type, set()).add(id)
+        if rec.type in ('A', 'AAAA'):
+            self.ips.setdefault(rec.content, set()).add((zone_name, id))
+        self.dirty=True
+        return id
+
+    def replace(self, zone_name, id, rec):
+        """ change record in place, its name and type are kept """
+        zone=self.zones[zone_name]
+        self.unindex_ip(zone_name, id, zone.records[id])
+        zone.records[id]=rec
+        if rec.type in ('A', 'AAAA'):
+            self.ips.setdefault(rec.content, set()).add((zone_name, id))
+        self.dirty=True
+
+    def remove(self, zone_name, id):
+        zone=self.zones[zone_name]
+        rec=zone.records.pop(id)
+        name=zone_name if rec.type=='SOA' else rec.name
+        zone.names[name].remove(id)
+        if not zone.names[name]:
+            del zone.names[name]
+        zone.types[rec.type].discard(id)
+        self.unindex_ip(zone_name, id, rec)
+        self.dirty=True
+
+    def unindex_ip(self, zone_name, id, rec):
+        if rec.type in ('A', 'AAAA'):
+            ids=self.ips.get(rec.content)
+            if ids is not None:
+                ids.discard((zone_name, id))
+                if not ids:
+                    del self.ips[rec.content]
+
+    def bump_serial(self, zone_name):
+        """ serial has to grow even for changes within the same second """
+        zone=self.zones[zone_name]
+        soa=zone.soa
+        zone.soa=DNSSOARecord(soa.primary, soa.hostmaster,
+            max(int(time.time()), int(soa.serial)+1), soa.refresh, soa.retry,
+            soa.expire, soa.ttl)
+        zone.records[zone.soa_id]=zone.soa
+        self.dirty=True
+
+    def dump(self):
+        zones={}
+        for zone_name, zone in self.zones.items():
+            soa=zone.soa
+            zones[zone_name]={
+                "soa": [soa.primary, soa.hostmaster, soa.serial, soa.refresh,
+                    soa.retry, soa.expire, soa.ttl],
+                "records": [list(rec) for rec in zone.records.values()
+                    if rec.type!='SOA']}
+        return zones
+
+    def load(self, path):
+        with open(path) as f:
+            zones=json.load(f)
+        for zone_name, data in zones.items():
+            zone_name=str(zone_name)
+            self.add_zone(zone_name, DNSSOARecord(*data["soa"]))
+            for rec in data["records"]:
+                self.insert(zone_name, RecordTuple(*rec))
+        self.dirty=False
+        LOG.info("%d zones were loaded from %s" % (len(zones), path))
+
+    def save(self):
+        """ write snapshot if store was changed since last save """
+        with self.lock:
+            if not self.snapshot or not self.dirty:
+                return
+            data=json.dumps(self.dump())
+            self.dirty=False
+        fd, tmp=tempfile.mkstemp(dir=os.path.dirname(
+            os.path.abspath(self.snapshot)), prefix=".tmp")
+        try:
+            f=os.fdopen(fd, "w")
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmp, self.snapshot)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+
+def get_store():
+    """Return process-wide store."""
+    global _STORE
+    if _STORE is None:
+        _STORE = Store(FLAGS.dns_memory_snapshot)
+    return _STORE
+
+
+class Manager(DNSManager):
+    def __init__(self):
+        self.store=get_store()
+    def list(self):
+        with self.store.lock:
+            return self.store.zones.keys()
+    def add(self, zone_name, soa={}):
+        zone_name=DNSRecord.normname(zone_name)
+        soa=DNSSOARecord(**soa)
+        with self.store.lock:
+            if zone_name in self.store.zones:
+                raise Exception('Zone already exists')
+            self.store.add_zone(zone_name, soa)
+        LOG.info("[%s]: Zone was added" % (zone_name))
+        return "ok"
+    def drop(self, zone_name, force=False):
+        with self.store.lock:
+            zones=[z for z in self.store.zones
+                if z==zone_name or z.endswith("."+zone_name)]
+            if not zones:
+                raise Exception('Zone not exists')
+            elif len(zones)>1 and not force:
+                raise Exception("Subzones exists: " + " ".join(zones))
+            for z in zones:
+                self.store.drop_zone(z)
+        for z in zones:
+            LOG.info("[%s]: Zone was deleted" % (z))
+        return "ok"
+    def get(self, zone_name):
+        with self.store.lock:
+            if zone_name not in self.store.zones:
+                raise Exception('Zone does not exist')
+        return MemoryZone(self.store, zone_name)
+    def get_by_ip(self, ip):
+        #rows of one name, as powerdns.Manager returns
+        with self.store.lock:
+            return [(unicode(self.store.zones[z].records[id].name),)
+                for z, id in sorted(self.store.ips.get(ip, ()))]
+    def drop_by_ip(self, ip):
+        with self.store.lock:
+            found=sorted(self.store.ips.get(ip, ()))
+            if not found:
+                raise Exception("No records was deleted")
+            for z, id in found:
+                self.store.remove(z, id)
+            for z in set(z for z, id in found):
+                self.store.bump_serial(z)
+        LOG.info("Record with IP (%s) was deleted" %(ip))
+        return True
+    def init_host(self):
+        pass
+    def release(self):
+        self.store.save()
+
+
+class MemoryZone(DNSZone):
+    def __init__(self, store, zone_name):
+        self.store=store
+        self.zone_name=zone_name
+    def _zone(self):
+        zone=self.store.zones.get(self.zone_name)
+        if zone is None:
+            raise Exception("Unknown zone: "+self.zone_name)
+        return zone
+    def get_soa(self):
+        with self.store.lock:
+            return self._zone().soa
+    def get_serial(self):
+        return self.get_soa().serial
+    def drop(self):
+        with self.store.lock:
+            zone=self._zone()
+            for id in zone.records.keys():
+                if id!=zone.soa_id:
+                    self.store.remove(self.zone_name, id)
+    def add(self, v):
+        return self._apply_one(("add", v))
+    def add_many(self, records):
+        return self._apply_one([("add", v) for v in records])
+    def apply(self, changes):
+        return [{"result":res, "error":str(err) if err else None}
+            for res, err in self._apply(changes)]
+    def get(self, name=None, type=None):
+        with self.store.lock:
+            zone=self._zone()
+            return [zone.records[id] for id in self._ids(zone, name, type)]
+    def iter_records(self, name=None, type=None, limit=None, marker=None):
+        """ keyset pagination on record id, as powerdns does """
+        with self.store.lock:
+            zone=self._zone()
+            ids=[id for id in self._ids(zone, name, type)
+                if marker is None or id>int(marker)]
+            if limit:
+                ids=ids[:int(limit)]
+            records=[(id, zone.records[id]) for id in ids]
+        for id, rec in records:
+            yield id, rec.to_dict()
+    def iter_names(self, type):
+        with self.store.lock:
+            zone=self._zone()
+            records=[zone.records[id] for id in
+                zone.types.get(DNSRecord.normtype(type), ())]
+        for r in sorted(records, key=lambda r: r.name):
+            yield r.name, r.content
+    def set(self, name, type, content="", priority="", ttl=""):
+        return self._apply_one(("set", name, type, content, priority, ttl))
+    def delete(self, name, type=None):
+        return self._apply_one(("delete", name, type))
+    def _apply_one(self, changes):
+        """ apply change(s), raise first error as add/set/delete did """
+        results=self._apply(changes if isinstance(changes, list) else [changes])
+        for res, err in results:
+            if err:
+                raise err
+        return "ok"
+    def _apply(self, changes):
+        """ apply changes under the store lock, serial is updated once.
+        Return list of (result, exception) """
+        results=[]
+        with self.store.lock:
+            zone=self._zone()
+            for change in changes:
+                action=change[0]
+                try:
+                    if action=="add":
+                        self._add(change[1])
+                    elif action=="set":
+                        self._set(zone, *change[1:])
+                    elif action=="delete":
+                        self._delete(zone, *change[1:])
+                    else:
+                        raise ValueError("Incorrect action: " + str(action))
+                    results.append(("ok", None))
+                except Exception as e:
+                    results.append((None, e))
+            if [r for r in results if r[0]]:
+                self.store.bump_serial(self.zone_name)
+        return results
+    def _add(self, v):
+        if v.type=='SOA':
+            raise Exception("Can't add SOA")
+        self.store.insert(self.zone_name, v,
+            DNSRecord.normname(self._fqdn(v.name)))
+        LOG.info("[%s]: Record (%s, %s, '%s') was added" %
+            (self.zone_name, v.name, v.type, v.content))
+    def _set(self, zone, name, type, content="", priority="", ttl=""):
+        if type=='SOA':
+            raise Exception("Can't change SOA")
+        ids=self._ids(zone, name, type)
+        if not ids:
+            raise Exception("Not found record (%s, %s)" % (name, type))
+        rec=zone.records[ids[0]]
+        self.store.replace(self.zone_name, ids[0], rec._replace(
+            content=content or rec.content,
+            priority=int(priority) if priority else rec.priority,
+            ttl=int(ttl) if ttl else rec.ttl))
+        LOG.info("[%s]: Record (%s, %s) was changed" %
+            (self.zone_name, rec.name, rec.type))
+    def _delete(self, zone, name, type=None):
+        if name is None:
+            raise ValueError("Record name is required")
+        ids=[id for id in self._ids(zone, name, type) if id!=zone.soa_id]
+        if not ids:
+            raise Exception("No records was deleted")
+        for id in ids:
+            self.store.remove(self.zone_name, id)
+        LOG.info("[%s]: Record (%s, %s) was deleted" % (self.zone_name,
+            name, type))
+    def _ids(self, zone, name=None, type=None):
+        """ ids of records by name and type, in order of addition """
+        type=DNSRecord.normtype(type) if type else None
+        if name is not None:
+            ids=zone.names.get(self._fqdn(name), ())
+            if type:
+                ids=[id for id in ids if zone.records[id].type==type]
+            return list(ids)
+        elif type:
+            return sorted(zone.types.get(type, ()))
+        return zone.records.keys()
+    def _fqdn(self, name):
+        return name+"."+self.zone_name if name else self.zone_name
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+DNS manager working thru PowerDNS HTTP API. Changes of zone are sent as
+one RRset PATCH per changeset, PowerDNS updates SOA serial and rectifies
+zone itself, so neither sudo nor pdns utilities are needed.
+
+PowerDNS keeps one RRset per (name, type): adding a record replaces the
+RRset.
+"""
+
+from nova import flags
+from nova.openstack.common import log as logging
+from nova_dns.dnsmanager import DNSManager, DNSZone, DNSRecord, DNSSOARecord
+from nova_dns.dnsmanager.pdnsapi.client import APIError, Client, quote
+
+LOG = logging.getLogger("nova_dns.dnsmanager.pdnsapi")
+
+pdnsapi_nova_dns_dnsmanager_opts = [
+    flags.cfg.StrOpt("dns_pdnsapi_url",
+                     default="http://127.0.0.1:8081/api/v1",
+                     help="PowerDNS API url"),
+    flags.cfg.StrOpt("dns_pdnsapi_key",
+                     default="",
+                     help="PowerDNS API key"),
+    flags.cfg.StrOpt("dns_pdnsapi_server",
+                     default="localhost",
+                     help="PowerDNS server id"),
+    flags.cfg.IntOpt("dns_pdnsapi_pool_size",
+                     default=10,
+                     help="Max number of kept alive connections to PowerDNS API"),
+    flags.cfg.IntOpt("dns_pdnsapi_timeout",
+                     default=10,
+                     help="Seconds to wait for PowerDNS API response"),
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(pdnsapi_nova_dns_dnsmanager_opts)
+
+#content of these types is a domain name, absolute in API
+name_types=set(("CNAME", "MX", "NS", "PTR", "SRV"))
+#content of these types starts with priority in API
+prio_types=set(("MX", "SRV"))
+
+_CLIENT = None
+
+
+def get_client():
+    """Return process-wide API client."""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = Client(FLAGS.dns_pdnsapi_url, FLAGS.dns_pdnsapi_key,
+            FLAGS.dns_pdnsapi_pool_size, FLAGS.dns_pdnsapi_timeout)
+    return _CLIENT
+
+def absolute(name):
+    return name if name.endswith(".") else name+"."
+
+def relative(name):
+    return name[:-1] if name.endswith(".") else name
+
+
+class Manager(DNSManager):
+    def __init__(self):
+        self.client=get_client()
+        self.server="/servers/"+quote(FLAGS.dns_pdnsapi_server)
+    def list(self):
+        return [relative(z["name"]) for z in
+            self.client.request("GET", self.server+"/zones")]
+    def add(self, zone_name, soa={}):
+        zone_name=DNSRecord.normname(zone_name)
+        soa=DNSSOARecord(**soa)
+        content=" ".join((str(f) for f in (absolute(soa.primary),
+            absolute(soa.hostmaster), soa.serial, soa.refresh, soa.retry,
+            soa.expire, soa.ttl)))
+        try:
+            self.client.request("POST", self.server+"/zones", {
+                "name": absolute(zone_name), "kind": "Native",
+                "nameservers": [],
+                "rrsets": [{"name": absolute(zone_name), "type": "SOA",
+                    "ttl": soa.ttl,
+                    "records": [{"content": content, "disabled": False}]}]})
+        except APIError as e:
+            if e.status==409:
+                raise Exception('Zone already exists')
+            raise
+        LOG.info("[%s]: Zone was added" % (zone_name))
+        return "ok"
+    def drop(self, zone_name, force=False):
+        zones=[z for z in self.list()
+            if z==zone_name or z.endswith("."+zone_name)]
+        if not zones:
+            raise Exception('Zone not exists')
+        elif len(zones)>1 and not force:
+            raise Exception("Subzones exists: " + " ".join(zones))
+        for z in zones:
+            self.client.request("DELETE", self.zone_path(z))
+            LOG.info("[%s]: Zone was deleted" % (z))
+        return "ok"
+    def get(self, zone_name):
+        if not self.client.request("GET", self.server+"/zones",
+                zone=absolute(zone_name)):
+            raise Exception('Zone does not exist')
+        return APIZone(self, zone_name)
+    def get_by_ip(self, ip):
+        #rows of one name, as powerdns.Manager returns
+        return [(relative(r["name"]),) for r in self._search_ip(ip)]
+    def drop_by_ip(self, ip):
+        zones={}
+        for r in self._search_ip(ip):
+            zones.setdefault(r["zone_id"], []).append({"name": r["name"],
+                "type": r["type"], "changetype": "DELETE"})
+        if not zones:
+            raise Exception("No records was deleted")
+        for zone_id, rrsets in zones.items():
+            self.client.request("PATCH", self.server+"/zones/"+quote(zone_id),
+                {"rrsets": rrsets})
+        LOG.info("Record with IP (%s) was deleted" %(ip))
+        return True
+    def init_host(self):
+        pass
+    def zone_path(self, zone_name):
+        return self.server+"/zones/"+quote(absolute(zone_name))
+    def _search_ip(self, ip):
+        return [r for r in self.client.request("GET", self.server+"/search-data",
+                q=ip, object_type="record")
+            if r["type"] in ("A", "AAAA") and r["content"]==ip]
+
+
+class APIZone(DNSZone):
+    def __init__(self, manager, zone_name):
+        self.zone_name=zone_name
+        self.client=manager.client
+        self.path=manager.zone_path(zone_name)
+    def get_soa(self):
+        soa=self.get('', 'SOA')
+        if not soa:
+            raise Exception("Zone has no SOA record")
+        return soa[0]
+    def get_serial(self):
+        soa=self.get('', 'SOA')
+        return soa[0].serial if soa else None
+    def drop(self):
+        self.client.request("DELETE", self.path)
+    def add(self, v):
+        return self._apply_one(("add", v))
+    def add_many(self, records):
+        return self._apply_one([("add", v) for v in records])
+    def apply(self, changes):
+        return [{"result":res, "error":str(err) if err else None}
+            for res, err in self._apply(changes)]
+    def get(self, name=None, type=None):
+        type=DNSRecord.normtype(type) if type else None
+        fqdn=absolute(self._fqdn(name)) if name is not None else None
+        res=[]
+        for key, rrset in self._rrsets(fqdn, type):
+            for r in rrset["records"]:
+                res.append(self._record(rrset, r["content"]))
+        return res
+    def set(self, name, type, content="", priority="", ttl=""):
+        return self._apply_one(("set", name, type, content, priority, ttl))
+    def delete(self, name, type=None):
+        return self._apply_one(("delete", name, type))
+    def _apply_one(self, changes):
+        """ apply change(s), raise first error as add/set/delete did """
+        results=self._apply(changes if isinstance(changes, list) else [changes])
+        for res, err in results:
+            if err:
+                raise err
+        return "ok"
+    def _apply(self, changes):
+        """ apply changes with one PATCH, later changes of the same RRset
+        win, adds of existing RRsets are refused. Return list of (result,
+        exception) """
+        results=[None]*len(changes)
+        #(name, type) => RRset change, in order of first change
+        rrsets={}
+        order=[]
+        #one change reads its RRsets only, bigger changesets read the zone
+        whole=len([c for c in changes
+            if c and c[0] in ("add", "set", "delete")])>1
+        current={}
+        def lookup(fqdn, type=None):
+            """ RRsets of name (and type), with pending changes """
+            key=None if whole else (fqdn, type)
+            if key not in current:
+                current[key]=dict(self._rrsets(*(key or ())))
+            found=dict(current[key])
+            found.update(rrsets)
+            return dict((k, v) for k, v in found.items()
+                if k[0]==fqdn and (type is None or k[1]==type)
+                and v.get("changetype")!="DELETE")
+        for i, change in enumerate(changes):
+            action=change[0]
+            try:
+                if action=="add":
+                    if change[1].type=='SOA':
+                        raise Exception("Can't add SOA")
+                    new=[self._rrset(change[1])]
+                    #REPLACE would overwrite it, (name, type) is unique as
+                    #in powerdns database
+                    key=(new[0]["name"], new[0]["type"])
+                    if lookup(*key):
+                        raise Exception("Record (%s, %s) already exists" %
+                            (relative(key[0]), key[1]))
+                elif action=="delete":
+                    name, type=(tuple(change[1:])+(None,))[:2]
+                    if name is None:
+                        raise ValueError("Record name is required")
+                    fqdn=absolute(self._fqdn(name))
+                    keys=lookup(fqdn,
+                        DNSRecord.normtype(type) if type else None).keys()
+                    if not keys:
+                        raise Exception("No records was deleted")
+                    new=[{"name": k[0], "type": k[1], "changetype": "DELETE"}
+                        for k in keys]
+                elif action=="set":
+                    new=[self._set(lookup, *change[1:])]
+                else:
+                    raise ValueError("Incorrect action: " + str(action))
+                for rrset in new:
+                    key=(rrset["name"], rrset["type"])
+                    if key not in rrsets:
+                        order.append(key)
+                    rrsets[key]=rrset
+                results[i]=("ok", None)
+            except APIError:
+                raise
+            except Exception as e:
+                results[i]=(None, e)
+        if order:
+            try:
+                self.client.request("PATCH", self.path,
+                    {"rrsets": [rrsets[k] for k in order]})
+            except APIError as e:
+                #PATCH is atomic - nothing was applied
+                return [(None, e) if res else (res, err)
+                    for res, err in results]
+            LOG.info("[%s]: %d RRset(s) were changed" % (self.zone_name,
+                len(order)))
+        return results
+    def _set(self, lookup, name, type, content="", priority="", ttl=""):
+        type=DNSRecord.normtype(type)
+        if type=='SOA':
+            raise Exception("Can't change SOA")
+        fqdn=absolute(self._fqdn(name))
+        rrset=lookup(fqdn, type).get((fqdn, type))
+        if not rrset:
+            raise Exception("Not found record (%s, %s)" % (name, type))
+        old=self._record(rrset, rrset["records"][0]["content"])
+        return self._rrset(DNSRecord(name=name, type=type,
+            content=content or old.content, priority=priority or old.priority,
+            ttl=ttl or old.ttl))
+    def _rrset(self, v):
+        content=v.content
+        if v.type in name_types:
+            content=absolute(content)
+        if v.type in prio_types:
+            content="%d %s" % (v.priority, content)
+        return {"name": absolute(self._fqdn(v.name)), "type": v.type,
+            "ttl": v.ttl, "changetype": "REPLACE",
+            "records": [{"content": content, "disabled": False}]}
+    def _record(self, rrset, content):
+        type=rrset["type"]
+        if type=='SOA':
+            v=content.split()
+            v[0], v[1]=relative(v[0]), relative(v[1])
+            return DNSSOARecord(*v)
+        priority=None
+        if type in prio_types:
+            priority, content=content.split(" ", 1)
+        if type in name_types:
+            content=relative(content)
+        return DNSRecord(name=relative(rrset["name"]), type=type,
+            content=content, priority=priority, ttl=rrset.get("ttl"))
+    def _rrsets(self, fqdn=None, type=None):
+        """ yield ((name, type), RRset) of zone, filtered by absolute
+        name and type """
+        params={}
+        if fqdn is not None:
+            params["rrset_name"]=fqdn
+        if type:
+            params["rrset_type"]=type
+        zone=self.client.request("GET", self.path, **params)
+        for rrset in zone.get("rrsets", []):
+            if fqdn is not None and rrset["name"]!=fqdn:
+                continue
+            if type and rrset["type"]!=type:
+                continue
+            yield (rrset["name"], rrset["type"]), rrset
+    def _fqdn(self, name):
+        return name+"."+self.zone_name if name else self.zone_name
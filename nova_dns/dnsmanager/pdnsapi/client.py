@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keep-alive HTTP client for PowerDNS API.
+
+Connections are kept in a pool and reused between requests, a request on
+connection closed by server is repeated once on a fresh one.
+"""
+
+import json
+import socket
+import urllib
+import urlparse
+
+from eventlet import pools
+from eventlet.green import httplib
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger("nova_dns.dnsmanager.pdnsapi.client")
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class ConnectionPool(pools.Pool):
+    def __init__(self, scheme, host, port, timeout, max_size):
+        self.connection_class = httplib.HTTPSConnection if scheme == "https" \
+            else httplib.HTTPConnection
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        pools.Pool.__init__(self, max_size=max_size)
+
+    def create(self):
+        return self.connection_class(self.host, self.port,
+            timeout=self.timeout)
+
+
+class Client(object):
+    def __init__(self, url, key, pool_size=10, timeout=10):
+        parsed = urlparse.urlparse(url)
+        self.prefix = parsed.path.rstrip("/")
+        self.key = key
+        self.pool = ConnectionPool(parsed.scheme, parsed.hostname,
+            parsed.port, timeout, pool_size)
+
+    def request(self, method, path, body=None, **params):
+        """ send request, return decoded JSON response or None. Raise
+        APIError for HTTP errors """
+        url = self.prefix + path
+        if params:
+            url += "?" + urllib.urlencode(params)
+        headers = {"X-API-Key": self.key, "Accept": "application/json"}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        with self.pool.item() as conn:
+            for attempt in (1, 2):
+                try:
+                    conn.request(method, url, body, headers)
+                    res = conn.getresponse()
+                    data = res.read()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    #keep-alive connection was closed by server
+                    conn.close()
+                    if attempt == 2:
+                        raise
+        LOG.debug("%s %s: %d" % (method, url, res.status))
+        if res.status >= 400:
+            try:
+                message = json.loads(data)["error"]
+            except Exception:
+                message = data or res.reason
+            raise APIError(res.status, message)
+        return json.loads(data) if data else None
+
+
+def quote(name):
+    return urllib.quote(name, safe="")
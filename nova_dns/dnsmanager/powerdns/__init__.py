@@ -18,134 +18,359 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import time
-import subprocess
 import os
 import os.path
 
 from nova import flags
 from nova.openstack.common import log as logging
-from nova_dns.dnsmanager import DNSManager, DNSZone, DNSRecord, DNSSOARecord
-from nova_dns.dnsmanager.powerdns.session import get_session
+from nova_dns import metrics
+from nova_dns.dnsmanager import DNSManager, DNSZone, DNSRecord, DNSSOARecord, \
+    RecordTuple
+from nova_dns.dnsmanager.powerdns.session import get_scoped_session, \
+    get_read_session, remove_session, written, stream, DB_ERRORS, \
+    unwrap_db_error
 from nova_dns.dnsmanager.powerdns.models import Domains, Records
-from sqlalchemy.sql import and_
+from nova_dns.dnsmanager.powerdns.pipeline import get_pipeline
+from sqlalchemy.sql import and_, select
+from sqlalchemy.exc import IntegrityError
 LOG = logging.getLogger("nova_dns.dnsmanager.powerdns")
 
 pdns_nova_dns_dnsmanager_opts = [
     flags.cfg.StrOpt("dns_powerdns_geomaps_dir", 
                      default="/var/lib/powerdns/nova/maps",
                      help="Default record ttl"),
+    flags.cfg.IntOpt("dns_powerdns_zone_cache_ttl",
+                     default=60,
+                     help="Seconds to keep zone name => domain id map before re-reading it"),
+    flags.cfg.BoolOpt("dns_powerdns_regenerate_geomaps",
+                      default=False,
+                      help="Rewrite geomaps directory from records when "
+                           "listener starts"),
 ]
 
 FLAGS = flags.FLAGS
 FLAGS.register_opts(pdns_nova_dns_dnsmanager_opts)
 
+ZONES = metrics.counter("nova_dns_powerdns_zones_total",
+    "Zones added and deleted", ("action",))
+CHANGES = metrics.counter("nova_dns_powerdns_changes_total",
+    "Record changes applied to zones", ("action", "result"))
+CHANGESET_SECONDS = metrics.histogram("nova_dns_powerdns_changeset_seconds",
+    "Time to apply a changeset to zone")
+
 
 models.register_models()
 
 class Manager(DNSManager):
+    #session of the current unit of work (REST request or listener
+    #event), shared with zones and closed by release()
+    session=property(lambda self: get_scoped_session())
     def __init__(self):
-        self.session=get_session()
+        # zone name => domain id, shared by list()/add()/get(). Zones can
+        # be added by other processes (REST and listener), so the map is
+        # re-read after dns_powerdns_zone_cache_ttl seconds (from replica)
+        # or on a miss (from primary, replica can lag behind)
+        self.zones={}
+        self.zones_loaded=None
+    def _zones(self, reload=False):
+        if reload or self.zones_loaded is None or \
+                time.time()-self.zones_loaded > FLAGS.dns_powerdns_zone_cache_ttl:
+            session=self.session if reload else get_read_session()
+            self.zones=dict(session.query(Domains.name, Domains.id).all())
+            self.zones_loaded=time.time()
+        return self.zones
+    def invalidate(self):
+        """ force re-read of zones on next access """
+        self.zones_loaded=None
     def list(self):
-        return [name[0] for name in self.session.query(Domains.name).all()]
+        return self._zones().keys()
     def add(self, zone_name, soa={}):
-        if zone_name in self.list():
-            raise Exception('Zone already exists')
         zone_name=DNSRecord.normname(zone_name)
-        self.session.add(Domains(name=zone_name, type="NATIVE"))
-        self.session.flush()
+        if zone_name in self._zones():
+            raise Exception('Zone already exists')
+        domain=Domains(name=zone_name, type="NATIVE",
+            reverse_name=models.reverse_name(zone_name))
+        self.session.add(domain)
+        try:
+            self.session.flush()
+        except DB_ERRORS as e:
+            #probably added by somebody else after our map was read
+            self.invalidate()
+            if isinstance(unwrap_db_error(e), IntegrityError):
+                raise Exception('Zone already exists')
+            raise
+        written()
+        self.zones[zone_name]=domain.id
+        ZONES.inc(action="add")
         LOG.info("[%s]: Zone was added" % (zone_name))
         soa=DNSSOARecord(**soa)
         # PowerDNS-specific. TODO make this more pytonish - with objects
         # and bells
         soa.content=" ".join((str(f) for f in (soa.primary, soa.hostmaster, soa.serial,
             soa.refresh, soa.retry, soa.expire, soa.ttl)))
-        PowerDNSZone(zone_name).add(soa)
+        PowerDNSZone(zone_name, domain.id).add(soa)
         return "ok"
     def drop(self, zone_name, force=False):
-        domains=self.session.query(Domains).filter(Domains.name.like('%'+zone_name)).all()
-        if not domains:
-            raise Exception('Zone not exists')
-        elif len(domains)>1 and not force:
-            raise Exception("Subzones exists: " + " ".join([d.name for d in domains]))
+        #zone and subzones by indexed prefix of reversed name, "_" is
+        #valid in names and has to be escaped for LIKE
+        prefix=models.reverse_name(zone_name)
+        prefix=prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self.session.begin():
+            #zones added by other tools (pdnssec, pdns API) have no
+            #reverse_name yet
+            for domain in self.session.query(Domains).filter(
+                    Domains.reverse_name == None):
+                domain.reverse_name=models.reverse_name(domain.name)
+            self.session.flush()
+            domains=self.session.query(Domains.id, Domains.name).filter(
+                Domains.reverse_name.like(prefix+'%', escape='\\')).all()
+            if not domains:
+                raise Exception('Zone not exists')
+            elif len(domains)>1 and not force:
+                raise Exception("Subzones exists: " + " ".join([d.name for d in domains]))
+            ids=[d.id for d in domains]
+            self.session.query(Records).filter(Records.domain_id.in_(ids)
+                ).delete(synchronize_session=False)
+            self.session.query(Domains).filter(Domains.id.in_(ids)
+                ).delete(synchronize_session=False)
+        written()
         for domain in domains:
-            PowerDNSZone(domain.name).drop()
-            self.session.delete(domain)
+            self.zones.pop(domain.name, None)
+            written(domain.name)
+            get_pipeline().discard(domain.name)
+            ZONES.inc(action="drop")
             LOG.info("[%s]: Zone was deleted" % (domain.name))
-        self.session.flush()
         return "ok"
     def get(self, zone_name):
-        if zone_name in self.list():
-            return PowerDNSZone(zone_name)
-        else:
+        domain_id=self._zones().get(zone_name)
+        if domain_id is None:
+            #probably new zone, added by another process
+            domain_id=self._zones(reload=True).get(zone_name)
+        if domain_id is None:
             raise Exception('Zone does not exist')
+        return PowerDNSZone(zone_name, domain_id)
     def get_by_ip(self, ip):
-        return self.session.query(Records.name).filter(Records.content.like('%'+ip+'%')).all()
+        return self._q_ip(get_read_session().query(Records.name), ip).all()
     def drop_by_ip(self, ip):
-        q=self.session.query(Records).filter(Records.content==ip)
-
-        if q.delete():
+        q=self._q_ip(self.session.query(Records), ip)
+        if q.delete(synchronize_session=False):
+            written()
             LOG.info("Record with IP (%s) was deleted" %(ip))
             return True 
         else:
             raise Exception("No records was deleted")
 
     def init_host(self):
-       pass
+        if FLAGS.dns_powerdns_regenerate_geomaps:
+            self.regenerate_geomaps()
+    def release(self):
+        remove_session()
+    def regenerate_geomaps(self):
+        """ rewrite geomaps directory from records table in one pass """
+        r, d=Records.__table__, Domains.__table__
+        q=select([r.c.name, d.c.name.label("zone_name")]).where(and_(
+            r.c.domain_id==d.c.id, r.c.name!=d.c.name))
+        files={}
+        for rec in stream(get_read_session(), q):
+            if rec.name.endswith("."+rec.zone_name):
+                path, content=geomap(rec.name[:-len(rec.zone_name)-1],
+                    rec.zone_name)
+                files[path]=content
+        get_pipeline().regenerate(FLAGS.dns_powerdns_geomaps_dir, files)
+        LOG.info("%d geomap files scheduled for regeneration" % len(files))
+        return len(files)
+    def _q_ip(self, q, ip):
+        #exact match on indexed content, only address records
+        return q.filter(Records.content==ip).filter(Records.type.in_(('A', 'AAAA')))
+
+def geomap(name, zone_name):
+    """ return (path, content) of geomap file for record name in zone """
+    top_level_zone=".".join(zone_name.split(".")[1:])
+    return (os.path.join(FLAGS.dns_powerdns_geomaps_dir,
+            name + "." + top_level_zone),
+        "$RECORD %s\n$ORIGIN %s\n0   %s.external\n900 %s.internal\n" %
+            (name, top_level_zone, name, name))
 
 class PowerDNSZone(DNSZone):
-    def __init__(self, zone_name):
+    session=property(lambda self: get_scoped_session())
+    #replica for read-only queries, primary right after zone was changed
+    read_session=property(lambda self: get_read_session(self.zone_name))
+    def __init__(self, zone_name, domain_id=None):
         self.zone_name=zone_name
-        self.session=get_session()
-        domain=self.session.query(Domains).filter(Domains.name==zone_name).first()
-        if not domain:
-            raise Exception("Unknown zone: "+zone_name)
-        self.domain_id=domain.id
+        if domain_id is None:
+            domain=self.read_session.query(Domains).filter(Domains.name==zone_name).first()
+            if not domain:
+                raise Exception("Unknown zone: "+zone_name)
+            domain_id=domain.id
+        self.domain_id=domain_id
+        self.pipeline=get_pipeline()
     def get_soa(self):
-        content=self._q(type="SOA", name='').first().content
+        soa=self._soa()
+        if soa is None:
+            raise Exception("Zone has no SOA record")
+        return soa
+    def get_serial(self):
+        soa=self._soa()
+        return soa.serial if soa else None
+    def _soa(self):
+        rec=self._q(type="SOA", name='', session=self.read_session).first()
+        if rec is None:
+            return None
         #content format is "primary hostmaster serial refresh retry expire ttl"
         #so we can magically pass it to consrtuctor
-        return DNSSOARecord(*content.split())
+        return DNSSOARecord(*rec.content.split())
     def drop(self):
         self._q().delete()
     def add(self, v):
-        rec=Records()
-        rec.domain_id=self.domain_id
-        rec.name=rec.name=v.name+"."+self.zone_name if v.name else self.zone_name
-        rec.name=DNSRecord.normname(rec.name)
-        rec.type=v.type
-        rec.content=v.content
-        rec.ttl=v.ttl
-        rec.prio=v.priority
-        rec.change_date=int(time.time())
-        self.session.add(rec)
-        self.session.flush()
-        LOG.info("[%s]: Record (%s, %s, '%s') was added" %
-            (self.zone_name, rec.name, rec.type, rec.content))
-        self._update_serial(rec.change_date)
-        if v.name:
-            top_level_zone=".".join(self.zone_name.split(".")[1:])
-            file_name= FLAGS.dns_powerdns_geomaps_dir+ "/" + v.name  + "." + top_level_zone
-            with open(file_name,"w") as f:
-                f.write("$RECORD %s\n"%(v.name))
-                f.write("$ORIGIN %s\n"%(top_level_zone))
-                f.write("0   %s.external\n"%(v.name))
-                f.write("900 %s.internal\n"%(v.name))
-                f.flush()
-                subprocess.call(["sudo","pdns_control","rediscover"])
-        subprocess.call(['sudo','pdnssec','--config-dir=/etc/powerdns/pdnssec','rectify-zone',self.zone_name])
-        return "ok"
+        return self._apply_one(("add", v))
+    def add_many(self, records):
+        return self._apply_one([("add", v) for v in records])
+    def apply(self, changes):
+        return [{"result":res, "error":str(err) if err else None}
+            for res, err in self._apply(changes)]
     def get(self, name=None, type=None):
         res=[]
-        for r in self._q(name, type).all():
+        for r in self._q(name, type, self.read_session).all():
             if r.type=='SOA':
                 res.append(DNSSOARecord(*r.content.split()))
             else:
                 res.append(DNSRecord(name=r.name, type=r.type, 
                     content=r.content, priority=r.prio, ttl=r.ttl))
         return res
+    def iter_records(self, name=None, type=None, limit=None, marker=None):
+        """ keyset pagination on record id, rows are streamed from server
+        side cursor (MySQL) without ORM objects """
+        t=Records.__table__
+        q=select([t.c.id, t.c.name, t.c.type, t.c.content, t.c.ttl, t.c.prio]
+            ).where(t.c.domain_id==self.domain_id)
+        if type:
+            q=q.where(t.c.type==DNSRecord.normtype(type))
+        if name is not None:
+            q=q.where(t.c.name==self._fqdn(name))
+        if marker is not None:
+            q=q.where(t.c.id>int(marker))
+        q=q.order_by(t.c.id)
+        if limit:
+            q=q.limit(int(limit))
+        default_ttl=FLAGS.dns_default_ttl
+        for r in stream(self.read_session, q):
+            if r.type=='SOA':
+                rec=DNSSOARecord(*r.content.split())
+            else:
+                #stored records are valid already
+                rec=RecordTuple._make((r.name, r.type, r.content,
+                    r.prio or 0, r.ttl or default_ttl))
+            yield r.id, rec.to_dict()
+    def iter_names(self, type):
+        t=Records.__table__
+        q=select([t.c.name, t.c.content]).where(and_(
+            t.c.domain_id==self.domain_id, t.c.type==DNSRecord.normtype(type))
+            ).order_by(t.c.name)
+        for r in stream(self.read_session, q):
+            yield r.name, r.content
     def set(self, name, type, content="", priority="", ttl=""):
+        return self._apply_one(("set", name, type, content, priority, ttl))
+    def delete(self, name, type=None):
+        return self._apply_one(("delete", name, type))
+    def _apply_one(self, changes):
+        """ apply change(s), raise first error as add/set/delete did """
+        results=self._apply(changes if isinstance(changes, list) else [changes])
+        for res, err in results:
+            if err:
+                raise err
+        return "ok"
+    def _apply(self, changes):
+        """ apply changes in one transaction. Consecutive adds are
+        inserted with one executemany (records which already exist are
+        reported and skipped), consecutive deletes are done with one select
+        and one delete per record type, serial is updated once.
+        Return list of (result, exception) """
+        results=[None]*len(changes)
+        rows=[]
+        deletes=[]
+        #geomap path => content (None to remove), written after commit
+        geomaps={}
+        change_date=int(time.time())
+        with CHANGESET_SECONDS.time(), self.session.begin():
+            for i, change in enumerate(changes):
+                action=change[0]
+                try:
+                    if action=="add":
+                        self._delete_many(deletes, results, geomaps)
+                        rows.append((i, self._add(change[1], change_date)))
+                        continue
+                    elif action=="delete":
+                        self._insert(rows, results, geomaps)
+                        deletes.append((i,)+self._delete_key(*change[1:]))
+                        continue
+                    else:
+                        self._insert(rows, results, geomaps)
+                        self._delete_many(deletes, results, geomaps)
+                        if action=="set":
+                            self._set(change_date, *change[1:])
+                        else:
+                            raise ValueError("Incorrect action: " + str(action))
+                    results[i]=("ok", None)
+                except DB_ERRORS:
+                    #transaction is broken, whatever change hit it
+                    raise
+                except Exception as e:
+                    results[i]=(None, e)
+            self._insert(rows, results, geomaps)
+            self._delete_many(deletes, results, geomaps)
+            if [r for r in results if r[0]]:
+                self._update_serial(change_date)
+        for change, (res, err) in zip(changes, results):
+            CHANGES.inc(action=change[0] if change[0] in
+                ("add", "set", "delete") else "invalid",
+                result="error" if err else "ok")
+        if [r for r in results if r[0]]:
+            written(self.zone_name)
+            for path, content in geomaps.items():
+                self.pipeline.geomap(path, content)
+            self.pipeline.rectify(self.zone_name)
+        return results
+    def _insert(self, rows, results, geomaps):
+        """ insert pending (index, row) records, set their results. Rows
+        with (name, type) already in the zone or earlier in rows would break
+        unique nametype_index and the whole transaction, so they are
+        looked up first and reported """
+        if not rows:
+            return
+        t=Records.__table__
+        keys=set((r["name"], r["type"]) for i, r in rows)
+        q=select([t.c.name, t.c.type]).where(and_(
+            t.c.domain_id==self.domain_id,
+            t.c.name.in_(set(name for name, type in keys))))
+        existing=set((r.name, r.type) for r in self.session.execute(q)
+            if (r.name, r.type) in keys)
+        insert=[]
+        for i, r in rows:
+            key=(r["name"], r["type"])
+            if key in existing:
+                results[i]=(None, Exception("Record (%s, %s) already exists"
+                    % key))
+                continue
+            existing.add(key)
+            insert.append(r)
+            results[i]=("ok", None)
+        del rows[:]
+        if insert:
+            self.session.execute(t.insert(), insert)
+        for r in insert:
+            LOG.info("[%s]: Record (%s, %s, '%s') was added" %
+                (self.zone_name, r["name"], r["type"], r["content"]))
+            if r["name"]!=self.zone_name:
+                path, content=geomap(r["name"][:-len(self.zone_name)-1],
+                    self.zone_name)
+                geomaps[path]=content
+    def _add(self, v, change_date):
+        name=DNSRecord.normname(v.name+"."+self.zone_name if v.name else self.zone_name)
+        return dict(domain_id=self.domain_id, name=name, type=v.type,
+            content=v.content, ttl=v.ttl, prio=v.priority, change_date=change_date)
+    def _set(self, change_date, name, type, content="", priority="", ttl=""):
         if type=='SOA':
-            raise exception("Can't change SOA")
+            raise Exception("Can't change SOA")
         rec=self._q(name, type).first()
         if not rec:
             raise Exception("Not found record (%s, %s)" % (name, type))
@@ -155,39 +380,67 @@ class PowerDNSZone(DNSZone):
             rec.ttl=ttl
         if priority:
             rec.prio=priority
-        rec.change_date=int(time.time())
-        self.session.merge(rec)
+        rec.change_date=change_date
         self.session.flush()
-        self._update_serial(rec.change_date)
         LOG.info("[%s]: Record (%s, %s) was changed" % 
             (self.zone_name, rec.name, rec.type))
-        return "ok"
-    def delete(self, name, type=None):
-        if self._q(name, type).delete():
-            LOG.info("[%s]: Record (%s, %s) was deleted" % (self.zone_name, name, type))
-            file_name= FLAGS.dns_powerdns_geomaps_dir+ "/" + name + "." + ".".join(self.zone_name.split(".")[1:]) 
-            LOG.debug("Geomap file to delte: %s"%(file_name))
-            if os.path.isfile(file_name):
-                os.remove(file_name)
-                subprocess.call(["sudo","pdns_control","rediscover"])
-            return "ok"
-        else:
-            raise Exception("No records was deleted")
+    def _delete_key(self, name, type=None):
+        if name is None:
+            raise ValueError("Record name is required")
+        return (name, DNSRecord.normtype(type) if type else None)
+    def _delete_many(self, deletes, results, geomaps):
+        """ delete pending (index, name, type) records, set their results """
+        types={}
+        for i, name, type in deletes:
+            types.setdefault(type, []).append((i, name))
+        del deletes[:]
+        for type, names in types.items():
+            fqdns=dict((i, self._fqdn(name)) for i, name in names)
+            q=self.session.query(Records.name).filter(
+                Records.domain_id==self.domain_id).filter(
+                Records.name.in_(set(fqdns.values())))
+            if type:
+                q=q.filter(Records.type==type)
+            found=set(r.name for r in q.all())
+            if found:
+                q=self.session.query(Records).filter(
+                    Records.domain_id==self.domain_id).filter(
+                    Records.name.in_(found))
+                if type:
+                    q=q.filter(Records.type==type)
+                q.delete(synchronize_session=False)
+            for i, name in names:
+                if fqdns[i] not in found:
+                    results[i]=(None, Exception("No records was deleted"))
+                    continue
+                found.discard(fqdns[i])
+                results[i]=("ok", None)
+                LOG.info("[%s]: Record (%s, %s) was deleted" % (self.zone_name, name, type))
+                file_name=geomap(name, self.zone_name)[0]
+                LOG.debug("Geomap file to delte: %s"%(file_name))
+                geomaps[file_name]=None
     def _update_serial(self, change_date):
-        #TODO change to get_soa
         soa=self._q('', 'SOA').first()
+        if soa is None:
+            #zone without SOA (removed by admin or other tools), nothing
+            #to version, records are still written
+            LOG.warn("[%s]: Zone has no SOA record, serial not updated"
+                % self.zone_name)
+            return
         v=soa.content.split()
         #TODO change this to ordinar set()
-        v[2]=change_date
+        #serial has to grow even for changes within the same second
+        v[2]=max(change_date, int(v[2])+1)
         content=" ".join((str(f) for f in v))
         #FIXME should change_date for SOA be changed here ?
         soa.update({"content":content, "change_date":change_date})
         self.session.flush()
-    def _q(self, name=None, type=None):
-        q=self.session.query(Records).filter(Records.domain_id==self.domain_id)
+    def _q(self, name=None, type=None, session=None):
+        q=(session or self.session).query(Records).filter(Records.domain_id==self.domain_id)
 	if type:
             q=q.filter(Records.type==DNSRecord.normtype(type))
         if name is None:
             return q
-        fqdn=name+"."+self.zone_name if name else self.zone_name
-        return q.filter(Records.name==fqdn)
+        return q.filter(Records.name==self._fqdn(name))
+    def _fqdn(self, name):
+        return name+"."+self.zone_name if name else self.zone_name
@@ -25,10 +25,15 @@ from sqlalchemy.orm import object_mapper
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import Index 
+from sqlalchemy.engine.reflection import Inspector
+
+from nova.openstack.common import log as logging
 
 from nova_dns.dnsmanager.powerdns.session import get_session, get_engine
 
 
+LOG = logging.getLogger("nova_dns.dnsmanager.powerdns.models")
+
 BASE = declarative_base()
 
 
@@ -96,6 +101,9 @@ class Domains(BASE, PowerDNSBase):
     type = Column(String(6), nullable=True)
     notified_serial = Column(Integer, nullable=True)
     account = Column(String(40), nullable=True)
+    # labels in reverse order with trailing dot ("com.example." for
+    # example.com), zone and its subzones are found by indexed prefix
+    reverse_name = Column(String(255), nullable=True, index=True)
 
 class Records(BASE, PowerDNSBase):
     __tablename__ = 'records'
@@ -109,6 +117,12 @@ class Records(BASE, PowerDNSBase):
     change_date = Column(Integer)
 
 Index('nametype_index', Records.name, Records.type, unique=True)
+# exact ip => record lookups (get_by_ip, drop_by_ip)
+Index('content_index', Records.content)
+
+def reverse_name(name):
+    """example.com => com.example."""
+    return ".".join(reversed(name.split("."))) + "."
 
 def register_models():
     """Register Models and create metadata."""
@@ -116,5 +130,36 @@ def register_models():
     engine = get_engine()
     for model in models:
         model.metadata.create_all(engine)
-    
 
+def upgrade_models():
+    """Add columns and indexes introduced later to existing tables.
+
+    Not run on start, ALTER/CREATE INDEX lock big tables - run
+    "nova-dns-manage db_sync" (see quickstart) once after upgrade."""
+    models = (Domains, Records)
+    engine = get_engine()
+    inspector = Inspector.from_engine(engine)
+    for model in models:
+        table = model.__table__
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                LOG.info("Adding column %s.%s" % (table.name, column.name))
+                engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table.name,
+                    column.name, column.type.compile(dialect=engine.dialect)))
+    # domains added before reverse_name or by other tools
+    domains = Domains.__table__
+    for domain in engine.execute(domains.select().where(
+            domains.c.reverse_name == None)).fetchall():
+        engine.execute(domains.update().where(domains.c.id == domain.id),
+            reverse_name=reverse_name(domain.name))
+    # by columns, index names differ between nova-dns and pdns schema
+    # (rec_name_index vs ix_records_name)
+    for model in models:
+        table = model.__table__
+        existing = set(tuple(i['column_names'])
+            for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if tuple(c.name for c in index.columns) not in existing:
+                LOG.info("Creating index %s" % index.name)
+                index.create(engine)
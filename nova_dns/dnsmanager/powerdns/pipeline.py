@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Deferred PowerDNS maintenance.
+
+Zones to rectify, geomap files and the need to rediscover are collected
+by record writes and processed in background once per flush window, so a
+burst of writes costs one ``pdnssec rectify-zone`` per zone and one
+``pdns_control rediscover``. Geomap files are written in a thread pool,
+each to a temporary file which is renamed over the old one, so pdns never
+reads half-written map.
+"""
+
+import os
+import os.path
+import tempfile
+
+import eventlet
+from eventlet import tpool
+from eventlet.green import subprocess
+
+from nova import flags
+from nova.openstack.common import log as logging
+from nova_dns import metrics
+
+LOG = logging.getLogger("nova_dns.dnsmanager.powerdns.pipeline")
+
+pdns_pipeline_opts = [
+    flags.cfg.FloatOpt("dns_powerdns_flush_window",
+                       default=1.0,
+                       help="Seconds to collect zones before running rectify-zone "
+                            "and rediscover, 0 to run them immediately"),
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(pdns_pipeline_opts)
+
+SUBPROCESS_SECONDS = metrics.histogram("nova_dns_powerdns_subprocess_seconds",
+    "Time of pdns utilities run by flush", ("command",))
+
+_PIPELINE = None
+
+
+class Pipeline(object):
+    def __init__(self, window=None):
+        self.window = FLAGS.dns_powerdns_flush_window if window is None else window
+        self.zones = set()
+        self.need_rediscover = False
+        #path => content, None to remove
+        self.geomaps = {}
+        #directory to clean of files not in geomaps
+        self.geomaps_dir = None
+        self.timer = None
+
+    def rectify(self, zone_name):
+        """ schedule rectify-zone for zone_name """
+        self.zones.add(zone_name)
+        self._schedule()
+
+    def rediscover(self):
+        """ schedule pdns_control rediscover """
+        self.need_rediscover = True
+        self._schedule()
+
+    def geomap(self, path, content):
+        """ schedule write of geomap file, removal if content is None """
+        self.geomaps[path] = content
+        self._schedule()
+
+    def regenerate(self, directory, files):
+        """ schedule replace of all geomaps in directory with files
+        (path => content). Pending writes of committed changes are newer
+        and win """
+        geomaps = dict(files)
+        geomaps.update(self.geomaps)
+        self.geomaps = geomaps
+        self.geomaps_dir = directory
+        self._schedule()
+
+    def discard(self, zone_name):
+        """ forget pending work for dropped zone """
+        self.zones.discard(zone_name)
+
+    def pending(self):
+        return bool(self.zones or self.geomaps or self.geomaps_dir) or \
+            self.need_rediscover
+
+    def flush(self):
+        """ run all pending work now """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        zones, self.zones = self.zones, set()
+        rediscover, self.need_rediscover = self.need_rediscover, False
+        geomaps, self.geomaps = self.geomaps, {}
+        directory, self.geomaps_dir = self.geomaps_dir, None
+        if geomaps or directory:
+            try:
+                if tpool.execute(write_geomaps, geomaps, directory):
+                    rediscover = True
+            except Exception:
+                #some files may be written already, zones still need
+                #rectify. Lost maps are rewritten by regenerate_geomaps
+                LOG.exception("Geomap files write failed")
+                rediscover = True
+        if rediscover:
+            with SUBPROCESS_SECONDS.time(command="rediscover"):
+                subprocess.call(["sudo", "pdns_control", "rediscover"])
+        for zone_name in sorted(zones):
+            with SUBPROCESS_SECONDS.time(command="rectify-zone"):
+                subprocess.call(['sudo', 'pdnssec', '--config-dir=/etc/powerdns/pdnssec',
+                    'rectify-zone', zone_name])
+        if zones or rediscover:
+            LOG.debug("Flushed: rectified %d zone(s), rediscover: %s" %
+                (len(zones), rediscover))
+
+    def _schedule(self):
+        if self.window <= 0:
+            self.flush()
+        elif self.timer is None:
+            self.timer = eventlet.spawn_after(self.window, self._run)
+
+    def _run(self):
+        self.timer = None
+        try:
+            self.flush()
+        except Exception:
+            LOG.exception("PowerDNS flush failed")
+
+
+def write_geomaps(files, directory=None):
+    """Write (remove for None content) geomap files, path => content.
+    If directory given, remove other files in it. Return number of
+    changed files."""
+    changed = 0
+    for path, content in files.items():
+        if content is None:
+            if os.path.isfile(path):
+                os.remove(path)
+                changed += 1
+            continue
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            #mkstemp creates 0600 file, pdns runs as another user
+            os.fchmod(fd, 0644)
+            f = os.fdopen(fd, "w")
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        changed += 1
+    if directory is not None:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if path not in files and os.path.isfile(path):
+                os.remove(path)
+                changed += 1
+    return changed
+
+
+def get_pipeline():
+    """Return process-wide pipeline."""
+    global _PIPELINE
+    if _PIPELINE is None:
+        _PIPELINE = Pipeline()
+    return _PIPELINE
@@ -35,3 +35,17 @@ class AMQPListener:
     def event(self, event):
         """process event"""
         pass
+
+    def events(self, events):
+        """process list of events, in order. Return list with None for
+        each processed event and exception for each failed one. Listeners
+        can override this to handle the whole batch at once"""
+        errors=[]
+        for e in events:
+            try:
+                self.event(e)
+                errors.append(None)
+            except Exception as ex:
+                LOG.exception("failed to handle message")
+                errors.append(ex)
+        return errors
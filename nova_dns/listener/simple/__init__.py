@@ -17,11 +17,12 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Simple listener:
-- doesn't sync state with dns after restart
+- syncs dns with nova on start (and periodically, if configured)
 - stateless"""
 
 import time
 import eventlet
+import eventlet.event
 
 from nova.openstack.common import log as logging
 from nova import utils
@@ -29,15 +30,16 @@ from nova.openstack.common import importutils
 from nova import flags
 
 from nova.db.sqlalchemy.session import get_engine
+from sqlalchemy.sql import text
 
-from nova_dns.dnsmanager import DNSRecord
+from nova_dns.dnsmanager import DNSRecord, RecordTuple
 from nova_dns.listener import AMQPListener
 from nova_dns import auth
-
-import netaddr
+from nova_dns import metrics
+from nova_dns.listener.simple.ptr import PTRZones
+from nova_dns.listener.simple.sync import Reconciler
 
 LOG = logging.getLogger("nova_dns.listener.simple")
-SLEEP = 60 
 
 AUTH = auth.AUTH
 
@@ -54,53 +56,78 @@ nova_dns_lis_simple = [
                       help="Create a zone per tenant"),
     flags.cfg.ListOpt('dns_ptr_zones', 
                       default="", 
-                      help="Classless delegation networks in format ip_addr/network")
+                      help="Classless delegation networks in format ip_addr/network"),
+    flags.cfg.IntOpt('dns_poll_interval_min',
+                     default=1,
+                     help="Seconds between polls for ip of new instances"),
+    flags.cfg.IntOpt('dns_poll_interval_max',
+                     default=60,
+                     help="Max seconds between polls while no new ip is found"),
+    flags.cfg.IntOpt('dns_poll_chunk',
+                     default=100,
+                     help="Max number of instances to look up in one query"),
+    flags.cfg.BoolOpt('dns_network_events',
+                      default=True,
+                      help="Add records on fixed ip allocation messages, "
+                           "poll only instances without such message"),
+    flags.cfg.IntOpt('dns_network_event_timeout',
+                     default=10,
+                     help="Seconds to wait for fixed ip allocation message "
+                          "before instance is polled")
 ]
 
 FLAGS = flags.FLAGS
 FLAGS.register_opts(nova_dns_lis_simple)
 
+POLL_SECONDS = metrics.histogram("nova_dns_listener_poll_seconds",
+    "Time of one poll for ip addresses of pending instances")
+PROPAGATION_SECONDS = metrics.histogram(
+    "nova_dns_listener_propagation_seconds",
+    "Time from run_instance message till records of instance were added")
+RECORDS = metrics.counter("nova_dns_listener_records_total",
+    "A records of instances added and deleted by listener", ("action",))
+SYNC = metrics.gauge("nova_dns_listener_sync",
+    "Stats of the last sync of DNS with nova", ("stat",))
+
 class Listener(AMQPListener):
     def __init__(self):
         self.pending={}
+        #pending instances with allocation message, address not stored yet
+        self.allocated=set()
+        #(zone name, hostname) changed by events while sync runs
+        self.touched=None
+        self.wakeup=eventlet.event.Event()
+        self.ptr_zones=PTRZones(FLAGS.dns_ptr_zones)
         LOG.info("Connecting to database @ %s"%(FLAGS.sql_connection))
         self.conn=get_engine()
         dnsmanager_class=importutils.import_class(FLAGS.dns_manager);
         self.dnsmanager=dnsmanager_class()
+        self.dnsmanager.init_host()
+        metrics.gauge("nova_dns_listener_pending",
+            "Instances waiting for ip address",
+            fn=lambda: len(self.pending))
         self.eventlet = eventlet.spawn(self._pollip)
+        self.reconciler=Reconciler(self)
+        self.sync_thread=None
+        if FLAGS.dns_sync_on_start or FLAGS.dns_sync_interval>0:
+            self.sync_thread=eventlet.spawn(self._sync)
 
     def event(self, e):
+        try:
+            self._event(e)
+        finally:
+            self.dnsmanager.release()
+
+    def _event(self, e):
         method = e.get("method", "<unknown>")
         if not e.has_key("args"):
             return
         uuid = e["args"].get("instance_uuid", None)
         if method=="run_instance":
             LOG.info("Run instance %s. Waiting on assing ip address" % (str(uuid),))
-            self.pending[uuid]=1
+            self._add_pending(uuid)
         elif method=="terminate_instance":
-            if self.pending.has_key(uuid): del self.pending[uuid]
-            rec = self.conn.execute("select hostname, project_id "+
-                "from instances where uuid=%s", uuid).first()
-            if not rec:
-                LOG.error('Unknown uuid: '+str(uuid))
-            else:
-                try:
-                    LOG.info("Instance %s hostname '%s' was terminated" %
-                        (uuid, rec.hostname))
-                    #TODO check if record was added/changed by admin
-                    if (FLAGS.dns_use_tenant_zone):
-                        zonename = AUTH.tenant2zonename(rec.project_id)
-                    else:
-                        zonename = FLAGS.dns_zone
-#                    zonename="internal."+zonename
-                    zone=self.dnsmanager.get(zonename)
-                    if FLAGS.dns_ptr:
-                        ip = zone.get(rec.hostname, 'A')[0].content
-                        (ptr_zonename, octet) = self.ip2zone(ip)
-                        self.dnsmanager.get(ptr_zonename).delete(str(octet), 'PTR')
-                    zone.delete(rec.hostname, 'A')
-                except:
-                    pass
+            self._terminate([uuid])
         elif method=="associate_floating_ip":
             LOG.debug("Message: %s"%(e))
             #u'args': {u'interface': u'eth0', u'fixed_address': u'10.0.0.24', u'floating_address': u'172.31.237.87'},
@@ -132,6 +159,9 @@ class Listener(AMQPListener):
             except:
                 pass
 
+        elif method in ("allocate_for_instance", "lease_fixed_ip") and \
+                FLAGS.dns_network_events:
+            self._allocated(uuid, e["args"].get("address"))
         elif method=="disassociate_floating_ip":
             ip = e["args"].get("address",None)
             try:
@@ -140,74 +170,289 @@ class Listener(AMQPListener):
               LOG.error("Could not delete record for IP adresss %s"%(ip))
         else:
             LOG.debug("Skip message with method: "+method)
+    def events(self, events):
+        """ process batch of events. Consecutive terminate_instance events
+        are handled at once - one query to nova and one changeset per zone.
+        Return list of errors, None for processed event """
+        errors=[]
+        terminated=[]
+        try:
+            for e in events:
+                if e.get("method")=="terminate_instance" and e.has_key("args"):
+                    terminated.append(e["args"].get("instance_uuid", None))
+                    continue
+                if terminated:
+                    errors.extend(self._terminate_events(terminated))
+                    terminated=[]
+                try:
+                    self._event(e)
+                    errors.append(None)
+                except Exception as ex:
+                    LOG.exception("Failed to handle message")
+                    errors.append(ex)
+            if terminated:
+                errors.extend(self._terminate_events(terminated))
+        finally:
+            self.dnsmanager.release()
+        return errors
+
+    def _terminate_events(self, uuids):
+        """ _terminate, return error for each of uuids """
+        try:
+            self._terminate(uuids)
+        except Exception as e:
+            LOG.exception("Failed to handle terminated instances")
+            return [e]*len(uuids)
+        return [None]*len(uuids)
+
+    def _terminate(self, uuids):
+        """ delete records of terminated instances """
+        for uuid in uuids:
+            self.pending.pop(uuid, None)
+            self.allocated.discard(uuid)
+        uuids=[uuid for uuid in set(uuids) if uuid]
+        zones={}
+        found=set()
+        for i in xrange(0, len(uuids), FLAGS.dns_poll_chunk):
+            params=dict(("uuid%d" % n, uuid) for n, uuid in
+                enumerate(uuids[i:i+FLAGS.dns_poll_chunk]))
+            for rec in self.conn.execute(text(
+                    "select hostname, project_id, uuid from instances "
+                    "where uuid in (%s)" % ",".join(":"+p for p in params)),
+                    **params):
+                found.add(rec.uuid)
+                LOG.info("Instance %s hostname '%s' was terminated" %
+                    (rec.uuid, rec.hostname))
+                try:
+                    zonename=self._zonename(rec.project_id)
+                    self._touch(zonename, rec.hostname)
+                    zones.setdefault(zonename, []).append(rec.hostname)
+                except Exception:
+                    LOG.exception("Unknown zone of instance %s" % (rec.uuid))
+        for uuid in set(uuids)-found:
+            LOG.error('Unknown uuid: '+str(uuid))
+        #TODO check if record was added/changed by admin
+        for zonename, hostnames in zones.items():
+            try:
+                zone=self.dnsmanager.get(zonename)
+                if FLAGS.dns_ptr:
+                    self._delete_ptrs([(hostname+'.'+zonename, r.content)
+                        for hostname in hostnames
+                        for r in zone.get(hostname, 'A')])
+                results=zone.apply([("delete", hostname, 'A')
+                    for hostname in hostnames])
+                RECORDS.inc(len([r for r in results if r["error"] is None]),
+                    action="deleted")
+            except Exception:
+                LOG.exception("Failed to delete records in zone %s" % (zonename))
+
+    def _sync(self):
+        """ sync dns with nova on start and every dns_sync_interval
+        seconds """
+        run=FLAGS.dns_sync_on_start
+        while True:
+            if run:
+                try:
+                    for stat, value in self.reconciler.run().items():
+                        SYNC.set(value, stat=stat)
+                except Exception:
+                    LOG.exception("Failed to sync DNS with nova")
+                finally:
+                    self.dnsmanager.release()
+            if FLAGS.dns_sync_interval<=0:
+                return
+            time.sleep(FLAGS.dns_sync_interval)
+            run=True
+
+    def _zonename(self, project_id):
+        if (FLAGS.dns_use_tenant_zone):
+            return AUTH.tenant2zonename(project_id)
+        return FLAGS.dns_zone
+
     def _pollip(self):
+        interval=FLAGS.dns_poll_interval_min
         while True:
-            time.sleep(SLEEP)
-            if not len(self.pending):
+            if not self.pending:
+                #nothing to wait for - sleep till next run_instance
+                self.wakeup.wait()
+                self.wakeup=eventlet.event.Event()
+                interval=FLAGS.dns_poll_interval_min
+            #allocation message cuts the wait short
+            with eventlet.Timeout(interval, False):
+                self.wakeup.wait()
+            if self.wakeup.ready():
+                self.wakeup=eventlet.event.Event()
+                interval=FLAGS.dns_poll_interval_min
+            uuids=self._overdue()
+            if not uuids:
+                #waiting on allocation messages
+                interval=FLAGS.dns_poll_interval_min
+                continue
+            try:
+                with POLL_SECONDS.time():
+                    added=self._poll_pending(uuids)
+            except Exception:
+                LOG.exception("Failed to poll ip addresses")
+                added=0
+            finally:
+                self.dnsmanager.release()
+            #poll fast while addresses arrive, back off while they don't
+            if added:
+                interval=FLAGS.dns_poll_interval_min
+            else:
+                interval=min(interval*2, FLAGS.dns_poll_interval_max)
+
+    def _add_pending(self, uuid):
+        if not self.pending:
+            self._wakeup()
+        self.pending.setdefault(uuid, time.time())
+
+    def _wakeup(self):
+        if not self.wakeup.ready():
+            self.wakeup.send()
+
+    def _overdue(self):
+        """ pending instances, that should be polled """
+        if not FLAGS.dns_network_events:
+            return self.pending.keys()
+        border=time.time()-FLAGS.dns_network_event_timeout
+        return [uuid for uuid, since in self.pending.items()
+            if since<border or uuid in self.allocated]
+
+    def _allocated(self, uuid, address):
+        """ fixed ip was allocated (allocate_for_instance, with uuid) or
+        leased (lease_fixed_ip, with address) - add records right away.
+        nova-network handles allocate_for_instance concurrently with us,
+        so the poller retries shortly if the address is not stored yet """
+        if address:
+            self._add_rows(self._fixed_ips("f.address=:address", address=address))
+            return
+        if not uuid:
+            return
+        self._add_pending(uuid)
+        if not self._poll_pending([uuid]) and uuid in self.pending:
+            self.allocated.add(uuid)
+            self._wakeup()
+
+    def _poll_pending(self, uuids):
+        """ look up fixed ips of instances with given uuids only and add
+        records for found ones. Return number of processed instances """
+        processed=0
+        for i in xrange(0, len(uuids), FLAGS.dns_poll_chunk):
+            params=dict(("uuid%d" % n, uuid) for n, uuid in
+                enumerate(uuids[i:i+FLAGS.dns_poll_chunk]))
+            processed+=self._add_rows(self._fixed_ips("i.uuid in (%s)" %
+                ",".join(":"+p for p in params), **params))
+        return processed
+
+    def _fixed_ips(self, where, **params):
+        return self.conn.execute(text("""
+            select i.hostname, i.uuid, i.project_id, f.address
+            from instances i, fixed_ips f
+            where i.id=f.instance_id and """ + where), **params).fetchall()
+
+    def _add_rows(self, rows):
+        """ add records for rows of pending instances """
+        processed=0
+        for r in rows:
+            LOG.debug("Processing Record with id %s"%(r.uuid))
+            #taken from pending before add, so the poller and allocation
+            #message handler don't add the same instance twice
+            since=self.pending.pop(r.uuid, None)
+            if since is None:
                 continue
-            #TODO change select to i.id in ( pendings ) to speed up
-            for r in self.conn.execute("""
-                select i.hostname, i.uuid, i.project_id, f.address
-                from instances i, fixed_ips f
-                where i.id=f.instance_id"""):
-                LOG.debug("Processing Record with id %s"%(r.uuid))
-                if r.uuid not in self.pending: continue
-                zone=self.dnsmanager.get(AUTH.tenant2zonename(r.project_id))
-		if len(zone.get(r.hostname, 'A')):
-                    if FLAGS.dns_ptr:
-                        (ptr_zonename, octet) = self.ip2zone(zone.get(r.hostname, 'A')[0].content)
-                        self.dnsmanager.get(ptr_zonename).delete(str(octet), 'PTR')
-                    zone.delete(r.hostname, 'A')
-		(ptr_zonename, octet) = self.ip2zone(r.address)
-		if len(self.dnsmanager.get(ptr_zonename).get(str(octet), 'PTR')):
-		    self.dnsmanager.get(ptr_zonename).delete(str(octet), 'PTR')
-                LOG.info("Instance %s hostname %s adding ip %s" %
-                    (r.uuid, r.hostname, r.address))
-                zones_list=self.dnsmanager.list()
-#                if ("internal."+FLAGS.dns_zone) not in zones_list:
-                if (FLAGS.dns_zone) not in zones_list:
-#                    self._add_zone("internal."+FLAGS.dns_zone)
-                    self._add_zone(FLAGS.dns_zone)
-                if (FLAGS.dns_use_tenant_zone):
-                    zonename = AUTH.tenant2zonename(r.project_id)
-                    if zonename not in zones_list:
-                        self._add_zone(zonename)
-#                    if ("internal."+zonename) not in zones_list:
-#                        self._add_zone("internal."+zonename)
-                    if (zonename) not in zones_list:
-                        self._add_zone(zonename)
-                else:
-                    zonename = FLAGS.dns_zone
-#                zonename = "internal."+zonename
-                name=self.dnsmanager.get(zonename).get('name', None)
-                name="" if name=='@' else name
-                type=self.dnsmanager.get(zonename).get('type', None)
-		if r.hostname+"."+zonename not in self.dnsmanager.get(zonename).get(name=name, type=type):
-                    try:
-                        self.dnsmanager.get(zonename).add(
-                            DNSRecord(name=r.hostname, type='A', content=r.address))
-                        del self.pending[r.uuid]
-                    except ValueError as e:
-                        LOG.warn(str(e))
-                    except:
-                        pass
-                    if FLAGS.dns_ptr:
-                        (ptr_zonename, octet) = self.ip2zone(r.address)
-                        if ptr_zonename not in zones_list:
-                            self._add_zone(ptr_zonename)
-                        self.dnsmanager.get(ptr_zonename).add(DNSRecord(name=octet, 
-                            type='PTR', content=r.hostname+'.'+zonename))
-		else:
-		    del self.pending[r.uuid]
+            try:
+                self._add_instance(r)
+            except ValueError as e:
+                #incorrect hostname, retry will not help
+                LOG.warn(str(e))
+            except Exception:
+                LOG.exception("Failed to add records for instance %s" % (r.uuid))
+                self.pending.setdefault(r.uuid, since)
+                continue
+            else:
+                RECORDS.inc(action="added")
+                PROPAGATION_SECONDS.observe(time.time()-since)
+            self.allocated.discard(r.uuid)
+            processed+=1
+        return processed
+
+    def _add_instance(self, r):
+        """ add A (and PTR) record for instance row with hostname, uuid,
+        project_id and address """
+        LOG.info("Instance %s hostname %s adding ip %s" %
+            (r.uuid, r.hostname, r.address))
+        zones_list=self.dnsmanager.list()
+        if (FLAGS.dns_zone) not in zones_list:
+            self._add_zone(FLAGS.dns_zone)
+        zonename = self._zonename(r.project_id)
+        if zonename not in zones_list:
+            self._add_zone(zonename)
+        zone=self.dnsmanager.get(zonename)
+        self._touch(zonename, r.hostname)
+        #hostname or address could be used by terminated instance, old
+        #records are replaced in the changeset adding new ones
+        old=zone.get(r.hostname, 'A')
+        self._replace(zone, ([("delete", r.hostname, 'A')] if old else []) +
+            [("add", RecordTuple(name=r.hostname, type='A', content=r.address))])
+        if FLAGS.dns_ptr:
+            (ptr_zonename, octet) = self.ip2zone(r.address)
+            ptr_changes={ptr_zonename: [("delete", str(octet), 'PTR')]}
+            if old and old[0].content!=r.address:
+                (old_zonename, old_octet) = self.ip2zone(old[0].content)
+                ptr_changes.setdefault(old_zonename, []).insert(0,
+                    ("delete", str(old_octet), 'PTR'))
+            for name, changes in ptr_changes.items():
+                if name!=ptr_zonename and name in zones_list:
+                    self.dnsmanager.get(name).apply(changes)
+            if ptr_zonename not in zones_list:
+                self._add_zone(ptr_zonename)
+            self._replace(self.dnsmanager.get(ptr_zonename),
+                ptr_changes[ptr_zonename] + [("add", RecordTuple(name=octet,
+                    type='PTR', content=r.hostname+'.'+zonename))])
+
+    def _touch(self, zonename, hostname):
+        """ remember host changed by event, for running sync """
+        if self.touched is not None:
+            self.touched.add((zonename, str(hostname).lower()))
+
+    def _replace(self, zone, changes):
+        """ apply deletes and the add at the end of changes at once.
+        Deleting missing records is fine, failed add is raised """
+        error=zone.apply(changes)[-1]["error"]
+        if error:
+            raise Exception(error)
+
+    def _delete_ptrs(self, records):
+        """ delete PTR records of (hostname, ip) records, one changeset per
+        reverse zone. PTR of ip pointing to another host is kept - the
+        address could be taken by new instance already """
+        ptr_zones={}
+        for hostname, ip in records:
+            (ptr_zonename, octet) = self.ip2zone(ip)
+            ptr_zones.setdefault(ptr_zonename, []).append((str(octet),
+                hostname.lower()))
+        zones_list=self.dnsmanager.list()
+        for ptr_zonename, ptrs in ptr_zones.items():
+            if ptr_zonename not in zones_list:
+                continue
+            zone=self.dnsmanager.get(ptr_zonename)
+            changes=[("delete", octet, 'PTR') for octet, hostname in ptrs
+                if [r for r in zone.get(octet, 'PTR')
+                    if r.content.lower().rstrip(".")==hostname]]
+            if changes:
+                zone.apply(changes)
 
     def _add_zone(self, name):
         try:
             self.dnsmanager.add(name)
             zone=self.dnsmanager.get(name)
             LOG.debug("FLAGS.dns_ns = %s"%(FLAGS.dns_ns))
+            records=[]
             for ns in FLAGS.dns_ns:
                 (name,content)=ns.split(':',2)
-                zone.add(DNSRecord(name=name, type="NS", content=content))
+                records.append(RecordTuple(name=name, type="NS", content=content))
+            zone.add_many(records)
         except ValueError as e:
             LOG.warn(str(e))
         except:
@@ -215,16 +460,5 @@ class Listener(AMQPListener):
             pass
 
     def ip2zone(self, ip):
-        #TODO check /cidr >= 24
-        addr = netaddr.IPAddress(ip) 
-        for zone in FLAGS.dns_ptr_zones: 
-            #TODO prepare netaddr one time on service start
-            zoneaddr = netaddr.IPNetwork(zone)
-            if addr not in zoneaddr:
-                continue
-            cidr = str(zoneaddr.cidr).split('/')[1]
-            w = zoneaddr.cidr.ip.words
-            return ("%s-%s.%s.%s.%s.in-addr.arpa" % 
-                (w[3], cidr, w[2], w[1], w[0]), addr.words[-1])
-        w = addr.words
-        return ("%s.%s.%s.in-addr.arpa" % (w[2], w[1], w[0]), w[3])
+        """ return (reverse zone name, record name) for ip """
+        return self.ptr_zones.lookup(ip)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reverse zone lookup.
+
+Classless delegation networks are parsed once into a sorted table of
+non-overlapping address intervals, each pointing to the most specific
+network covering it, so an address is resolved to its reverse zone with
+one binary search.
+"""
+
+import bisect
+import socket
+import struct
+
+import netaddr
+
+
+def ip2int(ip):
+    """Return (version, integer) for textual IPv4/IPv6 address."""
+    if ":" in ip:
+        hi, lo = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, ip))
+        return 6, (hi << 64) | lo
+    return 4, struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip))[0]
+
+
+def _nibbles(value, count):
+    """Lowest ``count`` hex digits of value, least significant first."""
+    return ["%x" % ((value >> (4 * i)) & 0xf) for i in xrange(count)]
+
+
+class PTRZones(object):
+    """
+    Longest prefix match of addresses to reverse zones.
+
+    IPv4 networks give RFC 2317 zones (``first-prefixlen.c.b.a.in-addr.arpa``)
+    with the last octet as record name, IPv6 networks (prefix length has
+    to be a multiple of 4) give ``ip6.arpa`` nibble zones. Addresses out
+    of configured networks fall into /24 (IPv4) or /64 (IPv6) zones.
+    """
+
+    def __init__(self, networks):
+        self.tables = {4: ([], [], []), 6: ([], [], [])}
+        nets = {4: [], 6: []}
+        for network in networks or []:
+            net = netaddr.IPNetwork(network).cidr
+            if net.version == 6 and net.prefixlen % 4:
+                raise ValueError("IPv6 reverse zone has to be on nibble "
+                    "boundary: %s" % network)
+            nets[net.version].append((int(net.network), int(net[-1]),
+                net.prefixlen, self._zonename(net)))
+        for version, items in nets.items():
+            self._build(self.tables[version], items)
+
+    def _zonename(self, net):
+        if net.version == 4:
+            w = net.ip.words
+            return "%s-%s.%s.%s.%s.in-addr.arpa" % (w[3], net.prefixlen,
+                w[2], w[1], w[0])
+        return ".".join(_nibbles(int(net.network) >> (128 - net.prefixlen),
+            net.prefixlen / 4)) + ".ip6.arpa"
+
+    def _build(self, table, items):
+        """Split networks into elementary intervals, most specific wins."""
+        starts, ends, zones = table
+        bounds = sorted(set([i[0] for i in items] + [i[1] + 1 for i in items]))
+        for start, next_start in zip(bounds, bounds[1:]):
+            covering = [i for i in items if i[0] <= start and next_start - 1 <= i[1]]
+            if not covering:
+                continue
+            zone = max(covering, key=lambda i: i[2])
+            if zones and zones[-1] is zone and ends[-1] == start - 1:
+                ends[-1] = next_start - 1
+                continue
+            starts.append(start)
+            ends.append(next_start - 1)
+            zones.append(zone)
+
+    def lookup(self, ip):
+        """Return (reverse zone name, record name) for ip."""
+        version, addr = ip2int(ip)
+        starts, ends, zones = self.tables[version]
+        i = bisect.bisect_right(starts, addr) - 1
+        if i >= 0 and addr <= ends[i]:
+            prefixlen, zonename = zones[i][2:]
+        else:
+            prefixlen, zonename = (24 if version == 4 else 64), None
+        if version == 4:
+            if zonename is None:
+                zonename = "%s.%s.%s.in-addr.arpa" % ((addr >> 8) & 0xff,
+                    (addr >> 16) & 0xff, addr >> 24)
+            return zonename, addr & 0xff
+        nibbles = _nibbles(addr, 32)
+        host = (128 - prefixlen) / 4
+        if zonename is None:
+            zonename = ".".join(nibbles[host:]) + ".ip6.arpa"
+        return zonename, ".".join(nibbles[:host])
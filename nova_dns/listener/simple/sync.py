@@ -0,0 +1,320 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reconciliation of DNS with nova.
+
+Instances with fixed ips are read from nova database and A records from
+their zones, both ordered by hostname, and merged as in sort-merge join,
+so memory use doesn't depend on number of instances. Missing and changed
+records are applied in changesets of dns_poll_chunk records.
+"""
+
+import itertools
+import time
+
+from sqlalchemy import String
+from sqlalchemy.sql import and_, column, or_, select, table
+
+from nova import flags
+from nova.openstack.common import log as logging
+
+from nova_dns.dnsmanager import DNSRecord, RecordTuple
+
+LOG = logging.getLogger("nova_dns.listener.simple.sync")
+
+nova_dns_sync_opts = [
+    flags.cfg.BoolOpt('dns_sync_on_start',
+                      default=True,
+                      help="Sync DNS with nova when listener starts"),
+    flags.cfg.IntOpt('dns_sync_interval',
+                     default=0,
+                     help="Seconds between syncs of DNS with nova, "
+                          "0 - sync on start only"),
+    flags.cfg.BoolOpt('dns_sync_delete',
+                      default=False,
+                      help="Delete A records of hostnames unknown to nova, "
+                           "otherwise they are only reported")
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(nova_dns_sync_opts)
+
+_instances = table("instances", column("id"), column("hostname", String),
+    column("project_id", String), column("deleted"))
+_fixed_ips = table("fixed_ips", column("id"), column("address", String),
+    column("instance_id"))
+
+
+def after(columns, values):
+    """Keyset condition: rows ordered by columns after row with values."""
+    if len(columns) == 1:
+        return columns[0] > values[0]
+    return or_(columns[0] > values[0], and_(columns[0] == values[0],
+        after(columns[1:], values[1:])))
+
+
+def merge(left, right):
+    """Full outer merge join of iterators of (key, value) ordered by key.
+
+    Yield (key, left value or None, right value or None).
+    """
+    l, r = next(left, None), next(right, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield l[0], l[1], None
+            l = next(left, None)
+        elif l is None or r[0] < l[0]:
+            yield r[0], None, r[1]
+            r = next(right, None)
+        else:
+            yield l[0], l[1], r[1]
+            l, r = next(left, None), next(right, None)
+
+
+def ordered(items, what):
+    """Pass (key, value) items through, checking that keys grow.
+
+    Databases may collate differently from python, merge of such
+    streams would report wrong differences.
+    """
+    last = None
+    for key, value in items:
+        if last is not None and key <= last:
+            raise ValueError("%s are not ordered: %r after %r" %
+                (what, key, last))
+        last = key
+        yield key, value
+
+
+class Reconciler(object):
+    """Adds missing and fixes changed A (and PTR) records of instances.
+
+    Hostnames are compared with trailing dot - "host." orders like
+    "host.zone" does in records table. Only single label names are
+    treated as instance records, apex and deeper names are left alone.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.dnsmanager = listener.dnsmanager
+
+    def run(self):
+        """Sync all zones of instances, return dict with counts.
+
+        Nova rows are read while listener handles events, hosts changed
+        by events since the sync started are skipped - their rows could
+        be stale, like of instance terminated meanwhile.
+        """
+        self.listener.touched = set()
+        try:
+            return self._run()
+        finally:
+            self.listener.touched = None
+
+    def _run(self):
+        start = time.time()
+        stats = dict(zones=0, hosts=0, added=0, changed=0, stale=0,
+            deleted=0, skipped=0, errors=0)
+        visited = set()
+        for zonename, hosts in self._nova_zones(stats):
+            if zonename in visited:
+                #rows of zone are not contiguous, its records would be
+                #taken for stale
+                LOG.error("Instances of zone %s are not ordered" % zonename)
+                stats["errors"] += 1
+                continue
+            visited.add(zonename)
+            self._sync_zone(zonename, hosts, stats)
+        #zones without instances left
+        for zonename in self._instance_zones():
+            if zonename not in visited:
+                self._sync_zone(zonename, iter(()), stats)
+        stats["seconds"] = time.time() - start
+        LOG.info("DNS synced with nova in %(seconds).1f s: %(zones)d zones, "
+            "%(hosts)d hosts, %(added)d added, %(changed)d changed, "
+            "%(stale)d stale, %(deleted)d deleted, %(skipped)d skipped, "
+            "%(errors)d errors" % stats)
+        return stats
+
+    def _nova_zones(self, stats):
+        """Yield (zone name, iterator of (hostname key, addresses))."""
+        rows = self._nova_rows()
+        if FLAGS.dns_use_tenant_zone:
+            projects = itertools.groupby(rows, lambda r: r.project_id)
+        else:
+            projects = [(None, rows)]
+        for project_id, group in projects:
+            try:
+                zonename = self.listener._zonename(project_id)
+            except Exception:
+                LOG.exception("Unknown zone of project %s" % project_id)
+                stats["errors"] += 1
+                continue
+            yield zonename, self._hosts(group, stats)
+
+    def _nova_rows(self):
+        """Yield instance rows ordered by (project_id,) hostname key.
+
+        Rows are read in pages of dns_poll_chunk by keyset, MySQLdb
+        engine of nova would buffer the whole result otherwise.
+        """
+        i, f = _instances, _fixed_ips
+        key = i.c.hostname + "."
+        if FLAGS.dns_use_tenant_zone:
+            order = (i.c.project_id, key, f.c.id)
+        else:
+            order = (key, f.c.id)
+        q = select([i.c.hostname, i.c.project_id, f.c.address, f.c.id]).where(
+            and_(i.c.id == f.c.instance_id, i.c.deleted == 0)).order_by(
+            *order).limit(FLAGS.dns_poll_chunk)
+        last = None
+        while True:
+            page = q if last is None else q.where(after(order, last))
+            rows = self.listener.conn.execute(page).fetchall()
+            for r in rows:
+                yield r
+            if len(rows) < FLAGS.dns_poll_chunk:
+                return
+            r = rows[-1]
+            last = (r.hostname + ".", r.id)
+            if FLAGS.dns_use_tenant_zone:
+                last = (r.project_id,) + last
+
+    def _hosts(self, rows, stats):
+        """Group rows by hostname, yield (hostname key, addresses)."""
+        def keys():
+            for r in rows:
+                try:
+                    yield DNSRecord.normname(r.hostname) + ".", r.address
+                except ValueError as e:
+                    LOG.warn(str(e))
+                    stats["errors"] += 1
+        for key, group in itertools.groupby(keys(), lambda r: r[0]):
+            yield key, sorted(address for key, address in group)
+
+    def _records(self, zone, zonename):
+        """Yield (hostname key, content) for A records of instances."""
+        suffix = "." + zonename
+        for name, content in zone.iter_names('A'):
+            if not name.endswith(suffix):
+                continue
+            host = name[:-len(suffix)]
+            if "." not in host:
+                yield host + ".", content
+
+    def _instance_zones(self):
+        """Names of existing zones, that hold instance records."""
+        zones = self.dnsmanager.list()
+        if not FLAGS.dns_use_tenant_zone:
+            return [z for z in zones if z == FLAGS.dns_zone]
+        suffix = "." + FLAGS.dns_zone
+        return [z for z in zones
+            if z.endswith(suffix) and "." not in z[:-len(suffix)]]
+
+    def _sync_zone(self, zonename, hosts, stats):
+        try:
+            zones_list = self.dnsmanager.list()
+            if FLAGS.dns_zone not in zones_list:
+                self.listener._add_zone(FLAGS.dns_zone)
+            if zonename not in zones_list:
+                self.listener._add_zone(zonename)
+            zone = self.dnsmanager.get(zonename)
+        except Exception:
+            LOG.exception("Failed to get zone %s" % zonename)
+            stats["errors"] += 1
+            return
+        stats["zones"] += 1
+        changes = []
+        #(hostname, old address, new address)
+        ptrs = []
+        try:
+            for key, addresses, content in merge(
+                    ordered(hosts, "Instances of zone %s" % zonename),
+                    ordered(self._records(zone, zonename),
+                        "Records of zone %s" % zonename)):
+                host = key[:-1]
+                if addresses is not None:
+                    stats["hosts"] += 1
+                if content is None:
+                    changes.append(("add", RecordTuple(host, 'A', addresses[0])))
+                    ptrs.append((host, None, addresses[0]))
+                    stats["added"] += 1
+                elif addresses is None:
+                    stats["stale"] += 1
+                    LOG.info("[%s]: Record (%s, A, '%s') of unknown host" %
+                        (zonename, host, content))
+                    if not FLAGS.dns_sync_delete:
+                        continue
+                    changes.append(("delete", host, 'A'))
+                    ptrs.append((host, content, None))
+                    stats["deleted"] += 1
+                elif content not in addresses:
+                    changes.append(("delete", host, 'A'))
+                    changes.append(("add", RecordTuple(host, 'A', addresses[0])))
+                    ptrs.append((host, content, addresses[0]))
+                    stats["changed"] += 1
+                if len(changes) >= FLAGS.dns_poll_chunk:
+                    self._apply(zone, zonename, changes, ptrs, stats)
+        except ValueError as e:
+            LOG.error(str(e))
+            stats["errors"] += 1
+            return
+        self._apply(zone, zonename, changes, ptrs, stats)
+
+    def _apply(self, zone, zonename, changes, ptrs, stats):
+        """Apply changeset to zone and to reverse zones, clear them."""
+        touched = set(host for zone_name, host in self.listener.touched or ()
+            if zone_name == zonename)
+        if touched:
+            skipped = set(host for host, old, new in ptrs if host in touched)
+            stats["skipped"] += len(skipped)
+            changes[:] = [c for c in changes if (c[1].name if c[0] == "add"
+                else c[1]) not in skipped]
+            ptrs[:] = [p for p in ptrs if p[0] not in skipped]
+        try:
+            if changes:
+                for result in zone.apply(changes):
+                    if result["error"]:
+                        LOG.warn("[%s]: %s" % (zonename, result["error"]))
+                        stats["errors"] += 1
+            if ptrs and FLAGS.dns_ptr:
+                self._apply_ptrs(zonename, ptrs)
+        except Exception:
+            LOG.exception("Failed to apply changes to zone %s" % zonename)
+            stats["errors"] += 1
+        del changes[:]
+        del ptrs[:]
+
+    def _apply_ptrs(self, zonename, ptrs):
+        self.listener._delete_ptrs([(host + '.' + zonename, old)
+            for host, old, new in ptrs if old])
+        ptr_zones = {}
+        for host, old, new in ptrs:
+            if new:
+                ptr_zonename, octet = self.listener.ip2zone(new)
+                #address could be left by another host
+                ptr_zones.setdefault(ptr_zonename, []).extend((
+                    ("delete", str(octet), 'PTR'),
+                    ("add", RecordTuple(str(octet), 'PTR',
+                        host + '.' + zonename))))
+        zones_list = self.dnsmanager.list()
+        for ptr_zonename, changes in ptr_zones.items():
+            if ptr_zonename not in zones_list:
+                self.listener._add_zone(ptr_zonename)
+            self.dnsmanager.get(ptr_zonename).apply(changes)
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Process-wide metrics in Prometheus text format
+
+Counters, gauges and histograms are registered once at import time of
+the module using them and updated in place. Metrics can take values from
+a function instead, for stats kept elsewhere.
+"""
+
+import threading
+import time
+
+import eventlet
+from eventlet import wsgi
+import webob
+import webob.dec
+
+from nova import flags
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger("nova_dns.metrics")
+
+nova_dns_metrics_opts = [
+    flags.cfg.StrOpt("dns_metrics_listen",
+                     default="0.0.0.0",
+                     help="IP address for metrics of listener process"),
+    flags.cfg.IntOpt("dns_metrics_port",
+                     default=0,
+                     help="Port for metrics of listener process, 0 - don't "
+                          "serve them"),
+]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(nova_dns_metrics_opts)
+
+#seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("%s expects labels %s" % (self.name,
+                ", ".join(self.labels)))
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def samples(self):
+        """ yield (suffix, label pairs, value) """
+        if self.fn is not None:
+            value = self.fn()
+            items = value.items() if isinstance(value, dict) else \
+                [((), value)]
+            for key, value in items:
+                yield "", zip(self.labels, key if isinstance(key, tuple)
+                    else (key,)), value
+            return
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield "", zip(self.labels, key), value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                format_labels(labels), format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                #per bucket counts, sum, count
+                counts = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, **labels):
+        """ context manager observing seconds spent in its block """
+        return Timer(self, labels)
+
+    def get(self, **labels):
+        """ return (count, sum) """
+        counts = self.values.get(self.key(labels))
+        return (counts[2], counts[1]) if counts else (0, 0.0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(c[0]), c[1], c[2]))
+                for key, c in self.values.items())
+        for key, (buckets, total, count) in items:
+            labels = zip(self.labels, key)
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                yield "_bucket", labels + [("le", format_value(bound))], \
+                    cumulative
+            yield "_bucket", labels + [("le", "+Inf")], count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.started, **self.labels)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, *args, **kwargs):
+        """ return metric of name, created on first call. Function of
+        metric is replaced by the latest one, it reads the latest object """
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s is a %s" % (name, metric.type))
+            elif kwargs.get("fn") is not None:
+                metric.fn = kwargs["fn"]
+            return metric
+
+    def counter(self, name, help, labels=(), fn=None):
+        return self.register(Counter, name, help, labels, fn=fn)
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.register(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, help, labels, buckets=buckets)
+
+    def unregister(self, name):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def render(self):
+        out = []
+        for name in sorted(self.metrics):
+            try:
+                out.append(self.metrics[name].render())
+            except Exception:
+                LOG.exception("Failed to collect metric %s" % name)
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+unregister = REGISTRY.unregister
+render = REGISTRY.render
+
+
+class App(object):
+    """
+    WSGI application returning metrics of the process
+    """
+    @webob.dec.wsgify
+    def __call__(self, req):
+        return webob.Response(REGISTRY.render(),
+            content_type="text/plain; version=0.0.4", charset="utf-8")
+
+    @classmethod
+    def factory(cls, global_config, **local_config):
+        return cls()
+
+
+def serve(host, port):
+    """ serve metrics over HTTP, blocks. Listener process uses it """
+    sock = eventlet.listen((host, port))
+    LOG.info("Serving metrics at %s:%d" % (host, port))
+    wsgi.server(sock, App(), log=NullLog())
+
+
+class NullLog(object):
+    """ access log of metrics server, scrapes are not logged """
+    def write(self, data):
+        pass
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\",
+        "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
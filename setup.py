@@ -12,7 +12,7 @@ setup(name='nova-dns',
       author_email='openstack@griddynamics.com',
       url='http://www.griddynamics.com/openstack',
       packages=find_packages(exclude=['bin', 'smoketests', 'tests']),
-      scripts=['bin/nova-dns'],
+      scripts=['bin/nova-dns', 'bin/nova-dns-manage'],
       py_modules=[],
       test_suite='tests'
 )
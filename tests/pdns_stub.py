@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process PowerDNS API server, enough of it for pdnsapi backend tests
+and benchmarks. Zones are kept in dicts, SOA serial is increased on
+every PATCH.
+"""
+
+import json
+
+import eventlet
+from eventlet import wsgi
+import webob
+import webob.dec
+import webob.exc
+
+
+class Server(object):
+    def __init__(self, key="secret"):
+        self.key = key
+        #name => {"name": ..., "rrsets": {(name, type): rrset}}
+        self.zones = {}
+        self.requests = []
+        self.ports = set()
+        self.sock = eventlet.listen(("127.0.0.1", 0))
+        self.url = "http://127.0.0.1:%d/api/v1" % self.sock.getsockname()[1]
+        self.thread = eventlet.spawn(wsgi.server, self.sock, self,
+            log=open("/dev/null", "w"))
+
+    def stop(self):
+        self.thread.kill()
+        self.sock.close()
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        self.requests.append((req.method, req.path_info))
+        self.ports.add(req.environ.get("REMOTE_PORT"))
+        if req.headers.get("X-API-Key") != self.key:
+            return self.error(401, "Unauthorized")
+        parts = req.path_info.split("/")[3:]
+        if parts[:2] != ["servers", "localhost"]:
+            return self.error(404, "Not found")
+        parts = parts[2:]
+        if parts == ["zones"]:
+            if req.method == "POST":
+                return self.create(json.loads(req.body))
+            name = req.GET.get("zone")
+            return self.json([self.info(z) for z in self.zones.values()
+                if name is None or z["name"] == name])
+        elif parts == ["search-data"]:
+            return self.json([dict(r, zone=z["name"], zone_id=z["name"],
+                    object_type="record")
+                for z in self.zones.values() for rrset in z["rrsets"].values()
+                for r in self.records(rrset) if r["content"] == req.GET["q"]])
+        elif len(parts) == 2 and parts[0] == "zones":
+            zone = self.zones.get(parts[1])
+            if zone is None:
+                return self.error(404, "Could not find domain '%s'" % parts[1])
+            if req.method == "DELETE":
+                del self.zones[parts[1]]
+                return webob.Response(status=204)
+            elif req.method == "PATCH":
+                return self.patch(zone, json.loads(req.body))
+            info = self.info(zone)
+            info["rrsets"] = [rrset for rrset in zone["rrsets"].values()
+                if req.GET.get("rrset_name", rrset["name"]) == rrset["name"]
+                and req.GET.get("rrset_type", rrset["type"]) == rrset["type"]]
+            return self.json(info)
+        return self.error(404, "Not found")
+
+    def create(self, body):
+        if body["name"] in self.zones:
+            return self.error(409, "Domain '%s' already exists" % body["name"])
+        self.zones[body["name"]] = {"name": body["name"], "rrsets": dict(
+            ((r["name"], r["type"]), r) for r in body.get("rrsets", []))}
+        return self.json(self.info(self.zones[body["name"]]), 201)
+
+    def patch(self, zone, body):
+        rrsets = dict(zone["rrsets"])
+        for rrset in body["rrsets"]:
+            key = (rrset["name"], rrset["type"])
+            if not rrset["name"].endswith(zone["name"]):
+                return self.error(422, "RRset %s IN %s: Name is out of zone"
+                    % key)
+            if rrset["changetype"] == "DELETE":
+                rrsets.pop(key, None)
+            elif rrset["changetype"] == "REPLACE":
+                rrsets[key] = dict((k, v) for k, v in rrset.items()
+                    if k != "changetype")
+            else:
+                return self.error(422, "Changetype not understood")
+        soa = rrsets[(zone["name"], "SOA")]
+        content = soa["records"][0]["content"].split()
+        content[2] = str(int(content[2]) + 1)
+        soa["records"] = [{"content": " ".join(content), "disabled": False}]
+        zone["rrsets"] = rrsets
+        return webob.Response(status=204)
+
+    def info(self, zone):
+        return {"id": zone["name"], "name": zone["name"], "kind": "Native"}
+
+    def records(self, rrset):
+        for r in rrset["records"]:
+            yield {"name": rrset["name"], "type": rrset["type"],
+                "ttl": rrset["ttl"], "content": r["content"],
+                "disabled": r["disabled"]}
+
+    def json(self, data, status=200):
+        return webob.Response(body=json.dumps(data), status=status,
+            content_type="application/json")
+
+    def error(self, status, message):
+        return self.json({"error": message}, status)
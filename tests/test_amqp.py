@@ -24,6 +24,8 @@ import datetime
 import unittest
 import stubout
 
+import eventlet
+
 from nova_dns import amqp
 from nova import flags
 
@@ -37,6 +39,37 @@ class TestListener():
     def event(self, e):
         self.event = e
 
+class SlowListener():
+    def __init__(self):
+        self.events = []
+    def event(self, e):
+        eventlet.sleep(e["args"].get("sleep", 0))
+        self.events.append(e["args"]["n"])
+
+class BatchListener():
+    def __init__(self):
+        self.batches = []
+    def events(self, events):
+        self.batches.append(events)
+        return [Exception("failed") if e.get("fail") else None for e in events]
+
+class TestChannel():
+    def __init__(self):
+        self.acks = []
+        self.rejects = []
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+    def basic_reject(self, delivery_tag, requeue):
+        self.rejects.append((delivery_tag, requeue))
+
+class TestMessage():
+    delivery_info = {"routing_key": "compute.test"}
+    def __init__(self, acked, delivery_tag=None):
+        self.acked = acked
+        self.delivery_tag = delivery_tag
+    def ack(self):
+        self.acked.append(self)
+
 class TestCase(tests.TestCase):
     run_instance_body = {
         "_context_roles": [
@@ -141,5 +174,87 @@ class TestCase(tests.TestCase):
         service.process_event(self.run_instance_body, None)
         self.assertEqual(self.run_instance_body, service.listener.event)
 
+    def test_metrics(self):
+        FLAGS.dns_listener = "tests.test_amqp.SlowListener"
+        service = amqp.Service()
+        messages = amqp.MESSAGES.get(method="test")
+        lag = amqp.LAG_SECONDS.get()[0]
+        service.process_message({"method": "test", "args": {"n": 1},
+            "_context_timestamp": datetime.datetime.utcnow().isoformat()},
+            TestMessage([]))
+        service.pool.waitall()
+        self.assertEqual(amqp.MESSAGES.get(method="test"), messages + 1)
+        self.assertEqual(amqp.LAG_SECONDS.get()[0], lag + 1)
+        self.assertEqual(amqp.message_time(self.run_instance_body),
+            1323198777.805503)
+        self.assertEqual(amqp.message_time({}), None)
+
     #TODO test work with actuall rabbit server - start private one for this needs
-    
+
+    def test_process_message_partitions(self):
+        FLAGS.dns_listener = "tests.test_amqp.SlowListener"
+        self.stubs.Set(FLAGS, "dns_amqp_workers", 4)
+        service = amqp.Service()
+        acked = []
+        for n, (uuid, sleep) in enumerate((("a", 0.02), ("a", 0), ("b", 0),
+                ("a", 0), ("b", 0.01), ("c", 0))):
+            service.process_message({"method": "test", "args":
+                {"instance_uuid": uuid, "sleep": sleep, "n": n}},
+                TestMessage(acked))
+        service.pool.waitall()
+        events = service.listener.events
+        self.assertEqual(len(acked), 6)
+        self.assertEqual(service.partitions, {})
+        #slow "a" doesn't stop others
+        self.assertEqual(events[:2], [2, 5])
+        #order within partition
+        self.assertEqual([n for n in events if n in (0, 1, 3)], [0, 1, 3])
+        self.assertEqual([n for n in events if n in (2, 4)], [2, 4])
+
+    def test_partition(self):
+        service = amqp.Service()
+        self.assertEqual(service.partition({"args": {"instance_uuid": "u",
+            "address": "1.1.1.1"}}), "u")
+        self.assertEqual(service.partition({"args": {"fixed_address": "1.1.1.1",
+            "floating_address": "2.2.2.2"}}), "2.2.2.2")
+        self.assertEqual(service.partition({"_context_project_id": "p",
+            "args": {}}), "p")
+        #run and terminate of instances sharing hostname are kept in order
+        self.assertEqual(service.partition({"_context_project_id": "p",
+            "args": {"instance_uuid": "u"}}), "p")
+
+    def test_batch(self):
+        FLAGS.dns_listener = "tests.test_amqp.BatchListener"
+        self.stubs.Set(FLAGS, "dns_amqp_batch_size", 3)
+        service = amqp.Service()
+        service.channel = TestChannel()
+        self.assertEqual(service.batch_timeout(), None)
+        for n in range(1, 5):
+            service.collect_message({"n": n}, TestMessage([], n))
+        self.assertEqual(service.listener.batches, [[{"n": 1}, {"n": 2}, {"n": 3}]])
+        self.assertEqual(service.channel.acks, [(3, True)])
+        self.assertTrue(0 < service.batch_timeout() <= 0.1)
+        service.process_batch()
+        self.assertEqual(service.listener.batches[1], [{"n": 4}])
+        self.assertEqual(service.channel.acks, [(3, True), (4, True)])
+
+    def test_batch_failures(self):
+        FLAGS.dns_listener = "tests.test_amqp.BatchListener"
+        self.stubs.Set(FLAGS, "dns_amqp_batch_size", 4)
+        service = amqp.Service()
+        service.channel = TestChannel()
+        redelivered = TestMessage([], 3)
+        redelivered.delivery_info = {"redelivered": True}
+        service.collect_message({"n": 1}, TestMessage([], 1))
+        service.collect_message({"n": 2, "fail": True}, TestMessage([], 2))
+        service.collect_message({"n": 3, "fail": True}, redelivered)
+        service.collect_message({"n": 4}, TestMessage([], 4))
+        #failed messages are not rerun, requeued once, then rejected
+        self.assertEqual(len(service.listener.batches), 1)
+        self.assertEqual(service.channel.rejects, [(2, True), (3, False)])
+        self.assertEqual(service.channel.acks, [(4, True)])
+        service.collect_message({"n": 5, "fail": True}, TestMessage([], 5))
+        service.process_batch()
+        self.assertEqual(service.channel.acks, [(4, True)])
+        self.assertEqual(service.channel.rejects[-1], (5, True))
+
@@ -23,14 +23,120 @@ import json
 import datetime
 import unittest
 import stubout
+import tempfile
 
+import eventlet
+import webob
+
+from nova import flags
 from nova_dns import auth 
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import tests
 
+FLAGS = flags.FLAGS
+
+PASTE_CONFIG = """
+[filter:authtoken]
+auth_protocol = http
+auth_host = 127.0.0.1
+auth_port = 35357
+admin_user = admin
+admin_password = openstack
+admin_tenant_name = openstack
+"""
+
+class Tenant():
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+class TestTenants():
+    def __init__(self):
+        self.tenants = {}
+        self.calls = []
+    def get(self, id):
+        self.calls.append(id)
+        if id not in self.tenants:
+            raise auth.keystone_exceptions.NotFound(404)
+        return Tenant(id, self.tenants[id])
+
+class TestClient():
+    def __init__(self, **kwargs):
+        self.tenants = TestTenants()
+
 class TestCase(tests.TestCase):
-    pass
     #TODO to be done after changing auth model to acl 
-    
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.config = tempfile.NamedTemporaryFile()
+        self.config.write(PASTE_CONFIG)
+        self.config.flush()
+        self.stubs.Set(FLAGS, 'dns_api_paste_config', self.config.name)
+        self.stubs.Set(auth.keystone_client, 'Client', TestClient)
+        self.auth = auth.KeystoneAuth()
+        self.tenants = self.auth.client.tenants
+
+    def tearDown(self):
+        self.config.close()
+        super(TestCase, self).tearDown()
+
+    def test_tenant_cache(self):
+        self.tenants.tenants['t1'] = 'Tenant1'
+        for i in range(3):
+            self.assertEqual(self.auth.tenant2zonename('t1'),
+                'tenant1.' + FLAGS.dns_zone)
+        self.assertEqual(self.tenants.calls, ['t1'])
+        #unknown tenants are remembered too
+        for i in range(3):
+            self.assertRaises(ValueError, self.auth.tenant2zonename, 'bad')
+        self.assertEqual(self.tenants.calls, ['t1', 'bad'])
+
+    def test_tenant_cache_refresh(self):
+        self.tenants.tenants['t1'] = 'Tenant1'
+        self.auth.tenant2zonename('t1')
+        self.tenants.tenants['t1'] = 'Renamed'
+        self.auth.tenants.set('t1', 'Tenant1', -1)
+        #stale name is served while refreshed in background
+        self.assertEqual(self.auth.tenant2zonename('t1'),
+            'tenant1.' + FLAGS.dns_zone)
+        eventlet.sleep(0)
+        self.assertEqual(self.auth.tenant2zonename('t1'),
+            'renamed.' + FLAGS.dns_zone)
+        self.assertEqual(self.auth.refreshing, set())
+
+    def test_tenant_cache_size(self):
+        self.stubs.Set(self.auth, 'tenants', auth.LRUCache(2, 60))
+        for id in ('t1', 't2', 't3'):
+            self.tenants.tenants[id] = id
+            self.auth.tenant2zonename(id)
+        self.assertEqual(len(self.auth.tenants), 2)
+        self.assertFalse('t1' in self.auth.tenants)
+
+    def test_tenant_cache_disabled(self):
+        self.stubs.Set(self.auth, 'tenants', auth.LRUCache(0, 60))
+        self.tenants.tenants['t1'] = 't1'
+        self.assertEqual(self.auth.tenant2zonename('t1'), 't1.' + FLAGS.dns_zone)
+        self.assertEqual(len(self.auth.tenants), 0)
+        self.assertEqual(self.auth.tenants.get('t1'), None)
+
+    def test_can(self):
+        self.tenants.tenants['t1'] = 'Tenant1'
+        def can(zone_name, roles, tenant='t1'):
+            req = webob.Request.blank('/')
+            req.headers['X_ROLE'] = roles
+            req.headers['X_TENANT_ID'] = tenant
+            return self.auth.can(req, zone_name)
+        zone = 'tenant1.' + FLAGS.dns_zone
+        self.assertEqual(can(zone, 'Admin'), {"read": True, "write": True})
+        self.assertEqual(can(zone, 'Member'), {"read": True, "write": False})
+        for i in range(3):
+            self.assertEqual(can(zone, 'Member, DNS_Admin'),
+                {"read": True, "write": True})
+        self.assertEqual(can('other.' + FLAGS.dns_zone, 'DNS_Admin'),
+            {"read": True, "write": False})
+        self.assertRaises(ValueError, can, zone, 'DNS_Admin', 'bad')
+        self.assertEqual(self.tenants.calls, ['t1', 'bad'])
+        self.assertEqual(self.auth.stats["calls"], 7)
+        self.assertEqual(self.auth.stats["hits"], 2)
@@ -26,6 +26,8 @@ import webob
 import urllib
 
 from nova_dns import dns 
+from nova_dns import metrics
+from nova_dns.dnsmanager import DNSZone, DNSRecord
 
 from nova import flags
 FLAGS = flags.FLAGS
@@ -39,6 +41,15 @@ soa =   dict(retry="1", primary="ns.localhost", refresh="3", expire="4", ttl="5"
 add =   dict(content="1", ttl=2, priority=3)
 
 class TestManager():
+    instances = 0
+    released = 0
+
+    def __init__(self):
+        TestManager.instances += 1
+
+    def release(self):
+        TestManager.released += 1
+
     def list(self):
         return zones
 
@@ -54,13 +65,18 @@ class TestManager():
         return TestZone(zone_name)
 
 
-class TestZone():
+class TestZone(DNSZone):
+    serial = None
     def __init__(self, zone_name):
         self.zone_name = zone_name
+    def get_serial(self):
+        return self.serial
+    def to_dict(self):
+        return self.__dict__
     def drop(self):
         pass
     def add(self, v):
-        return [self.zone_name, v.__dict__]
+        return [self.zone_name, v.to_dict()]
     def get(self, name, type=None):
         self.name = name
         self.type = type 
@@ -69,6 +85,9 @@ class TestZone():
         return [self.zone_name, name, type, content, priority, ttl] 
     def delete(self, name, type):
         return [self.zone_name, name, type] 
+    def apply(self, changes):
+        return [{"result": [c[0], c[1].to_dict()] if c[0] == "add" else list(c),
+            "error": None} for c in changes]
 
 class TestAuth():
     read = False
@@ -77,12 +96,15 @@ class TestAuth():
         return {"read": self.read, "write": self.write}
 
 class TestCase(tests.TestCase):
-    def req(self, path, status=200, error=None, method='GET', params=None):
+    def req(self, path, status=200, error=None, method='GET', params=None,
+            body=None):
         #FIXME - hardcoded api-paste chain
         query = "%s?%s" % (path, urllib.urlencode(params)) if params else path
         print query
         request = webob.Request.blank(query)
         request.method = method
+        if body is not None:
+            request.body = json.dumps(body)
         res = request.get_response(dns.VersionFilter(dns.App()))
         self.assertEqual(res.status_int, status, "path %s: status %d != %d" % 
             (path, res.status_int, status))
@@ -142,4 +164,104 @@ class TestCase(tests.TestCase):
         self.assertEqual(self.req('/record/testzone/some/MX', method='DELETE'),
             ['testzone', 'some', 'MX'])
 
+        self.assertEqual(self.req('/record/testzone/_bulk', method='POST', body=[
+                dict(action='add', name='@', type='A', content='1'),
+                dict(action='edit', name='some', type='MX', ttl=2),
+                dict(action='delete', name='some', type='A'),
+                dict(action='add', name='x', type='INCORRECT', content='1'),
+                dict(action='rename', name='x')]), [
+            dict(result=['add', dict(name='', type='A', content='1',
+                priority=0, ttl=7200)], error=None),
+            dict(result=['set', 'some', 'MX', None, None, 2], error=None),
+            dict(result=['delete', 'some', 'A'], error=None),
+            dict(result=None, error='Incorrect type: INCORRECT'),
+            dict(result=None, error='Incorrect action: rename')])
+        self.req('/record/testzone/_bulk', method='POST', body={},
+            error='List of operations expected')
+
+    def test_shared_controller(self):
+        FLAGS.dns_manager = "tests.test_dns.TestManager"
+        dns.AUTH = TestAuth()
+        instances = TestManager.instances
+        released = TestManager.released
+        app = dns.VersionFilter(dns.App())
+        #manager is created on first request
+        self.assertEqual(TestManager.instances, instances)
+        for path in ('/zone/', '/zone/test', '/record/test'):
+            webob.Request.blank(path).get_response(app).body
+        self.assertEqual(TestManager.instances, instances + 1)
+        self.assertEqual(TestManager.released, released + 3)
+
+    def test_stream_closed_unread(self):
+        FLAGS.dns_manager = "tests.test_dns.TestManager"
+        dns.AUTH = TestAuth()
+        released = TestManager.released
+        environ = webob.Request.blank('/record/testzone').environ
+        app_iter = dns.App()(environ, lambda status, headers: None)
+        self.assertEqual(TestManager.released, released)
+        #client gone before body was sent
+        app_iter.close()
+        self.assertEqual(TestManager.released, released + 1)
+
+    def test_list_pages(self):
+        FLAGS.dns_manager = "tests.test_dns.TestManager"
+        dns.AUTH = TestAuth()
+        self.stubs.Set(TestZone, 'get', lambda self, name, type=None:
+            [DNSRecord(name='r%d' % i, type='A', content='10.0.0.%d' % i)
+             for i in range(5)])
+        request = webob.Request.blank('/record/testzone?limit=2&marker=0')
+        res = json.loads(request.get_response(dns.App()).body)
+        self.assertEqual([r['name'] for r in res['result']], ['r1', 'r2'])
+        self.assertEqual(res['next_marker'], 2)
+        request = webob.Request.blank('/record/testzone?limit=2&marker=2')
+        res = json.loads(request.get_response(dns.App()).body)
+        self.assertEqual([r['name'] for r in res['result']], ['r3', 'r4'])
+        request = webob.Request.blank('/record/testzone?limit=2&marker=4')
+        res = json.loads(request.get_response(dns.App()).body)
+        self.assertEqual(res, {"result": [], "error": None})
+        self.req('/record/testzone', params={'limit': 'x'},
+            error="invalid literal for int() with base 10: 'x'")
+
+    def test_conditional_get(self):
+        FLAGS.dns_manager = "tests.test_dns.TestManager"
+        dns.AUTH = TestAuth()
+        self.stubs.Set(TestZone, 'serial', 1329319594)
+        app = dns.App()
+        res = webob.Request.blank('/record/testzone').get_response(app)
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(res.headers['ETag'], '"1329319594"')
+        self.assertEqual(res.headers['Last-Modified'],
+            'Wed, 15 Feb 2012 15:26:34 GMT')
+        request = webob.Request.blank('/record/testzone',
+            headers={'If-None-Match': '"1329319594"'})
+        self.assertEqual(request.get_response(app).status_int, 304)
+        request = webob.Request.blank('/record/testzone',
+            headers={'If-None-Match': '"1329319593"'})
+        self.assertEqual(request.get_response(app).status_int, 200)
+        request = webob.Request.blank('/record/testzone',
+            headers={'If-Modified-Since': res.headers['Last-Modified']})
+        self.assertEqual(request.get_response(app).status_int, 304)
+        self.stubs.Set(TestZone, 'serial', 2012021501)
+        res = webob.Request.blank('/record/testzone').get_response(app)
+        self.assertEqual(res.headers['ETag'], '"2012021501"')
+        self.assertFalse('Last-Modified' in res.headers)
 
+
+    def test_metrics(self):
+        FLAGS.dns_manager = "tests.test_dns.TestManager"
+        dns.AUTH = TestAuth()
+        ok = dns.REQUESTS.get(action="index", result="ok")
+        errors = dns.REQUESTS.get(action="zone_add", result="error")
+        app = dns.VersionFilter(dns.App())
+        webob.Request.blank('/zone/').get_response(app)
+        self.req('/zone/error', method='PUT', error="test error")
+        self.assertEqual(dns.REQUESTS.get(action="index", result="ok"), ok + 1)
+        self.assertEqual(dns.REQUESTS.get(action="zone_add", result="error"),
+            errors + 1)
+        #served by metrics app of paste urlmap, without auth
+        self.assertEqual(webob.Request.blank('/metrics').get_response(app
+            ).status_int, 404)
+        res = webob.Request.blank('/metrics').get_response(metrics.App())
+        self.assertEqual(res.status_int, 200)
+        self.assertTrue('nova_dns_api_requests_total{action="index",'
+            'result="ok"} %d\n' % (ok + 1) in res.body)
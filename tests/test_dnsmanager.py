@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+from nova_dns.dnsmanager import DNSRecord, DNSSOARecord, RecordTuple
+
+from nova import flags
+FLAGS = flags.FLAGS
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+
+class TestCase(tests.TestCase):
+    def test_record(self):
+        rec = DNSRecord(name='WWW', type='a', content='10.0.0.1')
+        self.assertEqual(rec.to_dict(), dict(name='www', type='A',
+            content='10.0.0.1', priority=0, ttl=FLAGS.dns_default_ttl))
+        self.assertFalse(hasattr(rec, '__dict__'))
+        self.assertEqual(DNSRecord.normtype('Mx'), 'MX')
+        self.assertRaises(ValueError, DNSRecord.normtype, 'INCORRECT')
+        self.assertRaises(ValueError, DNSRecord.normname, 'bad name')
+        self.assertEqual(DNSRecord.normname('*'), '*')
+
+    def test_soa_record(self):
+        soa = DNSSOARecord('ns1', 'hostmaster', '5')
+        self.assertEqual(soa.to_dict()['serial'], '5')
+        self.assertEqual(soa.to_dict()['type'], 'SOA')
+        self.assertEqual(len(soa.to_dict()), 11)
+
+    def test_record_tuple(self):
+        rec = RecordTuple(name='WWW', type='a', content='10.0.0.1',
+            priority='10')
+        self.assertEqual(rec.to_dict(), DNSRecord(name='www', type='A',
+            content='10.0.0.1', priority=10).to_dict())
+        self.assertEqual((rec.name, rec.priority), ('www', 10))
+        self.assertRaises(ValueError, RecordTuple, 'bad name', 'A', '1')
@@ -0,0 +1,333 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import shutil
+import tempfile
+
+import eventlet.event
+import sqlalchemy.event
+
+from nova import flags
+FLAGS = flags.FLAGS
+FLAGS.sql_connection = "sqlite://"
+FLAGS.dns_sql_connection = "sqlite://"
+
+from nova.db.sqlalchemy.session import get_engine
+from nova_dns import auth
+from nova_dns import metrics
+from nova_dns.dnsmanager import powerdns
+from nova_dns.dnsmanager.powerdns import pipeline
+from nova_dns.dnsmanager import DNSRecord
+from nova_dns.dnsmanager.powerdns.models import Domains, Records
+from nova_dns.listener import simple
+from nova_dns.listener.simple import sync
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+STATEMENTS = []
+sqlalchemy.event.listen(get_engine(), "before_cursor_execute",
+    lambda conn, cursor, statement, *args: STATEMENTS.append(statement))
+
+
+class TestCase(tests.TestCase):
+    def setUp(self):
+        super(TestCase, self).setUp()
+        FLAGS.dns_manager = "nova_dns.dnsmanager.powerdns.Manager"
+        self.stubs.Set(simple, 'AUTH', auth.NoAuth())
+        self.stubs.Set(pipeline.subprocess, 'call', lambda args: 0)
+        self.geomaps_dir = tempfile.mkdtemp()
+        FLAGS.dns_powerdns_geomaps_dir = self.geomaps_dir
+        conn = get_engine()
+        conn.execute("drop table if exists instances")
+        conn.execute("drop table if exists fixed_ips")
+        conn.execute("create table instances (id integer primary key, "
+            "uuid varchar(36), hostname varchar(255), project_id varchar(255), "
+            "deleted boolean default 0)")
+        conn.execute("create table fixed_ips (id integer primary key, "
+            "address varchar(39), instance_id integer)")
+        self.listener = simple.Listener()
+        self.listener.eventlet.kill()
+        self.listener.sync_thread.kill()
+        self.dnsmanager = self.listener.dnsmanager
+        self.dnsmanager.session.query(Records).delete()
+        self.dnsmanager.session.query(Domains).delete()
+        self.dnsmanager.invalidate()
+
+    def tearDown(self):
+        shutil.rmtree(self.geomaps_dir)
+        super(TestCase, self).tearDown()
+
+    def add_instance(self, id, hostname, address=None, project_id='tenant'):
+        conn = get_engine()
+        conn.execute("insert into instances (id, uuid, hostname, project_id) "
+            "values (?, ?, ?, ?)", id, "uuid-%d" % id, hostname, project_id)
+        if address:
+            conn.execute("insert into fixed_ips (address, instance_id) "
+                "values (?, ?)", address, id)
+        self.listener.event({"method": "run_instance",
+            "args": {"instance_uuid": "uuid-%d" % id}})
+
+    def zone_records(self):
+        zone = self.dnsmanager.get('tenant.' + FLAGS.dns_zone)
+        return sorted((r.name.split('.')[0], r.content) for r in zone.get(type='A'))
+
+    def test_poll_pending(self):
+        self.stubs.Set(FLAGS, 'dns_poll_chunk', 2)
+        for i in range(1, 101):
+            self.add_instance(i, 'other%d' % i, '10.1.0.%d' % i)
+        self.listener.pending.clear()
+        self.add_instance(101, 'host1', '10.0.0.1')
+        self.add_instance(102, 'host2', '10.0.0.2')
+        self.add_instance(103, 'host3')
+        del STATEMENTS[:]
+        self.assertEqual(self.listener._poll_pending(self.listener.pending.keys()), 2)
+        #only pending instances are queried, in chunks
+        self.assertEqual(len(STATEMENTS), 2)
+        self.assertEqual(self.listener.pending.keys(), ['uuid-103'])
+        self.assertEqual(self.zone_records(),
+            [('host1', '10.0.0.1'), ('host2', '10.0.0.2')])
+
+    def test_network_events(self):
+        self.add_instance(1, 'host1', '10.0.0.1')
+        self.add_instance(2, 'host2')
+        #poller waits on allocation messages first
+        self.assertEqual(self.listener._overdue(), [])
+        self.listener.event({"method": "allocate_for_instance",
+            "args": {"instance_uuid": "uuid-1"}})
+        self.assertEqual(self.zone_records(), [('host1', '10.0.0.1')])
+        get_engine().execute("insert into fixed_ips (address, instance_id) "
+            "values ('10.0.0.2', 2)")
+        self.listener.event({"method": "lease_fixed_ip",
+            "args": {"address": "10.0.0.2"}})
+        self.assertEqual(self.zone_records(),
+            [('host1', '10.0.0.1'), ('host2', '10.0.0.2')])
+        self.assertEqual(self.listener.pending, {})
+
+    def test_allocation_retry(self):
+        self.add_instance(1, 'host1')
+        spawned = []
+        self.stubs.Set(simple.eventlet, 'spawn', spawned.append)
+        self.listener.wakeup = eventlet.event.Event()
+        self.listener.event({"method": "allocate_for_instance",
+            "args": {"instance_uuid": "uuid-1"}})
+        #address isn't stored yet, the poller is woken to retry it
+        self.assertEqual(spawned, [])
+        self.assertTrue(self.listener.wakeup.ready())
+        self.assertEqual(self.listener._overdue(), ['uuid-1'])
+        get_engine().execute("insert into fixed_ips (address, instance_id) "
+            "values ('10.0.0.1', 1)")
+        self.assertEqual(self.listener._poll_pending(self.listener._overdue()), 1)
+        #instance taken from pending isn't added again
+        self.assertEqual(self.listener._poll_pending(['uuid-1']), 0)
+        self.assertEqual(self.zone_records(), [('host1', '10.0.0.1')])
+        self.assertEqual(self.listener._overdue(), [])
+        self.assertEqual(self.listener.allocated, set())
+
+    def test_overdue(self):
+        self.add_instance(1, 'host1')
+        self.listener.pending['uuid-1'] -= FLAGS.dns_network_event_timeout + 1
+        self.assertEqual(self.listener._overdue(), ['uuid-1'])
+        self.stubs.Set(FLAGS, 'dns_network_events', False)
+        self.add_instance(2, 'host2')
+        self.assertEqual(sorted(self.listener._overdue()), ['uuid-1', 'uuid-2'])
+
+    def test_events_terminate(self):
+        for i in range(1, 6):
+            self.add_instance(i, 'host%d' % i, '10.0.0.%d' % i)
+        self.listener._poll_pending(self.listener.pending.keys())
+        self.assertEqual(len(self.zone_records()), 5)
+        del STATEMENTS[:]
+        errors = self.listener.events([{"method": "terminate_instance",
+            "args": {"instance_uuid": "uuid-%d" % i}} for i in (1, 2, 3, 42)] + [
+            {"method": "run_instance", "args": {"instance_uuid": "uuid-6"}},
+            {"method": "terminate_instance", "args": {"instance_uuid": "uuid-4"}}])
+        #one nova query per group of terminate_instance
+        self.assertEqual(len(STATEMENTS), 2)
+        self.assertEqual(self.zone_records(), [('host5', '10.0.0.5')])
+        self.assertEqual(self.listener.pending.keys(), ['uuid-6'])
+        self.assertEqual(errors, [None] * 6)
+
+    def test_events_errors(self):
+        self.add_instance(1, 'host1', '10.0.0.1')
+        errors = self.listener.events([
+            {"method": "associate_floating_ip", "args": {
+                "fixed_address": "10.9.9.9", "floating_address": "1.1.1.1"}},
+            {"method": "allocate_for_instance",
+                "args": {"instance_uuid": "uuid-1"}}])
+        #failed event doesn't stop the rest of the batch
+        self.assertTrue(errors[0] is not None)
+        self.assertEqual(errors[1:], [None])
+        self.assertEqual(self.zone_records(), [('host1', '10.0.0.1')])
+
+    def test_replace_records(self):
+        self.stubs.Set(FLAGS, 'dns_ptr', True)
+        self.add_instance(1, 'host1', '10.0.0.1')
+        self.listener._poll_pending(self.listener.pending.keys())
+        changesets = []
+        apply = powerdns.PowerDNSZone.apply
+        self.stubs.Set(powerdns.PowerDNSZone, 'apply', lambda zone, changes:
+            changesets.append((zone.zone_name, [c[0] for c in changes])) or
+            apply(zone, changes))
+        #new instance reuses the hostname
+        self.add_instance(2, 'host1', '10.0.0.2')
+        self.listener._poll_pending(self.listener.pending.keys())
+        self.assertEqual(self.zone_records(), [('host1', '10.0.0.2')])
+        ptr_zone, octet = self.listener.ip2zone('10.0.0.2')
+        self.assertEqual([(r.name, r.content) for r in
+            self.dnsmanager.get(ptr_zone).get(type='PTR')],
+            [('%s.%s' % (octet, ptr_zone), 'host1.tenant.' + FLAGS.dns_zone)])
+        #A and PTR are replaced with one changeset each
+        self.assertEqual(changesets, [
+            ('tenant.' + FLAGS.dns_zone, ['delete', 'add']),
+            (ptr_zone, ['delete', 'delete', 'add'])])
+
+    def test_terminate_keeps_reused_ptr(self):
+        self.stubs.Set(FLAGS, 'dns_ptr', True)
+        self.add_instance(1, 'host1', '10.0.0.1')
+        self.listener._poll_pending(self.listener.pending.keys())
+        #address is given to new instance before old one's terminate is seen
+        self.add_instance(2, 'host2', '10.0.0.1')
+        self.listener._poll_pending(self.listener.pending.keys())
+        self.listener.event({"method": "terminate_instance",
+            "args": {"instance_uuid": "uuid-1"}})
+        self.assertEqual(self.zone_records(), [('host2', '10.0.0.1')])
+        ptr_zone, octet = self.listener.ip2zone('10.0.0.1')
+        self.assertEqual([r.content for r in
+            self.dnsmanager.get(ptr_zone).get(type='PTR')],
+            ['host2.tenant.' + FLAGS.dns_zone])
+        self.listener.event({"method": "terminate_instance",
+            "args": {"instance_uuid": "uuid-2"}})
+        self.assertEqual(self.dnsmanager.get(ptr_zone).get(type='PTR'), [])
+
+    def test_sync(self):
+        zone_name = 'tenant.' + FLAGS.dns_zone
+        conn = get_engine()
+        for id, hostname, address in ((1, 'a', '10.0.0.1'),
+                (2, 'a-b', '10.0.0.2'), (3, 'host3', '10.0.0.3'),
+                (4, 'host4', '10.0.0.4'), (5, 'host5', '10.0.0.5')):
+            conn.execute("insert into instances (id, uuid, hostname, "
+                "project_id) values (?, ?, ?, 'tenant')", id, "uuid-%d" % id,
+                hostname)
+            conn.execute("insert into fixed_ips (address, instance_id) "
+                "values (?, ?)", address, id)
+        conn.execute("update instances set deleted=1 where id=5")
+        self.listener._add_zone(zone_name)
+        self.dnsmanager.get(zone_name).add_many([
+            DNSRecord(name='', type='A', content='10.0.1.1'),
+            DNSRecord(name='www.x', type='A', content='10.0.1.2'),
+            DNSRecord(name='host3', type='A', content='10.0.0.3'),
+            DNSRecord(name='host4', type='A', content='10.0.0.9'),
+            DNSRecord(name='host5', type='A', content='10.0.0.5')])
+        self.listener._add_zone('other.' + FLAGS.dns_zone)
+        self.dnsmanager.get('other.' + FLAGS.dns_zone).add(
+            DNSRecord(name='gone', type='A', content='10.0.2.1'))
+        stats = self.listener.reconciler.run()
+        self.assertEqual(dict((k, stats[k]) for k in ('zones', 'hosts',
+            'added', 'changed', 'stale', 'deleted', 'errors')),
+            dict(zones=2, hosts=4, added=2, changed=1, stale=2, deleted=0,
+                errors=0))
+        #apex and deeper names are not instance records
+        self.assertEqual(self.zone_records(), [('a', '10.0.0.1'),
+            ('a-b', '10.0.0.2'), ('host3', '10.0.0.3'), ('host4', '10.0.0.4'),
+            ('host5', '10.0.0.5'), ('tenant', '10.0.1.1'),
+            ('www', '10.0.1.2')])
+        self.stubs.Set(FLAGS, 'dns_sync_delete', True)
+        self.stubs.Set(FLAGS, 'dns_poll_chunk', 1)
+        stats = self.listener.reconciler.run()
+        self.assertEqual((stats['added'], stats['changed'], stats['stale'],
+            stats['deleted'], stats['errors']), (0, 0, 2, 2, 0))
+        self.assertEqual([r[0] for r in self.zone_records()],
+            ['a', 'a-b', 'host3', 'host4', 'tenant', 'www'])
+        self.assertEqual(self.dnsmanager.get('other.' + FLAGS.dns_zone).get(
+            type='A'), [])
+
+    def test_sync_terminate_race(self):
+        self.stubs.Set(FLAGS, 'dns_ptr', True)
+        zone_name = 'tenant.' + FLAGS.dns_zone
+        self.listener._add_zone(zone_name)
+        self.add_instance(1, 'host1', '10.0.0.1')
+        self.add_instance(2, 'host2', '10.0.0.2')
+        self.listener.pending.clear()
+        records = sync.Reconciler._records
+
+        def terminate(reconciler, zone, zonename):
+            #nova rows are read already, host1 is terminated meanwhile
+            get_engine().execute("update instances set deleted=1 where id=1")
+            self.listener.event({"method": "terminate_instance",
+                "args": {"instance_uuid": "uuid-1"}})
+            return records(reconciler, zone, zonename)
+
+        self.stubs.Set(sync.Reconciler, '_records', terminate)
+        stats = self.listener.reconciler.run()
+        self.assertEqual((stats['added'], stats['skipped']), (2, 1))
+        self.assertEqual(self.zone_records(), [('host2', '10.0.0.2')])
+        ptr_zone, octet = self.listener.ip2zone('10.0.0.1')
+        self.assertEqual([r.content for r in
+            self.dnsmanager.get(ptr_zone).get(type='PTR')],
+            ['host2.' + zone_name])
+        self.assertEqual(self.listener.touched, None)
+
+    def test_sync_pages(self):
+        conn = get_engine()
+        for id, project_id, hostname in ((1, 'p2', 'a'), (2, 'p1', 'b'),
+                (3, 'p1', 'a'), (4, 'p1', 'c')):
+            conn.execute("insert into instances (id, uuid, hostname, "
+                "project_id) values (?, ?, ?, ?)", id, "uuid-%d" % id,
+                hostname, project_id)
+        for address, id in (('10.0.0.1', 1), ('10.0.0.3', 3),
+                ('10.0.0.2', 2), ('10.0.1.3', 3), ('10.0.0.4', 4)):
+            conn.execute("insert into fixed_ips (address, instance_id) "
+                "values (?, ?)", address, id)
+        self.stubs.Set(FLAGS, 'dns_poll_chunk', 2)
+        del STATEMENTS[:]
+        rows = list(self.listener.reconciler._nova_rows())
+        #pages of 2 rows, last one is short
+        self.assertEqual(len(STATEMENTS), 3)
+        self.assertEqual([(r.project_id, r.hostname, r.address) for r in rows],
+            [('p1', 'a', '10.0.0.3'), ('p1', 'a', '10.0.1.3'),
+             ('p1', 'b', '10.0.0.2'), ('p1', 'c', '10.0.0.4'),
+             ('p2', 'a', '10.0.0.1')])
+
+    def test_merge(self):
+        self.assertEqual(list(sync.merge(iter([(1, 'a'), (3, 'c')]),
+            iter([(2, 'B'), (3, 'C')]))),
+            [(1, 'a', None), (2, None, 'B'), (3, 'c', 'C')])
+        self.assertRaises(ValueError, list,
+            sync.ordered(iter([(2, 'b'), (1, 'a')]), 'Test'))
+
+
+    def test_metrics(self):
+        added = simple.RECORDS.get(action="added")
+        deleted = simple.RECORDS.get(action="deleted")
+        propagated = simple.PROPAGATION_SECONDS.get()[0]
+        self.add_instance(1, 'host1', '10.0.0.1')
+        self.assertTrue("nova_dns_listener_pending 1\n" in metrics.render())
+        self.listener.event({"method": "allocate_for_instance",
+            "args": {"instance_uuid": "uuid-1"}})
+        self.listener.event({"method": "terminate_instance",
+            "args": {"instance_uuid": "uuid-1"}})
+        self.assertEqual(simple.RECORDS.get(action="added"), added + 1)
+        self.assertEqual(simple.RECORDS.get(action="deleted"), deleted + 1)
+        self.assertEqual(simple.PROPAGATION_SECONDS.get()[0], propagated + 1)
+        self.assertTrue("nova_dns_listener_pending 0\n" in metrics.render())
+        self.assertTrue('nova_dns_sql_seconds_count{statement="INSERT"}'
+            in metrics.render())
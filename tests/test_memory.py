@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+
+from nova import flags
+FLAGS = flags.FLAGS
+
+from nova_dns.dnsmanager import DNSRecord, RecordTuple
+from nova_dns.dnsmanager import memory
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+
+class TestCase(tests.TestCase):
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.stubs.Set(memory, '_STORE', memory.Store())
+        self.manager = memory.Manager()
+
+    def test_zones(self):
+        self.manager.add('example.com')
+        self.manager.add('sub.example.com')
+        self.assertEqual(sorted(self.manager.list()),
+            ['example.com', 'sub.example.com'])
+        self.assertRaises(Exception, self.manager.add, 'example.com')
+        self.assertRaises(Exception, self.manager.get, 'other.com')
+        self.assertEqual(memory.Manager().list(), self.manager.list())
+        self.assertRaises(Exception, self.manager.drop, 'example.com')
+        self.manager.drop('example.com', force=True)
+        self.assertEqual(self.manager.list(), [])
+
+    def test_records(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        serial = zone.get_serial()
+        zone.add(DNSRecord('www', 'A', '10.0.0.1'))
+        zone.add(RecordTuple('www', 'TXT', 'text'))
+        self.assertTrue(zone.get_serial() > serial)
+        self.assertEqual([(r.name, r.type) for r in zone.get('www')],
+            [('www.example.com', 'A'), ('www.example.com', 'TXT')])
+        self.assertEqual([r.content for r in zone.get(type='a')], ['10.0.0.1'])
+        zone.set('www', 'A', '10.0.0.2', None, 60)
+        self.assertEqual([(r.content, r.ttl) for r in zone.get('www', 'A')],
+            [('10.0.0.2', 60)])
+        self.assertRaises(Exception, zone.set, 'ftp', 'A', '10.0.0.3')
+        self.assertEqual(self.manager.get_by_ip('10.0.0.1'), [])
+        self.assertEqual(self.manager.get_by_ip('10.0.0.2'),
+            [(u'www.example.com',)])
+        zone.delete('www')
+        self.assertEqual(zone.get('www'), [])
+        self.assertRaises(Exception, zone.delete, 'www', 'A')
+        self.assertEqual([r.type for r in zone.get()], ['SOA'])
+
+    def test_apply(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        results = zone.apply([("add", RecordTuple('a', 'A', '10.0.0.1')),
+            ("set", 'b', 'A', '10.0.0.2', None, None),
+            ("delete", 'a', 'A'),
+            ("bogus",)])
+        self.assertEqual([r["error"] is None for r in results],
+            [True, False, True, False])
+        zone.add_many([RecordTuple('h%d' % i, 'A', '10.0.1.%d' % i)
+            for i in range(10)])
+        ids = [id for id, r in zone.iter_records(type='A', limit=4)]
+        self.assertEqual(len(ids), 4)
+        rest = [r['name'] for id, r in zone.iter_records(type='A',
+            marker=ids[-1])]
+        self.assertEqual(rest, ['h%d.example.com' % i for i in range(4, 10)])
+        self.assertEqual([n for n, c in zone.iter_names('A')][:2],
+            ['h0.example.com', 'h1.example.com'])
+        self.assertTrue(self.manager.drop_by_ip('10.0.1.3'))
+        self.assertRaises(Exception, self.manager.drop_by_ip, '10.0.1.3')
+        self.assertEqual(len(zone.get(type='A')), 9)
+
+    def test_duplicates(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add(RecordTuple('www', 'A', '10.0.0.1'))
+        self.assertRaisesRegexp(Exception,
+            r'Record \(www.example.com, A\) already exists',
+            zone.add, RecordTuple('WWW', 'A', '10.0.0.2'))
+        results = zone.apply([("add", RecordTuple('a', 'A', '10.0.0.3')),
+            ("add", RecordTuple('a', 'A', '10.0.0.4')),
+            ("add", RecordTuple('a', 'TXT', 'text'))])
+        self.assertEqual([r["error"] for r in results],
+            [None, 'Record (a.example.com, A) already exists', None])
+        self.assertEqual([r.content for r in zone.get(type='A')],
+            ['10.0.0.1', '10.0.0.3'])
+        self.assertEqual(self.manager.get_by_ip('10.0.0.2'), [])
+
+    def test_threads(self):
+        self.manager.add('example.com')
+
+        def add(n):
+            zone = memory.Manager().get('example.com')
+            for i in range(100):
+                zone.add(RecordTuple('t%d-%d' % (n, i), 'A',
+                    '10.%d.0.%d' % (n, i)))
+
+        threads = [threading.Thread(target=add, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.manager.get('example.com').get(type='A')),
+            800)
+        self.assertEqual(len(memory.get_store().ips), 800)
+
+    def test_snapshot(self):
+        path = os.path.join(tempfile.mkdtemp(), 'zones.json')
+        try:
+            self.stubs.Set(memory, '_STORE', memory.Store(path))
+            manager = memory.Manager()
+            manager.add('example.com')
+            manager.get('example.com').add(RecordTuple('a', 'MX', 'mx', 10))
+            self.assertFalse(os.path.exists(path))
+            manager.release()
+            self.assertTrue(os.path.exists(path))
+            store = memory.Store(path)
+            self.assertFalse(store.dirty)
+            self.assertEqual(store.dump(), memory.get_store().dump())
+        finally:
+            shutil.rmtree(os.path.dirname(path))
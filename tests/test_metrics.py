@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+import webob
+
+from nova_dns import metrics
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+
+class TestCase(tests.TestCase):
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.registry = metrics.Registry()
+
+    def test_counter_gauge(self):
+        c = self.registry.counter("test_total", "Test counter", ("kind",))
+        c.inc(kind="a")
+        c.inc(2, kind="b")
+        c.inc(kind="a")
+        self.assertEqual(c.get(kind="a"), 2)
+        self.assertRaises(ValueError, c.inc, other="a")
+        self.assertTrue(self.registry.counter("test_total", "") is c)
+        self.assertRaises(ValueError, self.registry.gauge, "test_total", "")
+        g = self.registry.gauge("test_size", "Test gauge", fn=lambda: 3)
+        self.assertEqual(self.registry.render(),
+            "# HELP test_size Test gauge\n"
+            "# TYPE test_size gauge\n"
+            "test_size 3\n"
+            "# HELP test_total Test counter\n"
+            "# TYPE test_total counter\n"
+            'test_total{kind="a"} 2\n'
+            'test_total{kind="b"} 2\n')
+        #latest function wins
+        self.registry.gauge("test_size", "Test gauge", fn=lambda: 5)
+        self.assertTrue("test_size 5\n" in self.registry.render())
+
+    def test_histogram(self):
+        h = self.registry.histogram("test_seconds", "Test histogram",
+            ("op",), buckets=(0.1, 1))
+        h.observe(0.05, op="get")
+        h.observe(0.5, op="get")
+        h.observe(5, op="get")
+        with h.time(op="set"):
+            pass
+        self.assertEqual(h.get(op="get"), (3, 5.55))
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:7], [
+            'test_seconds_bucket{op="get",le="0.1"} 1',
+            'test_seconds_bucket{op="get",le="1"} 2',
+            'test_seconds_bucket{op="get",le="+Inf"} 3',
+            'test_seconds_sum{op="get"} 5.55',
+            'test_seconds_count{op="get"} 3'])
+        self.assertEqual(lines[-1], 'test_seconds_count{op="set"} 1')
+
+    def test_app(self):
+        metrics.counter("nova_dns_test_total", "Test").inc()
+        res = webob.Request.blank("/metrics").get_response(metrics.App())
+        self.assertEqual(res.content_type, "text/plain")
+        self.assertTrue("nova_dns_test_total 1\n" in res.body)
+        metrics.unregister("nova_dns_test_total")
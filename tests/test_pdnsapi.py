@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+from nova import flags
+FLAGS = flags.FLAGS
+
+from nova_dns.dnsmanager import DNSRecord, RecordTuple
+from nova_dns.dnsmanager import pdnsapi
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+from tests import pdns_stub
+
+
+class TestCase(tests.TestCase):
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.server = pdns_stub.Server()
+        FLAGS.dns_pdnsapi_url = self.server.url
+        FLAGS.dns_pdnsapi_key = self.server.key
+        self.stubs.Set(pdnsapi, '_CLIENT', None)
+        self.manager = pdnsapi.Manager()
+
+    def tearDown(self):
+        self.server.stop()
+        super(TestCase, self).tearDown()
+
+    def test_zones(self):
+        self.manager.add('example.com')
+        self.manager.add('sub.example.com')
+        self.assertEqual(sorted(self.manager.list()),
+            ['example.com', 'sub.example.com'])
+        self.assertRaises(Exception, self.manager.add, 'example.com')
+        self.assertRaises(Exception, self.manager.get, 'other.com')
+        soa = self.manager.get('example.com').get_soa()
+        self.assertEqual(soa.primary, FLAGS.dns_soa_primary)
+        self.assertRaises(Exception, self.manager.drop, 'example.com')
+        self.manager.drop('example.com', force=True)
+        self.assertEqual(self.manager.list(), [])
+
+    def test_records(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        serial = zone.get_serial()
+        zone.add(DNSRecord('www', 'A', '10.0.0.1'))
+        zone.add(RecordTuple('', 'MX', 'mail.example.com', 10))
+        self.assertNotEqual(zone.get_serial(), serial)
+        mx = zone.get('', 'MX')[0]
+        self.assertEqual((mx.name, mx.content, mx.priority),
+            ('example.com', 'mail.example.com', 10))
+        self.assertEqual(self.server.zones['example.com.']['rrsets']
+            [('example.com.', 'MX')]['records'][0]['content'],
+            '10 mail.example.com.')
+        zone.set('www', 'A', '10.0.0.2')
+        self.assertEqual([r.content for r in zone.get('www')], ['10.0.0.2'])
+        self.assertEqual(zone.get('www')[0].ttl, FLAGS.dns_default_ttl)
+        self.assertRaises(Exception, zone.set, 'ftp', 'A', '10.0.0.3')
+        zone.delete('www')
+        self.assertEqual(zone.get('www'), [])
+        self.assertRaises(Exception, zone.delete, 'www', 'A')
+
+    def test_apply_one_patch(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        del self.server.requests[:]
+        results = zone.apply([("add", RecordTuple('a', 'A', '10.0.0.1')),
+            ("add", RecordTuple('b', 'A', '10.0.0.2')),
+            ("set", 'a', 'A', '10.0.0.3', None, None),
+            ("set", 'c', 'A', '10.0.0.4', None, None),
+            ("bogus",)])
+        self.assertEqual([r["error"] is None for r in results],
+            [True, True, True, False, False])
+        self.assertEqual([m for m, p in self.server.requests],
+            ['GET', 'PATCH'])
+        self.assertEqual([r.content for r in zone.get('a')], ['10.0.0.3'])
+        zone.add_many([RecordTuple('%d' % i, 'A', '10.0.1.%d' % i)
+            for i in range(50)])
+        self.assertEqual(len(zone.get(type='A')), 52)
+        #PATCH is atomic, error is reported for every change
+        self.stubs.Set(zone, 'zone_name', 'other.com')
+        results = zone.apply([("add", RecordTuple('d', 'A', '10.0.0.5'))])
+        self.assertTrue(results[0]["error"])
+
+    def test_duplicates(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add(DNSRecord('www', 'A', '10.0.0.1'))
+        self.assertRaisesRegexp(Exception,
+            r'Record \(www.example.com, A\) already exists',
+            zone.add, DNSRecord('www', 'A', '10.0.0.2'))
+        results = zone.apply([("add", RecordTuple('a', 'A', '10.0.0.3')),
+            ("add", RecordTuple('www', 'A', '10.0.0.4')),
+            ("add", RecordTuple('a', 'A', '10.0.0.5')),
+            ("add", RecordTuple('a', 'TXT', 'text')),
+            ("delete", 'www', 'A'),
+            ("add", RecordTuple('www', 'A', '10.0.0.6'))])
+        self.assertEqual([r["error"] for r in results], [None,
+            'Record (www.example.com, A) already exists',
+            'Record (a.example.com, A) already exists', None, None, None])
+        self.assertEqual(sorted((r.name, r.content) for r in zone.get(type='A')),
+            [('a.example.com', '10.0.0.3'), ('www.example.com', '10.0.0.6')])
+
+    def test_by_ip(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add_many([RecordTuple('a', 'A', '10.0.0.1'),
+            RecordTuple('b', 'A', '10.0.0.2')])
+        self.assertEqual(self.manager.get_by_ip('10.0.0.1'),
+            [('a.example.com',)])
+        self.assertTrue(self.manager.drop_by_ip('10.0.0.1'))
+        self.assertEqual(zone.get('a'), [])
+        self.assertRaises(Exception, self.manager.drop_by_ip, '10.0.0.1')
+
+    def test_keepalive(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        for i in range(20):
+            zone.add(RecordTuple('%d' % i, 'A', '10.0.0.%d' % i))
+        self.assertEqual(len(self.server.ports), 1)
+        self.stubs.Set(self.server, 'key', 'other')
+        self.assertRaises(pdnsapi.APIError, self.manager.list)
@@ -0,0 +1,478 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import shutil
+import tempfile
+
+import sqlalchemy.event
+
+from nova import exception
+from nova import flags
+FLAGS = flags.FLAGS
+FLAGS.dns_sql_connection = "sqlite://"
+
+from nova_dns.dnsmanager import DNSRecord
+from nova_dns.dnsmanager import powerdns
+from nova_dns.dnsmanager.powerdns import pipeline
+from nova_dns.dnsmanager.powerdns import models
+from nova_dns.dnsmanager.powerdns import session
+from nova_dns.dnsmanager.powerdns.models import Domains, Records
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+STATEMENTS = []
+sqlalchemy.event.listen(models.get_engine(), "before_cursor_execute",
+    lambda conn, cursor, statement, *args: STATEMENTS.append(statement))
+
+
+class TestCase(tests.TestCase):
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.calls = []
+        self.stubs.Set(pipeline.subprocess, 'call', lambda args: self.calls.append(args))
+        self.stubs.Set(pipeline, '_PIPELINE', pipeline.Pipeline(window=60))
+        self.geomaps_dir = tempfile.mkdtemp()
+        FLAGS.dns_powerdns_geomaps_dir = self.geomaps_dir
+        self.manager = powerdns.Manager()
+        self.manager.session.query(Records).delete()
+        self.manager.session.query(Domains).delete()
+
+    def tearDown(self):
+        self.manager.release()
+        shutil.rmtree(self.geomaps_dir)
+        super(TestCase, self).tearDown()
+
+    def count_queries(self):
+        del STATEMENTS[:]
+        return STATEMENTS
+
+    def test_zone_registry(self):
+        self.manager.add('example.com')
+        self.assertEqual(self.manager.list(), ['example.com'])
+        queries = self.count_queries()
+        zone = self.manager.get('example.com')
+        self.assertEqual(zone.zone_name, 'example.com')
+        self.assertEqual(queries, [])
+        self.assertRaises(Exception, self.manager.add, 'example.com')
+        self.manager.drop('example.com')
+        self.assertEqual(self.manager.list(), [])
+        self.assertRaises(Exception, self.manager.get, 'example.com')
+
+    def test_zone_registry_reload(self):
+        other = powerdns.Manager()
+        self.assertEqual(self.manager.list(), [])
+        other.add('example.com')
+        #miss re-reads zones, added by another manager
+        self.assertEqual(self.manager.get('example.com').domain_id,
+            other.get('example.com').domain_id)
+        #stale map, unique index still refuses duplicates
+        other.add('new.com')
+        self.assertRaisesRegexp(Exception, 'Zone already exists',
+            self.manager.add, 'new.com')
+        self.assertEqual(sorted(self.manager.list()), ['example.com', 'new.com'])
+
+    def test_coalesced_rectify(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        for i in range(5):
+            zone.add(DNSRecord('host%d' % i, 'A', '10.0.0.%d' % i))
+        self.assertEqual(self.calls, [])
+        pipeline.get_pipeline().flush()
+        self.assertEqual(self.calls, [
+            ['sudo', 'pdns_control', 'rediscover'],
+            ['sudo', 'pdnssec', '--config-dir=/etc/powerdns/pdnssec',
+                'rectify-zone', 'example.com']])
+        self.assertFalse(pipeline.get_pipeline().pending())
+
+    def test_get_by_ip(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add(DNSRecord('ns1', 'NS', '10.0.0.1'))
+        zone.add(DNSRecord('www', 'A', '10.0.0.1'))
+        zone.add(DNSRecord('www2', 'A', '10.0.0.12'))
+        self.assertEqual(self.manager.get_by_ip('10.0.0.1'), [('www.example.com',)])
+        self.assertTrue(self.manager.drop_by_ip('10.0.0.1'))
+        self.assertEqual(self.manager.get_by_ip('10.0.0.1'), [])
+        self.assertEqual(len(zone.get('ns1', 'NS')), 1)
+        self.assertRaises(Exception, self.manager.drop_by_ip, '10.0.0.1')
+
+    def test_upgrade_models_adds_indexes(self):
+        engine = models.get_engine()
+        engine.execute("DROP INDEX content_index")
+        engine.execute("DROP INDEX ix_records_name")
+        engine.execute("CREATE INDEX rec_name_index ON records (name)")
+        #no DDL on start
+        models.register_models()
+        inspector = models.Inspector.from_engine(engine)
+        self.assertFalse('content_index' in
+            [i['name'] for i in inspector.get_indexes('records')])
+        models.upgrade_models()
+        indexes = dict((i['name'], i['column_names']) for i in
+            models.Inspector.from_engine(engine).get_indexes('records'))
+        self.assertEqual(indexes['content_index'], ['content'])
+        #same columns under pdns schema name
+        self.assertEqual(indexes['rec_name_index'], ['name'])
+        self.assertFalse('ix_records_name' in indexes)
+
+    def test_add_many(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        serial = zone.get_soa().serial
+        queries = self.count_queries()
+        zone.add_many([DNSRecord('host%d' % i, 'A', '10.0.0.%d' % i)
+            for i in range(10)])
+        #existing records select, insert, SOA select and update
+        self.assertEqual(len(queries), 4)
+        self.assertEqual(len(zone.get(type='A')), 10)
+        self.assertNotEqual(zone.get_soa().serial, serial)
+
+    def test_apply(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        results = zone.apply([
+            ("add", DNSRecord('www', 'A', '10.0.0.1')),
+            ("set", 'www', 'A', '10.0.0.2', None, 60),
+            ("delete", 'missing', 'A'),
+            ("add", DNSRecord('mail', 'MX', '10.0.0.3', priority=10)),
+            ("delete", 'mail', 'MX'),
+            ("rename", 'www')])
+        self.assertEqual([r['error'] for r in results], [None, None,
+            'No records was deleted', None, None, 'Incorrect action: rename'])
+        records = zone.get(type='A')
+        self.assertEqual([(r.name, r.content, r.ttl) for r in records],
+            [('www.example.com', '10.0.0.2', 60)])
+        self.assertEqual(zone.get('mail', 'MX'), [])
+
+    def test_zone_without_soa(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add(DNSRecord('www', 'A', '10.0.0.1'))
+        self.assertTrue(zone.get_serial())
+        zone._q('', 'SOA').delete()
+        #listed without version, not failed
+        self.assertEqual(zone.get_serial(), None)
+        self.assertRaisesRegexp(Exception, 'Zone has no SOA record',
+            zone.get_soa)
+        self.assertEqual([r['name'] for m, r in zone.iter_records()],
+            ['www.example.com'])
+        #writes don't need serial
+        zone.add(DNSRecord('www2', 'A', '10.0.0.2'))
+        zone.delete('www', 'A')
+        self.assertEqual([r['name'] for m, r in zone.iter_records()],
+            ['www2.example.com'])
+
+    def test_apply_duplicates(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add(DNSRecord('www', 'A', '10.0.0.1'))
+        results = zone.apply([
+            ("add", DNSRecord('host1', 'A', '10.0.0.2')),
+            ("add", DNSRecord('www', 'A', '10.0.0.3')),
+            ("add", DNSRecord('host2', 'A', '10.0.0.4')),
+            ("add", DNSRecord('host1', 'A', '10.0.0.5')),
+            ("add", DNSRecord('host1', 'TXT', 'text'))])
+        #duplicates don't break the transaction, other records are added
+        self.assertEqual([r['error'] for r in results], [None,
+            'Record (www.example.com, A) already exists', None,
+            'Record (host1.example.com, A) already exists', None])
+        self.assertEqual(sorted((r.name, r.content) for r in zone.get(type='A')),
+            [('host1.example.com', '10.0.0.2'),
+             ('host2.example.com', '10.0.0.4'),
+             ('www.example.com', '10.0.0.1')])
+        self.assertEqual(len(zone.get('host1', 'TXT')), 1)
+
+    def test_apply_db_error(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add(DNSRecord('www', 'A', '10.0.0.1'))
+
+        def flush(*args):
+            raise exception.DBError(Exception("lost connection"))
+
+        self.stubs.Set(zone.session, 'flush', flush)
+        #database error aborts the changeset, it isn't a per-change error
+        self.assertRaises(exception.DBError, zone.apply, [
+            ("add", DNSRecord('mail', 'A', '10.0.0.2')),
+            ("set", 'www', 'A', '10.0.0.3', None, None)])
+        self.stubs.UnsetAll()
+        self.assertEqual([r.content for r in zone.get(type='A')], ['10.0.0.1'])
+        #geomaps are scheduled after commit only
+        self.assertEqual(zone.pipeline.geomaps.keys(),
+            [os.path.join(self.geomaps_dir, 'www.com')])
+
+    def test_apply_deletes(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add_many([DNSRecord('host%d' % i, 'A', '10.0.0.%d' % i)
+            for i in range(10)])
+        queries = self.count_queries()
+        results = zone.apply([("delete", 'host%d' % i, 'A') for i in range(9)] +
+            [("delete", 'host0', 'A')])
+        #select, delete, SOA select and update
+        self.assertEqual(len(queries), 4)
+        self.assertEqual([r['error'] for r in results],
+            [None] * 9 + ['No records was deleted'])
+        self.assertEqual([r.name for r in zone.get(type='A')], ['host9.example.com'])
+
+    def test_session_scope(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        self.assertTrue(zone.session is self.manager.session)
+        old = self.manager.session
+        self.manager.release()
+        self.assertFalse(self.manager.session is old)
+        self.assertTrue(zone.session is self.manager.session)
+        self.assertEqual(len(zone.get('', 'SOA')), 1)
+
+    def test_ping_interval(self):
+        pings = []
+        class Cursor(object):
+            def execute(self, sql):
+                pings.append(sql)
+        class Connection(object):
+            def cursor(self):
+                return Cursor()
+        class Record(object):
+            info = {}
+        listener = session.MySQLPingListener()
+        con, record = Connection(), Record()
+        listener.checkout(con, record, None)
+        listener.checkin(con, record)
+        listener.checkout(con, record, None)
+        self.assertEqual(pings, ['select 1'])
+        self.stubs.Set(FLAGS, 'dns_sql_ping_interval', 0)
+        listener.checkout(con, record, None)
+        self.assertEqual(len(pings), 2)
+
+    def test_server_side_cursors(self):
+        class cursors(object):
+            class SSCursor(object):
+                pass
+        class Connection(object):
+            def cursor(self, cursor_class=None):
+                return cursor_class
+        class Context(object):
+            def create_cursor(self):
+                return self._dbapi_connection.cursor()
+        class MySQLdb(object):
+            pass
+        MySQLdb.cursors = cursors
+        class Dialect(object):
+            execution_ctx_cls = Context
+            dbapi = MySQLdb
+        dialect = Dialect()
+        session._server_side_cursors(dialect)
+        context = dialect.execution_ctx_cls()
+        context._dbapi_connection = Connection()
+        context.execution_options = {}
+        self.assertEqual(context.create_cursor(), None)
+        context.execution_options = {"stream_results": True}
+        self.assertEqual(context.create_cursor(), cursors.SSCursor)
+
+    def test_stream_while_writing(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add_many([DNSRecord('host%d' % i, 'A', '10.0.0.%d' % i)
+            for i in range(3)])
+        #records are streamed by their own connection
+        for name, content in zone.iter_names('A'):
+            zone.delete(name.split('.')[0], 'A')
+        self.assertEqual(zone.get(type='A'), [])
+
+    def test_read_replica(self):
+        self.stubs.Set(FLAGS, 'dns_sql_read_connection', ['sqlite://'])
+        self.stubs.Set(session, '_READ_ENGINES', None)
+        self.stubs.Set(session, '_READ_MAKERS', None)
+        self.stubs.Set(session, '_READ_SESSIONS', None)
+        self.stubs.Set(session, '_WRITES', {})
+        replica = session.get_read_engines()[0]
+        models.BASE.metadata.create_all(replica)
+        replica.execute(Domains.__table__.insert(), id=100, name='replica.com',
+            type='NATIVE')
+        #read your writes
+        self.manager.add('example.com')
+        self.manager.invalidate()
+        self.assertEqual(self.manager.list(), ['example.com'])
+        self.manager.invalidate()
+        self.stubs.Set(FLAGS, 'dns_sql_sticky_time', 0)
+        self.assertEqual(self.manager.list(), ['replica.com'])
+        self.assertEqual(self.manager.get_by_ip('10.0.0.1'), [])
+        #writes go to primary
+        zone = self.manager.get('replica.com')
+        self.assertEqual(zone.get(), [])
+        self.assertRaises(Exception, zone.set, '', 'A', '10.0.0.1')
+        #zone added by another process isn't on lagging replica yet
+        powerdns.Manager().add('new.com')
+        self.assertEqual(self.manager.get('new.com').zone_name, 'new.com')
+
+    def test_iter_records(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        zone.add_many([DNSRecord(name='r%d' % i, type='A',
+            content='10.0.0.%d' % i) for i in range(5)])
+        records = list(zone.iter_records(type='A', limit=3))
+        self.assertEqual([r['name'] for m, r in records],
+            ['r0.example.com', 'r1.example.com', 'r2.example.com'])
+        records = list(zone.iter_records(type='A', marker=records[-1][0]))
+        self.assertEqual([r['content'] for m, r in records],
+            ['10.0.0.3', '10.0.0.4'])
+        records = [r for m, r in zone.iter_records(name='')]
+        self.assertEqual([r['type'] for r in records], ['SOA'])
+        self.assertEqual(records, [r.to_dict() for r in zone.get('', 'SOA')])
+
+    def test_get_serial(self):
+        self.manager.add('example.com')
+        zone = self.manager.get('example.com')
+        serial = int(zone.get_serial())
+        zone.add(DNSRecord(name='www', type='A', content='10.0.0.1'))
+        self.assertTrue(int(zone.get_serial()) > serial)
+
+    def test_drop_subzones(self):
+        for name in ('example.com', 'sub.example.com', 'a.sub.example.com',
+                'myexample.com', 'my_example.com'):
+            self.manager.add(name)
+            self.manager.get(name).add(DNSRecord(name='www', type='A',
+                content='10.0.0.1'))
+        try:
+            self.manager.drop('example.com')
+            self.fail('subzones were dropped')
+        except Exception as e:
+            self.assertEqual(sorted(str(e).split()[2:]), ['a.sub.example.com',
+                'example.com', 'sub.example.com'])
+        queries = self.count_queries()
+        self.manager.drop('example.com', force=True)
+        self.assertEqual(len([q for q in queries if 'DELETE' in q]), 2)
+        self.assertEqual(sorted(self.manager.list()),
+            ['my_example.com', 'myexample.com'])
+        self.assertEqual(self.manager.session.query(Records).filter(
+            Records.name.like('%.example.com')).count(), 0)
+        self.assertRaises(Exception, self.manager.drop, 'my%example.com')
+        self.manager.drop('my_example.com')
+        self.assertEqual(self.manager.list(), ['myexample.com'])
+
+    def test_drop_zones_added_by_other_tools(self):
+        engine = models.get_engine()
+        engine.execute("insert into domains (name, type) "
+            "values ('example.com', 'NATIVE')")
+        engine.execute("insert into domains (name, type) "
+            "values ('sub.example.com', 'NATIVE')")
+        self.manager.invalidate()
+        self.assertRaises(Exception, self.manager.drop, 'example.com')
+        self.manager.drop('example.com', force=True)
+        self.assertEqual(self.manager.list(), [])
+
+    def test_upgrade_models_adds_columns(self):
+        engine = models.get_engine()
+        engine.execute("drop table domains")
+        engine.execute("create table domains (id integer primary key, "
+            "name varchar(255), master varchar(255), last_check integer, "
+            "type varchar(6), notified_serial integer, account varchar(40))")
+        engine.execute("insert into domains (id, name, type) "
+            "values (1, 'sub.example.com', 'NATIVE')")
+        models.upgrade_models()
+        self.assertEqual(engine.execute("select reverse_name from domains"
+            ).fetchall(), [('com.example.sub.',)])
+        self.manager.invalidate()
+        self.manager.drop('example.com')
+        self.assertEqual(self.manager.list(), [])
+
+    def test_geomaps(self):
+        self.manager.add('tenant.example.com')
+        zone = self.manager.get('tenant.example.com')
+        zone.add_many([DNSRecord('host%d' % i, 'A', '10.0.0.%d' % i)
+            for i in range(3)])
+        #written on flush only
+        self.assertEqual(os.listdir(self.geomaps_dir), [])
+        pipeline.get_pipeline().flush()
+        self.assertEqual(sorted(os.listdir(self.geomaps_dir)),
+            ['host0.example.com', 'host1.example.com', 'host2.example.com'])
+        with open(os.path.join(self.geomaps_dir, 'host1.example.com')) as f:
+            self.assertEqual(f.read(), "$RECORD host1\n$ORIGIN example.com\n"
+                "0   host1.external\n900 host1.internal\n")
+        #readable by pdns user
+        self.assertEqual(os.stat(os.path.join(self.geomaps_dir,
+            'host1.example.com')).st_mode & 0777, 0644)
+        self.assertEqual(self.calls[0], ['sudo', 'pdns_control', 'rediscover'])
+        zone.delete('host1', 'A')
+        zone.add(DNSRecord('host3', 'A', '10.0.0.3'))
+        del self.calls[:]
+        pipeline.get_pipeline().flush()
+        self.assertEqual(sorted(os.listdir(self.geomaps_dir)),
+            ['host0.example.com', 'host2.example.com', 'host3.example.com'])
+        self.assertEqual(self.calls.count(['sudo', 'pdns_control',
+            'rediscover']), 1)
+
+    def test_geomaps_write_error(self):
+        self.manager.add('tenant.example.com')
+        zone = self.manager.get('tenant.example.com')
+        zone.add(DNSRecord('host0', 'A', '10.0.0.0'))
+        shutil.rmtree(self.geomaps_dir)
+        #zone is rectified even if maps can't be written
+        pipeline.get_pipeline().flush()
+        self.assertEqual(self.calls, [
+            ['sudo', 'pdns_control', 'rediscover'],
+            ['sudo', 'pdnssec', '--config-dir=/etc/powerdns/pdnssec',
+                'rectify-zone', 'tenant.example.com']])
+        self.assertFalse(pipeline.get_pipeline().pending())
+        os.mkdir(self.geomaps_dir)
+
+    def test_regenerate_geomaps(self):
+        self.manager.add('tenant.example.com')
+        zone = self.manager.get('tenant.example.com')
+        zone.add_many([DNSRecord('host%d' % i, 'A', '10.0.0.%d' % i)
+            for i in range(2)])
+        pipeline.get_pipeline().flush()
+        os.remove(os.path.join(self.geomaps_dir, 'host0.example.com'))
+        open(os.path.join(self.geomaps_dir, 'stale.example.com'), 'w').close()
+        self.assertEqual(self.manager.regenerate_geomaps(), 2)
+        pipeline.get_pipeline().flush()
+        self.assertEqual(sorted(os.listdir(self.geomaps_dir)),
+            ['host0.example.com', 'host1.example.com'])
+
+    def test_regenerate_keeps_pending(self):
+        self.manager.add('tenant.example.com')
+        zone = self.manager.get('tenant.example.com')
+        zone.add_many([DNSRecord('host%d' % i, 'A', '10.0.0.%d' % i)
+            for i in range(2)])
+        pipeline.get_pipeline().flush()
+        #delete committed, its map removal is pending while maps are read
+        files = dict(powerdns.geomap('host%d' % i, 'tenant.example.com')
+            for i in range(2))
+        zone.delete('host0', 'A')
+        zone.add(DNSRecord('host2', 'A', '10.0.0.2'))
+        pipeline.get_pipeline().regenerate(self.geomaps_dir, files)
+        pipeline.get_pipeline().flush()
+        self.assertEqual(sorted(os.listdir(self.geomaps_dir)),
+            ['host1.example.com', 'host2.example.com'])
+
+    def test_regenerate_geomaps_on_start(self):
+        self.manager.add('tenant.example.com')
+        zone = self.manager.get('tenant.example.com')
+        zone.add(DNSRecord('host0', 'A', '10.0.0.0'))
+        pipeline.get_pipeline().flush()
+        open(os.path.join(self.geomaps_dir, 'stale.example.com'), 'w').close()
+        self.manager.init_host()
+        self.assertFalse(pipeline.get_pipeline().pending())
+        self.stubs.Set(FLAGS, 'dns_powerdns_regenerate_geomaps', True)
+        self.manager.init_host()
+        pipeline.get_pipeline().flush()
+        self.assertEqual(os.listdir(self.geomaps_dir), ['host0.example.com'])
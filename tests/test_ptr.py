@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova DNS
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 2.1 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+from nova_dns.listener.simple.ptr import PTRZones
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+
+class TestCase(tests.TestCase):
+    def test_ipv4(self):
+        zones = PTRZones(["10.0.0.0/8", "10.0.1.0/24", "10.0.1.64/26",
+            "192.168.0.32/27"])
+        self.assertEqual(zones.lookup("10.0.1.70"), ("64-26.1.0.10.in-addr.arpa", 70))
+        self.assertEqual(zones.lookup("10.0.1.1"), ("0-24.1.0.10.in-addr.arpa", 1))
+        self.assertEqual(zones.lookup("10.0.1.128"), ("0-24.1.0.10.in-addr.arpa", 128))
+        self.assertEqual(zones.lookup("10.2.3.4"), ("0-8.0.0.10.in-addr.arpa", 4))
+        self.assertEqual(zones.lookup("192.168.0.63"), ("32-27.0.168.192.in-addr.arpa", 63))
+        #out of delegated networks
+        self.assertEqual(zones.lookup("192.168.0.64"), ("0.168.192.in-addr.arpa", 64))
+        self.assertEqual(PTRZones("").lookup("172.16.5.4"), ("5.16.172.in-addr.arpa", 4))
+
+    def test_ipv6(self):
+        zones = PTRZones(["2001:db8::/32", "2001:db8:1::/48"])
+        self.assertEqual(zones.lookup("2001:db8:1::1"),
+            ("1.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa",
+             "1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0"))
+        self.assertEqual(zones.lookup("2001:db8:2::1")[0], "8.b.d.0.1.0.0.2.ip6.arpa")
+        self.assertEqual(zones.lookup("2001:db9::1"),
+            ("0.0.0.0.0.0.0.0.9.b.d.0.1.0.0.2.ip6.arpa",
+             "1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0"))
+        self.assertRaises(ValueError, PTRZones, ["2001:db8::/30"])